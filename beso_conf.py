@@ -26,6 +26,8 @@ domain_FI[elset_name] = [[("stress_von_Mises", 450.0e6)],  # inner tuples () for
                         # examples:
                         # [("user_def", "sxx / 600.0"), ("user_def", "syy / 150.0"), ("user_def", "sxy / 50.0")]  # "user_def" defines complete formula for FI
                         # [("stress_von_Mises", 450.0)]  # for von Mises stress give only allowable stress
+                        # "user_def" may use sxx, syy, szz, sxy, sxz, syz (syx, szx, szy), numbers, arithmetic operators,
+                        # functions abs, sqrt, exp, log, max, min and numpy ufuncs as np.name, e.g. np.arctan2
 domain_material[elset_name] = ["*ELASTIC \n210000e-6,  0.3",  # material definition after CalculiX *MATERIAL card, use \n for line break
                                "*ELASTIC \n210000,  0.3"]  # next string for the next state of switch_elm
 domain_same_state[elset_name] = False  # False - element states can differ, True - all domain elements have common state
@@ -43,8 +45,10 @@ continue_from = ""  # if not "", optimization will load element states from the
 filter_list = [["simple", 2]]  # [[filter type, range, domains or nothing for all domains], [next filter type, range, "domain1", "domain2"], ...]
                             # filter types:
                             # "over points" - filter with step over own point mesh, works on sensitivities
-                            # "over nodes" - filter with step over nodes (suffer from boundary sticking?, 2nd order elements need more memory), works on sensitivities
+                            # "over nodes" - filter with step over nodes (suffer from boundary sticking?), works on sensitivities
                             # "simple" - averages sensitivity number with surroundings (suffer from boundary sticking?), works on sensitivities
+                            # "topological" - averages sensitivity number over elements within N rings of elements sharing a node,
+                            #                 range N is the number of rings, suitable for graded meshes, works on sensitivities
                             # morphology based filters:
                             # "erode sensitivity" - use minimum sensitivity number in radius range
                             # "dilate sensitivity" - use maximum sensitivity number in radius range
@@ -58,11 +62,26 @@ filter_list = [["simple", 2]]  # [[filter type, range, domains or nothing for al
 
 # ADVANCED INPUTS:
 
+filter_memory_limit = 0  # 0 - no limit, near elements of all "simple" and morphology filters are searched at once
+                         # N - near elements are searched in chunks using about N MB, stored as compact arrays
+                         # and spilled to temporary files next to the input file if they exceed N/2 MB
+
+structured_grid_filter = False  # True - "simple" filter on elements with centres on a regular orthogonal grid
+                                # (e.g. voxel-like hexa8 or quad4 meshes) is computed by FFT convolution without
+                                # lists of near elements, other meshes are filtered as usual
+                                # False - always use lists of near elements
+
 optimization_base = "stiffness"  # "stiffness" - maximization of stiffness (minimization of compliance), reference_points must be set to "integration points"
                                  # "failure_index" sensitivity number is given by FI/density
 
 cpu_cores = 0  # 0 - use all processor cores, N - will use N number of processor cores
 
+mesh_cache = False  # True - save parsed mesh, element volumes, centres of gravity and prepared filters to .npz files
+                    # next to the input file
+                    # and reuse them in the next runs while the input file and its included files are not changed,
+                    # a _filter_cache_*.npz file is kept for each filter setting, delete stale ones manually
+                    # False - read the input file in each run
+
 FI_violated_tolerance = 1  # N - freeze mass if, compared to initial state, there is N more elements with FI >= 1
 decay_coefficient = -0.2  # k - exponential decay coefficient to dump mass_additive_ratio and mass_removal_ratio after freezing mass
                           # fits to equation: exp(k * i), where i is iteration number from triggering by exceeding FI_violated_tolerance
@@ -89,6 +108,8 @@ steps_superposition = []  # make linear superposition of stress tensors from dif
                           # [[(0.5, 1), (0.2, 2)], [(-1.5, 3)]]
                           # first superposition is from the first step (i.e. step 1) with stress tensor multiplied by 0.5 plus stress tensor from step 2 multiplied by 0.2,
                           # second superposition is only from step 3 but with stress tensor multiplied by -1.5
+stream_steps = False  # True - results of each step are folded to maxima over steps as the step is read, memory does not
+                      # grow with the number of steps, exported FI are the same, False - results of all steps are kept
 
 iterations_limit = "auto"  # "auto" - automatic estimate, <integer> - the maximum allowable number of iterations
 tolerance = 1e-3  # the maximum relative difference in mean stress in optimization domains between the last 5 iterations needed to finish
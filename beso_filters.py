@@ -1,17 +1,9 @@
+import hashlib
+import os
+import tempfile
 import numpy as np
 import beso_lib
 
-def sround(x, s):
-    """round float number x to s significant digits"""
-    if x > 0:
-        result = round(x, -int(np.floor(np.log10(x))) + s - 1)
-    elif x < 0:
-        result = round(x, -int(np.floor(np.log10(-x))) + s - 1)
-    elif x == 0:
-        result = 0
-    return result
-
-
 # function to check if filtering is to be used on domains with prescribed same state
 def check_same_state(domain_same_state, filtered_dn, file_name):
     wrong_domains = False
@@ -30,381 +22,821 @@ def check_same_state(domain_same_state, filtered_dn, file_name):
         print(msg)
 
 
-# function preparing values for filtering element sensitivity numbers to suppress checkerboard
-def prepare1(nodes, Elements, cg, r_min, opt_domains):
-    # searching for Elements neighbouring to every node
-    node_neighbours = {}
-
-    def fce():
-        if nn not in node_neighbours:
-            node_neighbours[nn] = [en]
-        elif en not in node_neighbours[nn]:
-            node_neighbours[nn].append(en)
-
-    for en in Elements.tria3:
-        for nn in Elements.tria3[en]:
-            fce()
-    for en in Elements.tria6:
-        for nn in Elements.tria6[en]:
-            fce()
-    for en in Elements.quad4:
-        for nn in Elements.quad4[en]:
-            fce()
-    for en in Elements.quad8:
-        for nn in Elements.quad8[en]:
-            fce()
-    for en in Elements.tetra4:
-        for nn in Elements.tetra4[en]:
-            fce()
-    for en in Elements.tetra10:
-        for nn in Elements.tetra10[en]:
-            fce()
-    for en in Elements.hexa8:
-        for nn in Elements.hexa8[en]:
-            fce()
-    for en in Elements.hexa20:
-        for nn in Elements.hexa20[en]:
-            fce()
-    for en in Elements.penta6:
-        for nn in Elements.penta6[en]:
-            fce()
-    for en in Elements.penta15:
-        for nn in Elements.penta15[en]:
-            fce()
-    # computing weight factors for sensitivity number of nodes according to distance to adjacent elements
-    distance = {}
-    M = {}  # element numbers en adjacent to each node nn
-    weight_factor_node = {}
-    for nn in node_neighbours:
-        distance_sum = 0
-        M[nn] = []
-        for en in node_neighbours[nn]:
-            dx = cg[en][0] - nodes[nn][0]
-            dy = cg[en][1] - nodes[nn][1]
-            dz = cg[en][2] - nodes[nn][2]
-            distance[(en, nn)] = (dx ** 2 + dy ** 2 + dz ** 2) ** 0.5
-            distance_sum += distance[(en, nn)]
-            M[nn].append(en)
-        weight_factor_node[nn] = {}
-        for en in M[nn]:
-            if len(M[nn]) != 1:
-                weight_factor_node[nn][en] = 1 / (len(M[nn]) - 1.0) * (1 - distance[(en, nn)] / distance_sum)
+# offsets of 13 neighbouring cells which are compared with each cell (the other 13 compare with it)
+# down level:  middle level:  upper level:
+# o  o  -      o  o  -        o  o  -
+# o  -  -      o self -       o  o  -
+# o  -  -      o  -  -        o  -  -
+neighbour_cells = [(1, -1, -1), (1, 0, -1), (1, 1, -1), (0, 1, -1), (1, -1, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0),
+                   (1, -1, 1), (1, 0, 1), (1, 1, 1), (0, 1, 1), (0, 0, 1)]
+
+
+# function sorting points xyz (n, 3) to integer cells of size cell_size with given origin and dimensions
+# returns order of points, sorted keys of occupied cells with position of their first point and number of points,
+# cell of each point in the order and coordinates in the order
+def hash_cells(xyz, origin, cell_size, dims):
+    cells = np.floor((xyz - origin) / cell_size).astype(np.int64) + 1  # margin for neighbour cells
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys, kind="stable")
+    [cell_keys, cell_start, cell_count] = np.unique(keys[order], return_index=True, return_counts=True)
+    point_cell = np.repeat(np.arange(len(cell_keys)), cell_count)
+    coordinates = [np.ascontiguousarray(xyz[order, k]) for k in range(3)]
+    return order, cell_keys, cell_start, cell_count, point_cell, coordinates
+
+
+# function finding pairs of points with distance less than r_min
+# points xyz (n, 3) are hashed to integer cells of size r_min, only occupied cells are stored in a sorted array
+# and each point is compared with points of its own and neighbouring cells in batches of batch_size candidate pairs
+# returns positions i < j of near points in xyz and their distance,
+# or positions i in xyz and j in xyz2 if the second set of points xyz2 is given
+def near_pairs(xyz, r_min, xyz2=None, batch_size=2 ** 22):
+    i_list = [np.zeros(0, dtype=np.int64)]
+    j_list = [np.zeros(0, dtype=np.int64)]
+    distance_list = [np.zeros(0)]
+    xyz_b = xyz if xyz2 is None else xyz2
+    if len(xyz) == 0 or len(xyz_b) == 0:
+        return i_list[0], j_list[0], distance_list[0]
+    origin = np.minimum(xyz.min(axis=0), xyz_b.min(axis=0))
+    cell_size = r_min * (1 + 1e-9)  # near points are in neighbouring cells despite rounding
+    dims = np.floor((np.maximum(xyz.max(axis=0), xyz_b.max(axis=0)) - origin) / cell_size).astype(np.int64) + 3
+    [order_b, cell_keys_b, cell_start_b, cell_count_b, point_cell_b, xyz_b_sorted] = hash_cells(xyz_b, origin,
+                                                                                              cell_size, dims)
+    if xyz2 is None:  # the same cells, each pair is found once from the own and 13 neighbouring cells
+        [order_a, cell_keys_a, point_cell_a, xyz_a_sorted] = [order_b, cell_keys_b, point_cell_b, xyz_b_sorted]
+        offsets = [(0, 0, 0)] + neighbour_cells
+    else:
+        [order_a, cell_keys_a, _, _, point_cell_a, xyz_a_sorted] = hash_cells(xyz, origin, cell_size, dims)
+        offsets = [(dx, dy, dz) for dx in [-1, 0, 1] for dy in [-1, 0, 1] for dz in [-1, 0, 1]]
+
+    for offset in offsets:
+        if xyz2 is None and offset == (0, 0, 0):  # following points of the same cell
+            points = np.arange(len(xyz))
+            start = points + 1
+            count = (cell_start_b + cell_count_b)[point_cell_a] - start
+        else:
+            key_offset = (offset[0] * dims[1] + offset[1]) * dims[2] + offset[2]
+            position = np.searchsorted(cell_keys_b, cell_keys_a + key_offset)
+            occupied = position < len(cell_keys_b)
+            occupied[occupied] = cell_keys_b[position[occupied]] == cell_keys_a[occupied] + key_offset
+            points = np.nonzero(occupied[point_cell_a])[0]
+            neighbour = position[point_cell_a[points]]
+            start = cell_start_b[neighbour]
+            count = cell_count_b[neighbour]
+        pair_end = np.cumsum(count)
+        # points are taken in batches with limited number of candidate pairs
+        first = 0
+        while first < len(points):
+            last = np.searchsorted(pair_end, pair_end[first] - count[first] + batch_size, side="right")
+            last = max(last, first + 1)
+            counts = count[first:last]
+            i = np.repeat(points[first:last], counts)  # positions in the cell order
+            j = np.arange(counts.sum()) + np.repeat(start[first:last] - np.cumsum(counts) + counts, counts)
+            distance = (xyz_a_sorted[0][i] - xyz_b_sorted[0][j]) ** 2
+            distance += (xyz_a_sorted[1][i] - xyz_b_sorted[1][j]) ** 2
+            distance += (xyz_a_sorted[2][i] - xyz_b_sorted[2][j]) ** 2
+            distance = np.sqrt(distance)
+            near = distance < r_min
+            i = order_a[i[near]]
+            j = order_b[j[near]]
+            if xyz2 is None:
+                i_list.append(np.minimum(i, j))
+                j_list.append(np.maximum(i, j))
             else:
-                weight_factor_node[nn][en] = 1.0
+                i_list.append(i)
+                j_list.append(j)
+            distance_list.append(distance[near])
+            first = last
+    return np.concatenate(i_list), np.concatenate(j_list), np.concatenate(distance_list)
+
+
+# function copying arrays to a new block of shared memory, returns the block and views of the arrays in it
+def shared_arrays(arrays):
+    from multiprocessing import shared_memory
+    size = sum(array.nbytes for array in arrays)
+    block = shared_memory.SharedMemory(create=True, size=max(1, size))
+    views = []
+    offset = 0
+    for array in arrays:
+        views.append(np.ndarray(array.shape, array.dtype, buffer=block.buf, offset=offset))
+        views[-1][...] = array
+        offset += array.nbytes
+    return block, views
+
+
+# function searching near pairs of one slab of points in a process, points are read from shared memory block
+# and pairs are returned in a new shared memory block which is released by the caller
+def slab_pairs(task):
+    from multiprocessing import shared_memory
+    [name, n_a, n_b, first, end, c_first, c_end, r_min, self_mode] = task
+    block = shared_memory.SharedMemory(name=name)
+    xyz_a = np.ndarray((n_a, 3), buffer=block.buf)
+    xyz_b = np.ndarray((n_b, 3), buffer=block.buf, offset=n_a * 24) if not self_mode else xyz_a
+    [i, j, distance] = near_pairs(xyz_a[first:end], r_min, xyz_b[c_first:c_end])
+    del xyz_a, xyz_b
+    block.close()
+    i += first
+    j += c_first
+    if self_mode:
+        other = i != j
+        [i, j, distance] = [i[other], j[other], distance[other]]
+    result, _ = shared_arrays([i, j, distance])
+    result.close()
+    return result.name, len(i)
+
+
+# function finding pairs of points with distance less than r_min in cpu_cores processes
+# points are sorted along x axis and split to slabs, each slab is searched against points of the slab extended by
+# halo of width r_min, points are shared with processes and pairs are gathered from them through shared memory
+# returns positions i, j of near points in xyz in both directions (without the point itself) and their distance,
+# or positions i in xyz and j in xyz2 if the second set of points xyz2 is given, None if processes cannot be used
+def near_pairs_parallel(xyz, r_min, xyz2=None, cpu_cores=1, slabs_per_core=4):
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:  # Python older than 3.8, serial search is used
+        return None
+    self_mode = xyz2 is None
+    xyz_b = xyz if self_mode else xyz2
+    order_a = np.argsort(xyz[:, 0], kind="stable")
+    order_b = order_a if self_mode else np.argsort(xyz_b[:, 0], kind="stable")
+    block, views = shared_arrays([xyz[order_a]] if self_mode else [xyz[order_a], xyz_b[order_b]])
+    pool = beso_lib.process_pool(cpu_cores)
+    if pool is None:
+        del views
+        block.close()
+        block.unlink()
+        return None
+    x_a = views[0][:, 0]
+    x_b = views[0][:, 0] if self_mode else views[1][:, 0]
+    tasks = []
+    bounds = np.linspace(0, len(xyz), cpu_cores * slabs_per_core + 1).astype(np.int64)
+    for first, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        if end > first:
+            c_first = int(np.searchsorted(x_b, x_a[first] - r_min, side="left"))
+            c_end = int(np.searchsorted(x_b, x_a[end - 1] + r_min, side="right"))
+            tasks.append((block.name, len(xyz), len(xyz_b), first, end, c_first, c_end, r_min, self_mode))
+    del x_a, x_b, views
+    try:
+        results = pool.map(slab_pairs, tasks)
+    finally:
+        pool.close()
+        pool.join()
+        block.close()
+        block.unlink()
+
+    total = sum(count for _, count in results)
+    [i, j, distance] = [np.zeros(total, dtype=np.int64), np.zeros(total, dtype=np.int64), np.zeros(total)]
+    position = 0
+    for name, count in results:
+        result = shared_memory.SharedMemory(name=name)
+        i[position:position + count] = np.ndarray((count,), np.int64, buffer=result.buf)
+        j[position:position + count] = np.ndarray((count,), np.int64, buffer=result.buf, offset=count * 8)
+        distance[position:position + count] = np.ndarray((count,), buffer=result.buf, offset=count * 16)
+        result.close()
+        result.unlink()
+        position += count
+    return order_a[i], order_b[j], distance
+
+
+# function finding pairs of points xyz and xyz2 with distance less than r_min by computing all their distances
+# returns positions i in xyz and j in xyz2 and the distance, very slow for large sets of points
+def near_pairs_brute_force(xyz, xyz2, r_min, batch_size=2 ** 22):
+    i_list = [np.zeros(0, dtype=np.int64)]
+    j_list = [np.zeros(0, dtype=np.int64)]
+    distance_list = [np.zeros(0)]
+    rows = max(1, batch_size // max(1, len(xyz2)))
+    for first in range(0, len(xyz), rows):
+        distance = np.sqrt(((xyz[first:first + rows, None, :] - xyz2[None, :, :]) ** 2).sum(axis=2))
+        [i, j] = np.nonzero(distance < r_min)
+        i_list.append(i + first)
+        j_list.append(j)
+        distance_list.append(distance[i, j])
+    return np.concatenate(i_list), np.concatenate(j_list), np.concatenate(distance_list)
+
+
+# sparse matrix in compressed sparse row format, row r has columns indices[indptr[r]:indptr[r + 1]] with data
+class SparseMatrix(object):
+    def __init__(self, rows, columns, data, shape):
+        order = np.argsort(rows)
+        self.shape = shape
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=shape[0]))])
+        self.indices = np.asarray(columns)[order]
+        self.data = None if data is None else np.asarray(data)[order]  # None for a pattern of near elements
+
+    def empty_rows(self):
+        return self.indptr[:-1] == self.indptr[1:]
+
+    def reduce(self, ufunc, values, empty=0):
+        """reduction (np.add, np.minimum, np.maximum) of values given for stored entries in each row"""
+        result = np.full(self.shape[0], empty, dtype=np.asarray(values).dtype)
+        starts = self.indptr[:-1][~self.empty_rows()]
+        if len(starts):
+            result[~self.empty_rows()] = ufunc.reduceat(values, starts)
+        return result
+
+    def row_blocks(self, block_size=2 ** 22):
+        """first and end row of blocks of rows with about block_size stored entries"""
+        first = 0
+        while first < self.shape[0]:
+            end = np.searchsorted(self.indptr, self.indptr[first] + block_size, side="right") - 1
+            end = min(max(end, first + 1), self.shape[0])
+            yield first, end
+            first = end
+
+    def reduce_columns(self, ufunc, vector, empty=0):
+        """reduction of vector values at columns of stored entries (multiplied by data if any) in each row,
+        computed in blocks of rows so that data mapped from a file are not read at once"""
+        vector = np.asarray(vector)
+        dtype = vector.dtype if self.data is None else np.result_type(vector.dtype, self.data.dtype)
+        result = np.full(self.shape[0], empty, dtype=dtype)
+        for [first, end] in self.row_blocks():
+            indptr = self.indptr[first:end + 1] - self.indptr[first]
+            values = vector[self.indices[self.indptr[first]:self.indptr[end]]]
+            if self.data is not None:
+                values = values * self.data[self.indptr[first]:self.indptr[end]]
+            non_empty = indptr[:-1] != indptr[1:]
+            if non_empty.any():
+                result[first:end][non_empty] = ufunc.reduceat(values, indptr[:-1][non_empty])
+        return result
+
+    def dot(self, vector):
+        return self.reduce_columns(np.add, vector)
+
+    def normalize_rows(self):
+        sums = self.reduce(np.add, self.data)
+        sums[sums == 0] = 1
+        self.data = self.data / np.repeat(sums, np.diff(self.indptr))
+
+
+# function returning sparse matrix of given compressed sparse row arrays
+def sparse_from_csr(indptr, indices, data, shape):
+    matrix = SparseMatrix.__new__(SparseMatrix)
+    matrix.shape = shape
+    matrix.indptr = indptr
+    matrix.indices = indices
+    matrix.data = data
+    return matrix
+
+
+# function returning array of values in blocks written to a temporary file in directory, mapped from the file
+def spilled_array(directory, blocks, dtype):
+    length = sum(len(block) for block in blocks)
+    if not length:
+        return np.zeros(0, dtype=dtype)
+    f = tempfile.TemporaryFile(dir=directory)  # removed when the mapped array is deleted
+    for block in blocks:
+        np.asarray(block, dtype=dtype).tofile(f)
+    f.flush()
+    return np.memmap(f, dtype=dtype, mode="r", shape=(length,))
+
+
+# function building sparse matrix of near elements within r_min with bounded memory
+# points xyz are sorted to cells of size r_min and rows are searched in chunks of consecutive cells against points of
+# neighbouring cell layers, each chunk gives complete rows which are stored as int32 indices and float32 data
+# weighted=True - data are weight factors r_min - distance normalized to unit sum in each row, False - pattern only
+# itself=True - the element itself is included among its near elements
+# memory_limit in MB bounds the chunk size and stored rows are spilled to temporary files next to file_name
+# if the estimated matrix size exceeds the half of memory_limit
+# returns the matrix and the order of points used for its rows and columns
+def near_elements_chunked(file_name, xyz, r_min, weighted, itself, memory_limit):
+    if len(xyz) >= 2 ** 31:
+        raise Exception("too many elements for int32 indices of near elements")
+    origin = xyz.min(axis=0) if len(xyz) else np.zeros(3)
+    cell_size = r_min * (1 + 1e-9)
+    dims = np.floor(((xyz.max(axis=0) if len(xyz) else origin) - origin) / cell_size).astype(np.int64) + 3
+    [order, cell_keys, cell_start, cell_count, point_cell, coordinates] = hash_cells(xyz, origin, cell_size, dims)
+    xyz = np.array(coordinates).T
+    point_keys = cell_keys[point_cell]
+    layer_size = dims[1] * dims[2]  # keys of one x layer of cells
+
+    # number of near points estimated from the number of points in the own cell as in a uniform density
+    point_estimate = cell_count[point_cell] * 4 / 3.0 * np.pi
+    estimate = max(0, int(point_estimate.sum()) - len(xyz))
+    entry_bytes = 8 if weighted else 4
+    msg = "\nnear elements within range %s: estimated number %d (%.1f per element), %.0f MB\n" \
+          % (r_min, estimate, estimate / max(1.0, len(xyz)), estimate * entry_bytes / 2.0 ** 20)
+    budget = memory_limit * 2 ** 20
+    spill = estimate * entry_bytes > budget / 2
+    if spill:
+        msg += "near elements exceed the half of filter_memory_limit, they are stored to temporary files\n"
+    print(msg)
+    beso_lib.write_to_log(file_name, msg)
+
+    # chunk rows and candidate pairs are limited by the quarter of memory_limit, about 64 bytes per found pair
+    # and 48 bytes per candidate pair are used during the search
+    chunk_estimate = max(1, budget // 4 // 64)
+    batch_size = max(2 ** 16, budget // 4 // 48)
+    chunk_ends = np.searchsorted(np.cumsum(point_estimate), np.arange(chunk_estimate, point_estimate.sum(),
+                                                                      chunk_estimate))
+    row_counts = []
+    indices_blocks = []
+    data_blocks = []
+    first = 0
+    for end in np.unique(np.append(chunk_ends, len(xyz))).tolist():
+        if end <= first:
+            continue
+        # candidate points in x layers of cells neighbouring to the chunk, within its box extended by r_min
+        c_first = np.searchsorted(point_keys, (point_keys[first] // layer_size - 1) * layer_size)
+        c_end = np.searchsorted(point_keys, (point_keys[end - 1] // layer_size + 2) * layer_size)
+        box_min = xyz[first:end].min(axis=0) - cell_size
+        box_max = xyz[first:end].max(axis=0) + cell_size
+        candidates = np.arange(c_first, c_end)
+        candidates = candidates[((xyz[c_first:c_end] >= box_min) & (xyz[c_first:c_end] <= box_max)).all(axis=1)]
+        [i, j, distance] = near_pairs(xyz[first:end], r_min, xyz[candidates], batch_size)
+        j = candidates[j]
+        if not itself:
+            other = i + first != j
+            [i, j, distance] = [i[other], j[other], distance[other]]
+        sort = np.lexsort((j, i))
+        [i, j, distance] = [i[sort], j[sort], distance[sort]]
+        row_counts.append(np.bincount(i, minlength=end - first))
+        indices_blocks.append(j.astype(np.int32))
+        if weighted:
+            weights = r_min - distance
+            sums = np.bincount(i, weights, minlength=end - first)
+            data_blocks.append((weights / sums[i]).astype(np.float32))
+        first = end
+    indptr = np.concatenate([[0]] + row_counts).cumsum()
+    if spill:
+        directory = os.path.dirname(os.path.abspath(file_name))
+        indices = spilled_array(directory, indices_blocks, np.int32)
+        data = spilled_array(directory, data_blocks, np.float32) if weighted else None
+    else:
+        indices = np.concatenate([np.zeros(0, dtype=np.int32)] + indices_blocks)
+        data = np.concatenate([np.zeros(0, dtype=np.float32)] + data_blocks) if weighted else None
+    return sparse_from_csr(indptr, indices, data, (len(xyz), len(xyz))), order
+
+
+# function detecting points xyz (n, 3) placed in centres of cells of a regular orthogonal grid (voxel-like meshes)
+# returns grid spacing, grid dimensions and flat index of the cell of each point,
+# or None if points are not on a regular grid or the grid would have more than max_fill times more cells than points
+def structured_grid(xyz, tolerance=1e-6, max_fill=8):
+    if len(xyz) < 2:
+        return None
+    origin = xyz.min(axis=0)
+    spacing = np.ones(3)
+    dims = np.ones(3, dtype=np.int64)
+    cells = np.zeros((len(xyz), 3), dtype=np.int64)
+    for k in range(3):
+        coordinate = xyz[:, k] - origin[k]
+        if coordinate.max() <= tolerance * max(1.0, np.abs(xyz).max()):
+            continue  # planar grid
+        steps = np.diff(np.unique(coordinate))
+        spacing[k] = steps[steps > tolerance * coordinate.max()].min()
+        cells[:, k] = np.rint(coordinate / spacing[k])
+        if np.abs(coordinate - cells[:, k] * spacing[k]).max() > tolerance * spacing[k]:
+            return None
+        dims[k] = cells[:, k].max() + 1
+    if np.prod(dims) > max_fill * len(xyz):
+        return None
+    flat_cells = np.ravel_multi_index(cells.T, dims)
+    if len(np.unique(flat_cells)) != len(xyz):
+        return None  # more points in one cell
+    return spacing, dims, flat_cells
+
+
+# function returning the smallest size with factors 2, 3 and 5 only which is not less than n (fast for FFT)
+def fft_size(n):
+    size = n
+    while True:
+        m = size
+        for factor in [2, 3, 5]:
+            while m % factor == 0:
+                m //= factor
+        if m == 1:
+            return size
+        size += 1
+
+
+# filter of element values on a regular grid of element centres computed by FFT convolution with kernel
+# values of filtered elements placed in grid cells (flat indices cells) are convolved with the kernel
+# and divided by the convolution of occupied cells, i.e. normalized by the sum of weights of existing elements
+# it has dot and empty_rows methods as SparseMatrix with weight factors normalized in rows
+class GridConvolution(object):
+    def __init__(self, dims, cells, kernel):
+        self.dims = tuple(int(d) for d in dims)
+        self.cells = cells
+        self.kernel = kernel
+        self.shape = (len(cells), len(cells))
+        self.fft_shape = tuple(fft_size(d + k - 1) for d, k in zip(self.dims, kernel.shape))
+        self.kernel_spectrum = np.fft.rfftn(kernel, self.fft_shape)
+        occupied = np.ones(len(cells))
+        self.weight_sum = self.convolve(occupied, self.kernel_spectrum)
+        support_spectrum = np.fft.rfftn((kernel > 0).astype(float), self.fft_shape)
+        self.near_count = np.rint(self.convolve(occupied, support_spectrum))
+
+    def convolve(self, vector, spectrum):
+        grid = np.zeros(self.dims)
+        grid.flat[self.cells] = vector
+        full = np.fft.irfftn(np.fft.rfftn(grid, self.fft_shape) * spectrum, self.fft_shape)
+        middle = tuple(slice(k // 2, k // 2 + d) for d, k in zip(self.dims, self.kernel.shape))
+        return full[middle].ravel()[self.cells]
+
+    def empty_rows(self):
+        return self.near_count == 0
+
+    def dot(self, vector):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.convolve(vector, self.kernel_spectrum) / self.weight_sum
+
+
+# function returning kernel of weight factors r_min - distance of near cells (without the cell itself)
+# for grid with given spacing and dimensions
+def grid_kernel(spacing, dims, r_min):
+    reach = [int(np.floor(r_min / h)) if d > 1 else 0 for h, d in zip(spacing, dims)]
+    offsets = np.meshgrid(*[np.arange(-n, n + 1) * h for n, h in zip(reach, spacing)], indexing="ij")
+    distance = np.sqrt(offsets[0] ** 2 + offsets[1] ** 2 + offsets[2] ** 2)
+    kernel = np.where(distance < r_min, r_min - distance, 0)
+    kernel[tuple(reach)] = 0
+    return kernel
+
+
+# near elements (or near nodes with given nodes) of elements in opt_domains found once within the largest range r_max
+# pairs are sorted by element and distance, filters with smaller range or fewer domains take a part of them
+# the search is done when the first filter needs it, in cpu_cores processes if possible
+# pairs are sorted by element, distance and near element, so processes give exactly the same result as one process
+class Neighbourhood(object):
+    def __init__(self, cg, r_max, opt_domains, nodes=None, cpu_cores=1):
+        self.elm = np.unique(opt_domains)
+        self.r_max = r_max
+        self.nodes = nodes
+        self.cpu_cores = cpu_cores
+        self.i = None
+
+    def search(self, cg):
+        nodes = self.nodes
+        r_max = self.r_max
+        xyz = np.array([cg[en] for en in self.elm.tolist()]).reshape(-1, 3)
+        pairs = None
+        if self.cpu_cores > 1 and len(xyz):
+            pairs = near_pairs_parallel(xyz, r_max, None if nodes is None else nodes.coordinates, self.cpu_cores)
+        if pairs is not None:
+            [i, j, distance] = pairs
+        elif nodes is None:
+            [i, j, distance] = near_pairs(xyz, r_max)
+            [i, j, distance] = [np.concatenate([i, j]), np.concatenate([j, i]), np.concatenate([distance, distance])]
+        else:
+            [i, j, distance] = near_pairs(xyz, r_max, nodes.coordinates)
+        order = np.lexsort((j, distance, i))
+        self.i = i[order]
+        self.j = j[order]
+        self.distance = distance[order]
+
+    def within(self, cg, r_min, opt_domains):
+        """filtered elements of opt_domains and their pairs (i, j positions, distance) with distance less than r_min"""
+        elm_filtered = np.unique(opt_domains)
+        position = np.searchsorted(self.elm, elm_filtered)
+        if r_min > self.r_max or (position == len(self.elm)).any() or (self.elm[position % len(self.elm)] !=
+                                                                        elm_filtered).any():
+            # not prepared, searching again
+            xyz = np.array([cg[en] for en in elm_filtered.tolist()]).reshape(-1, 3)
+            if self.nodes is None:
+                return [elm_filtered] + list(near_pairs(xyz, r_min))
+            return [elm_filtered] + list(near_pairs(xyz, r_min, self.nodes.coordinates))
+        if self.i is None:
+            self.search(cg)
+        new_position = np.full(len(self.elm), -1)
+        new_position[position] = np.arange(len(elm_filtered))
+        near = (self.distance < r_min) & (new_position[self.i] >= 0)
+        if self.nodes is None:
+            near &= new_position[self.j] >= 0
+            j = new_position[self.j[near]]
+            i = new_position[self.i[near]]
+            i_less = i < j  # each pair once as from near_pairs
+            return elm_filtered, i[i_less], j[i_less], self.distance[near][i_less]
+        return elm_filtered, new_position[self.i[near]], self.j[near], self.distance[near]
+
+
+# function returning cache file name and key of a prepared filter
+# the key is given by the mesh hash, the filter type, the filter range and the filtered elements
+# all morphology filters use the same prepared near elements
+def filter_cache(file_name, mesh_key, filter_type, r_min, opt_domains, memory_limit=0, structured=False):
+    if filter_type not in ["simple", "over nodes", "over points", "topological"]:
+        filter_type = "morphology"
+    if structured and filter_type == "simple":
+        filter_type += " structured"
+    if memory_limit and filter_type in ["simple", "simple structured", "morphology"]:
+        filter_type += " chunked"  # compact arrays in other order
+    filter_hash = hashlib.sha1((mesh_key + " " + filter_type + " " + repr(float(r_min))).encode())
+    filter_hash.update(np.unique(opt_domains).astype(np.int64).tobytes())
+    cache_key = filter_hash.hexdigest()
+    return file_name[:-4] + "_filter_cache_" + cache_key[:16] + ".npz", cache_key
+
+
+# function saving prepared filter (list of sparse matrices and arrays) to the cache file
+# filters with matrices spilled to temporary files are not saved since loading would read them to memory
+# returns True if the filter is saved
+def save_prepared(cache_file, cache_key, prepared):
+    for item in prepared:
+        if isinstance(item, SparseMatrix) and (isinstance(item.indices, np.memmap) or
+                                               isinstance(item.data, np.memmap)):
+            return False
+    arrays = {}
+    for k, item in enumerate(prepared):
+        if isinstance(item, GridConvolution):
+            arrays["%d_grid_dims" % k] = np.array(item.dims)
+            arrays["%d_grid_cells" % k] = item.cells
+            arrays["%d_grid_kernel" % k] = item.kernel
+        elif isinstance(item, SparseMatrix):
+            arrays["%d_shape" % k] = np.array(item.shape)
+            arrays["%d_indptr" % k] = item.indptr
+            arrays["%d_indices" % k] = item.indices
+            if item.data is not None:
+                arrays["%d_data" % k] = item.data
+        else:
+            arrays["%d_array" % k] = np.asarray(item)
+    beso_lib.save_cache(cache_file, cache_key, arrays)
+    return True
+
+
+# function loading prepared filter from the cache file, returns None if there is no valid cache for the key
+def load_prepared(cache_file, cache_key):
+    arrays = beso_lib.load_cache(cache_file, cache_key)
+    if arrays is None:
+        return None
+    prepared = []
+    k = 0
+    while True:
+        if "%d_array" % k in arrays:
+            prepared.append(arrays["%d_array" % k])
+        elif "%d_grid_dims" % k in arrays:
+            prepared.append(GridConvolution(arrays["%d_grid_dims" % k], arrays["%d_grid_cells" % k],
+                                            arrays["%d_grid_kernel" % k]))
+        elif "%d_shape" % k in arrays:
+            prepared.append(sparse_from_csr(arrays["%d_indptr" % k], arrays["%d_indices" % k],
+                                            arrays.get("%d_data" % k), tuple(arrays["%d_shape" % k].tolist())))
+        else:
+            break
+        k += 1
+    return prepared
+
+
+# function computing weight factors for averaging sensitivity numbers from adjacent elements to nodes
+# returns sparse matrix with rows for nodes and columns for positions in Elements.numbers,
+# and the number of adjacent elements of each node
+def node_weight_factors(nodes, Elements, cg):
+    # searching for elements neighbouring to every node
+    node_list = []
+    elm_list = []
+    position = 0
+    for category in Elements.categories:  # element cg computed also out of opt_domains due to neighbours counted also there
+        elm_category = getattr(Elements, category)
+        node_list.append(nodes.rows(elm_category.connectivity).ravel())
+        elm_list.append(np.repeat(np.arange(position, position + len(elm_category)),
+                                  Elements.number_of_nodes[category]))
+        position += len(elm_category)
+    node_elm = np.unique(np.concatenate(node_list) * len(Elements) + np.concatenate(elm_list))  # without duplicates
+    [node_row, elm_position] = divmod(node_elm, len(Elements))
+
+    # computing weight factors for sensitivity number of nodes according to distance to adjacent elements
+    elm_xyz = np.array([cg[en] for en in Elements.numbers.tolist()]).reshape(-1, 3)
+    distance = np.sqrt(((elm_xyz[elm_position] - nodes.coordinates[node_row]) ** 2).sum(axis=1))
+    adjacent_count = np.bincount(node_row, minlength=len(nodes))  # number of elements adjacent to each node
+    distance_sum = np.bincount(node_row, distance, minlength=len(nodes))
+    m = adjacent_count[node_row]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight = np.where(m != 1, 1 / (m - 1.0) * (1 - distance / distance_sum[node_row]), 1.0)
+    weight_factor_node = SparseMatrix(node_row, elm_position, weight, (len(nodes), len(Elements)))
+    return weight_factor_node, adjacent_count
+
+
+# function computing weight factors r_min - distance for averaging from near nodes to elements
+# pairs i (element rows), j (node rows) with their distance are given, nodes without adjacent elements are skipped
+def distance_weight_factors(i, j, distance, r_min, adjacent_count, shape):
+    adjacent = adjacent_count[j] > 0  # nodes without adjacent elements have no sensitivity number
+    weight_factor_distance = SparseMatrix(i[adjacent], j[adjacent], r_min - distance[adjacent], shape)
+    weight_factor_distance.normalize_rows()
+    return weight_factor_distance
+
+
+# function preparing values for filtering element sensitivity numbers to suppress checkerboard
+# reference version of prepare1s, near nodes of elements are searched by
+# search="cells" - integer cell hashing as in prepare1s
+# search="brute force" - computing distance of every element to every node, very slow for large meshes
+# with check_sample > 0, near nodes of randomly chosen check_sample elements are searched by both methods
+# and compared, the result is printed and written to the log file
+def prepare1(nodes, Elements, cg, r_min, opt_domains, search="cells", check_sample=0, file_name=None):
+    [weight_factor_node, adjacent_count] = node_weight_factors(nodes, Elements, cg)
     # print ("weight_factor_node have been computed")
-    # computing weight factors for distance of each element and node nearer than r_min
-    weight_factor_distance = {}
-    near_nodes = {}
-    for en in opt_domains:
-        near_nodes[en] = []
-        down_x = cg[en][0] - r_min
-        down_y = cg[en][1] - r_min
-        down_z = cg[en][2] - r_min
-        up_x = cg[en][0] + r_min
-        up_y = cg[en][1] + r_min
-        up_z = cg[en][2] + r_min
-        for nn in nodes:
-            condition_x = down_x < nodes[nn][0] < up_x
-            condition_y = down_y < nodes[nn][1] < up_y
-            condition_z = down_z < nodes[nn][2] < up_z
-            if condition_x and condition_y and condition_z:  # prevents computing distance >> r_min
-                dx = cg[en][0] - nodes[nn][0]
-                dy = cg[en][1] - nodes[nn][1]
-                dz = cg[en][2] - nodes[nn][2]
-                distance = (dx ** 2 + dy ** 2 + dz ** 2) ** 0.5
-                if distance < r_min:
-                    weight_factor_distance[(en, nn)] = r_min - distance
-                    near_nodes[en].append(nn)
+    elm_filtered = np.unique(opt_domains)
+    xyz = np.array([cg[en] for en in elm_filtered.tolist()]).reshape(-1, 3)
+    if search == "brute force":
+        [i, j, distance] = near_pairs_brute_force(xyz, nodes.coordinates, r_min)
+    else:
+        [i, j, distance] = near_pairs(xyz, r_min, nodes.coordinates)
+    weight_factor_distance = distance_weight_factors(i, j, distance, r_min, adjacent_count,
+                                                     (len(elm_filtered), len(nodes)))
     # print ("weight_factor_distance have been computed")
-    return weight_factor_node, M, weight_factor_distance, near_nodes
+
+    if check_sample > 0:
+        sample = np.random.RandomState(0).choice(len(xyz), min(check_sample, len(xyz)), replace=False)
+        [i_bf, j_bf, distance_bf] = near_pairs_brute_force(xyz[sample], nodes.coordinates, r_min)
+        [i_c, j_c, distance_c] = near_pairs(xyz[sample], r_min, nodes.coordinates)
+        pairs_bf = sorted(zip(elm_filtered[sample][i_bf].tolist(), j_bf.tolist(), distance_bf.tolist()))
+        pairs_c = sorted(zip(elm_filtered[sample][i_c].tolist(), j_c.tolist(), distance_c.tolist()))
+        if pairs_bf == pairs_c:
+            msg = "\nINFO: near nodes of %d elements found by cells and by brute force are the same\n" % len(sample)
+        else:
+            en_different = sorted(set(pairs_bf).symmetric_difference(pairs_c))[0][0]
+            msg = "\nERROR: near nodes found by cells and by brute force differ, e.g. for element %d\n" % en_different
+        print(msg)
+        if file_name:
+            beso_lib.write_to_log(file_name, msg)
+    return weight_factor_node, weight_factor_distance, elm_filtered
 
 
 # function preparing values for filtering element sensitivity numbers to suppress checkerboard
-# uses sectoring to prevent computing distance of far points
-def prepare1s(nodes, Elements, cg, r_min, opt_domains):
-    # searching for elements neighbouring to every node
-    node_neighbours = {}
-
-    def fce():
-        if nn not in node_neighbours:
-            node_neighbours[nn] = [en]
-        elif en not in node_neighbours[nn]:
-            node_neighbours[nn].append(en)
-
-    for en in Elements.tria3:  # element cg computed also out of opt_domains due to neighbours counted also there
-        for nn in Elements.tria3[en]:
-            fce()
-    for en in Elements.tria6:
-        for nn in Elements.tria6[en]:
-            fce()
-    for en in Elements.quad4:
-        for nn in Elements.quad4[en]:
-            fce()
-    for en in Elements.quad8:
-        for nn in Elements.quad8[en]:
-            fce()
-    for en in Elements.tetra4:
-        for nn in Elements.tetra4[en]:
-            fce()
-    for en in Elements.tetra10:
-        for nn in Elements.tetra10[en]:
-            fce()
-    for en in Elements.hexa8:
-        for nn in Elements.hexa8[en]:
-            fce()
-    for en in Elements.hexa20:
-        for nn in Elements.hexa20[en]:
-            fce()
-    for en in Elements.penta6:
-        for nn in Elements.penta6[en]:
-            fce()
-    for en in Elements.penta15:
-        for nn in Elements.penta15[en]:
-            fce()
-    # computing weight factors for sensitivity number of nodes according to distance to adjacent elements
-    M = {}  # element numbers en adjacent to each node nn
-    weight_factor_node = {}
-    for nn in node_neighbours:
-        distance_sum = 0
-        M[nn] = []
-        distance = []
-        for en in node_neighbours[nn]:
-            dx = cg[en][0] - nodes[nn][0]
-            dy = cg[en][1] - nodes[nn][1]
-            dz = cg[en][2] - nodes[nn][2]
-            distance.append((dx ** 2 + dy ** 2 + dz ** 2) ** 0.5)
-            distance_sum += distance[-1]
-            M[nn].append(en)
-        weight_factor_node[nn] = {}
-        en_relative = 0
-        for en in node_neighbours[nn]:
-            if len(M[nn]) != 1:
-                weight_factor_node[nn][en] = 1 / (len(M[nn]) - 1.0) * (1 - distance[en_relative] / distance_sum)
-            else:
-                weight_factor_node[nn][en] = 1.0
-            en_relative += 1
+# uses integer cell hashing to prevent computing distance of far points
+# returns sparse matrices of weight factors for averaging sensitivity numbers from adjacent elements to nodes
+# (rows are nodes, columns are positions in Elements.numbers) and for averaging from near nodes back to elements
+# (rows belong to elm_filtered, weight factors r_min - distance normalized to unit sum in each row)
+# near nodes can be taken from the neighbourhood prepared for more filters
+def prepare1s(nodes, Elements, cg, r_min, opt_domains, neighbourhood=None):
+    [weight_factor_node, adjacent_count] = node_weight_factors(nodes, Elements, cg)
     # print ("weight_factor_node have been computed")
+
     # computing weight factors for distance of each element and node nearer than r_min
-    weight_factor_distance = {}
-    near_nodes = {}
-    sector_nodes = {}
-    sector_elm = {}
-    nodes_min = nodes[list(nodes.keys())[0]]  # initial values
-    nodes_max = nodes[list(nodes.keys())[0]]
-    for nn in nodes:
-        nodes_min = [min(nodes[nn][0], nodes_min[0]), min(nodes[nn][1], nodes_min[1]), min(nodes[nn][2], nodes_min[2])]
-        nodes_max = [max(nodes[nn][0], nodes_max[0]), max(nodes[nn][1], nodes_max[1]), max(nodes[nn][2], nodes_max[2])]
-    # preparing empty sectors
-    x = nodes_min[0] + 0.5 * r_min
-    while x <= nodes_max[0] + 0.5 * r_min:
-        y = nodes_min[1] + 0.5 * r_min
-        while y <= nodes_max[1] + 0.5 * r_min:
-            z = nodes_min[2] + 0.5 * r_min
-            while z <= nodes_max[2] + 0.5 * r_min:
-                # 6 significant digit round because of small declination (6 must be used for all sround)
-                sector_nodes[(sround(x, 6), sround(y, 6), sround(z, 6))] = []
-                sector_elm[(sround(x, 6), sround(y, 6), sround(z, 6))] = []
-                z += r_min
-            y += r_min
-        x += r_min
-    # assigning nodes to the sectors
-    for nn in nodes:
-        sector_centre = []
-        for k in range(3):
-            position = nodes_min[k] + r_min * (0.5 + np.floor((nodes[nn][k] - nodes_min[k]) / r_min))
-            sector_centre.append(sround(position, 6))
-        sector_nodes[tuple(sector_centre)].append(nn)
-    # assigning elements to the sectors
-    for en in opt_domains:
-        sector_centre = []
-        for k in range(3):
-            position = nodes_min[k] + r_min * (0.5 + np.floor((cg[en][k] - nodes_min[k]) / r_min))
-            sector_centre.append(sround(position, 6))
-        sector_elm[tuple(sector_centre)].append(en)
-        near_nodes[en] = []
-    # finding near nodes in neighbouring sectors (even inside) by comparing distance with neighbouring sector elements
-    x = nodes_min[0] + 0.5 * r_min
-    while x <= nodes_max[0] + 0.5 * r_min:
-        y = nodes_min[1] + 0.5 * r_min
-        while y <= nodes_max[1] + 0.5 * r_min:
-            z = nodes_min[2] + 0.5 * r_min
-            while z <= nodes_max[2] + 0.5 * r_min:
-                position = (sround(x, 6), sround(y, 6), sround(z, 6))
-                for xx in [x + r_min, x, x - r_min]:
-                    for yy in [y + r_min, y, y - r_min]:
-                        for zz in [z + r_min, z, z - r_min]:
-                            position_neighbour = (sround(xx, 6), sround(yy, 6), sround(zz, 6))
-                            for en in sector_elm[position]:
-                                try:
-                                    for nn in sector_nodes[position_neighbour]:
-                                        dx = cg[en][0] - nodes[nn][0]
-                                        dy = cg[en][1] - nodes[nn][1]
-                                        dz = cg[en][2] - nodes[nn][2]
-                                        distance = (dx ** 2 + dy ** 2 + dz ** 2) ** 0.5
-                                        if distance < r_min:
-                                            weight_factor_distance[(en, nn)] = r_min - distance
-                                            near_nodes[en].append(nn)
-                                except KeyError:
-                                    pass
-                z += r_min
-            y += r_min
-        x += r_min
+    if neighbourhood is None:
+        neighbourhood = Neighbourhood(cg, r_min, opt_domains, nodes)
+    [elm_filtered, i, j, distance] = neighbourhood.within(cg, r_min, opt_domains)
+    weight_factor_distance = distance_weight_factors(i, j, distance, r_min, adjacent_count,
+                                                     (len(elm_filtered), len(nodes)))
     # print ("weight_factor_distance have been computed")
-    return weight_factor_node, M, weight_factor_distance, near_nodes
+    return weight_factor_node, weight_factor_distance, elm_filtered
 
 
 # function to filter sensitivity number to suppress checkerboard
-def run1(file_name, sensitivity_number, weight_factor_node, M, weight_factor_distance, near_nodes, nodes, opt_domains):
-    sensitivity_number_node = {}  # hypothetical sensitivity number of each node
-    for nn in nodes:
-        if nn in M:
-            sensitivity_number_node[nn] = 0
-            for en in M[nn]:
-                sensitivity_number_node[nn] += weight_factor_node[nn][en] * sensitivity_number[en]
+def run1(file_name, sensitivity_number, weight_factor_node, weight_factor_distance, elm_filtered, Elements):
+    if weight_factor_distance.empty_rows().any():
+        msg = "\nERROR: filter over nodes failed due to division by 0." \
+              "Some element CG has not a node in distance <= r_min.\n"
+        print(msg)
+        beso_lib.write_to_log(file_name, msg)
+        return sensitivity_number
+    sensitivity_array = np.array([sensitivity_number[en] for en in Elements.numbers.tolist()])
+    sensitivity_number_node = weight_factor_node.dot(sensitivity_array)  # hypothetical sensitivity number of nodes
     sensitivity_number_filtered = sensitivity_number.copy()  # sensitivity number of each element after filtering
-    for en in opt_domains:
-        numerator = 0
-        denominator = 0
-        for nn in near_nodes[en]:
-            try:
-                numerator += weight_factor_distance[(en, nn)] * sensitivity_number_node[nn]
-                denominator += weight_factor_distance[(en, nn)]
-            except KeyError:
-                pass
-        if denominator != 0:
-            sensitivity_number_filtered[en] = numerator / denominator
-        else:
-            msg = "\nERROR: filter over nodes failed due to division by 0." \
-                  "Some element CG has not a node in distance <= r_min.\n"
-            print(msg)
-            beso_lib.write_to_log(file_name, msg)
-            filter_on_sensitivity = 0
-            return sensitivity_number
+    sensitivity_number_filtered.update(zip(elm_filtered.tolist(),
+                                           weight_factor_distance.dot(sensitivity_number_node).tolist()))
     return sensitivity_number_filtered
 
 
 # function preparing values for filtering element rho to suppress checkerboard
-# uses sectoring to prevent computing distance of far points
-def prepare2s(cg, cg_min, cg_max, r_min, opt_domains, weight_factor2, near_elm):
-    sector_elm = {}
-    # preparing empty sectors
-    x = cg_min[0] + 0.5 * r_min
-    while x <= cg_max[0] + 0.5 * r_min:
-        y = cg_min[1] + 0.5 * r_min
-        while y <= cg_max[1] + 0.5 * r_min:
-            z = cg_min[2] + 0.5 * r_min
-            while z <= cg_max[2] + 0.5 * r_min:
-                # 6 significant digit round because of small declination (6 must be used for all sround below)
-                sector_elm[(sround(x, 6), sround(y, 6), sround(z, 6))] = []
-                z += r_min
-            y += r_min
-        x += r_min
-    # assigning elements to the sectors
-    for en in opt_domains:
-        sector_centre = []
-        for k in range(3):
-            position = cg_min[k] + r_min * (0.5 + np.floor((cg[en][k] - cg_min[k]) / r_min))
-            sector_centre.append(sround(position, 6))
-        sector_elm[tuple(sector_centre)].append(en)
-    # finding near elements inside each sector
-    for sector_centre in sector_elm:
-        for en in sector_elm[sector_centre]:
-            near_elm[en] = []
-        for en in sector_elm[sector_centre]:
-            for en2 in sector_elm[sector_centre]:
-                if en == en2:
-                    continue
-                ee = (min(en, en2), max(en, en2))
-                try:
-                    weight_factor2[ee]
-                except KeyError:
-                    dx = cg[en][0] - cg[en2][0]
-                    dy = cg[en][1] - cg[en2][1]
-                    dz = cg[en][2] - cg[en2][2]
-                    distance = (dx ** 2 + dy ** 2 + dz ** 2) ** 0.5
-                    if distance < r_min:
-                        weight_factor2[ee] = r_min - distance
-                        near_elm[en].append(en2)
-                        near_elm[en2].append(en)
-    # finding near elements in neighbouring sectors by comparing distance with neighbouring sector elements
-    x = cg_min[0] + 0.5 * r_min
-    while x <= cg_max[0] + 0.5 * r_min:
-        y = cg_min[1] + 0.5 * r_min
-        while y <= cg_max[1] + 0.5 * r_min:
-            z = cg_min[2] + 0.5 * r_min
-            while z <= cg_max[2] + 0.5 * r_min:
-                position = (sround(x, 6), sround(y, 6), sround(z, 6))
-                # down level neighbouring sectors:
-                # o  o  -
-                # o  -  -
-                # o  -  -
-                # middle level neighbouring sectors:
-                # o  o  -
-                # o self -
-                # o  -  -
-                # upper level neighbouring sectors:
-                # o  o  -
-                # o  o  -
-                # o  -  -
-                for position_neighbour in [(x + r_min, y - r_min, z - r_min),
-                                           (x + r_min, y, z - r_min),
-                                           (x + r_min, y + r_min, z - r_min),
-                                           (x, y + r_min, z - r_min),
-                                           (x + r_min, y - r_min, z),
-                                           (x + r_min, y, z),
-                                           (x + r_min, y + r_min, z),
-                                           (x, y + r_min, z),
-                                           (x + r_min, y - r_min, z + r_min),
-                                           (x + r_min, y, z + r_min),
-                                           (x + r_min, y + r_min, z + r_min),
-                                           (x, y + r_min, z + r_min),
-                                           (x, y, z + r_min)]:
-                    position_neighbour = (sround(position_neighbour[0], 6), sround(position_neighbour[1], 6),
-                                          sround(position_neighbour[2], 6))
-                    for en in sector_elm[position]:
-                        try:
-                            for en2 in sector_elm[position_neighbour]:
-                                dx = cg[en][0] - cg[en2][0]
-                                dy = cg[en][1] - cg[en2][1]
-                                dz = cg[en][2] - cg[en2][2]
-                                distance = (dx ** 2 + dy ** 2 + dz ** 2) ** 0.5
-                                if distance < r_min:
-                                    ee = (min(en, en2), max(en, en2))
-                                    weight_factor2[ee] = r_min - distance
-                                    near_elm[en].append(en2)
-                                    near_elm[en2].append(en)
-                        except KeyError:
-                            pass
-                z += r_min
-            y += r_min
-        x += r_min
+# uses integer cell hashing to prevent computing distance of far points
+# returns sparse matrix of weight factors (r_min - distance) of near elements normalized to unit sum in each row,
+# rows and columns belong to elements in elm_filtered, near elements can be taken from the neighbourhood prepared
+# for more filters, with memory_limit in MB near elements are searched in chunks (see near_elements_chunked)
+# with structured=True and elements on a regular grid, returns GridConvolution instead of the sparse matrix
+def prepare2s(cg, r_min, opt_domains, neighbourhood=None, memory_limit=0, file_name=None, structured=False):
+    if structured:
+        elm_filtered = np.unique(opt_domains)
+        xyz = np.array([cg[en] for en in elm_filtered.tolist()]).reshape(-1, 3)
+        grid = structured_grid(xyz)
+        if grid is not None:
+            [spacing, dims, cells] = grid
+            msg = "\nINFO: simple filter with range %s computed by FFT convolution on regular grid %d x %d x %d\n" \
+                  % (r_min, dims[0], dims[1], dims[2])
+            beso_lib.write_to_log(file_name, msg)
+            return GridConvolution(dims, cells, grid_kernel(spacing, dims, r_min)), elm_filtered
+    if memory_limit:
+        elm_filtered = np.unique(opt_domains)
+        xyz = np.array([cg[en] for en in elm_filtered.tolist()]).reshape(-1, 3)
+        [weight_factor2, order] = near_elements_chunked(file_name, xyz, r_min, True, False, memory_limit)
+        return weight_factor2, elm_filtered[order]
+    if neighbourhood is None:
+        neighbourhood = Neighbourhood(cg, r_min, opt_domains)
+    [elm_filtered, i, j, distance] = neighbourhood.within(cg, r_min, opt_domains)
+    weight_factor2 = SparseMatrix(np.concatenate([i, j]), np.concatenate([j, i]),
+                                  np.concatenate([r_min - distance, r_min - distance]),
+                                  (len(elm_filtered), len(elm_filtered)))
+    weight_factor2.normalize_rows()
     # print ("near elements have been associated, weight factors computed")
-    return weight_factor2, near_elm
+    return weight_factor2, elm_filtered
 
 
 # function to filter sensitivity number to suppress checkerboard
 # simplified version: makes weighted average of sensitivity numbers from near elements
-def run2(file_name, sensitivity_number, weight_factor2, near_elm, opt_domains):
+def run2(file_name, sensitivity_number, weight_factor2, elm_filtered):
+    if weight_factor2.empty_rows().any():
+        msg = "\nERROR: simple filter failed due to division by 0." \
+              "Some element has not a near element in distance <= r_min.\n"
+        print(msg)
+        beso_lib.write_to_log(file_name, msg)
+        return sensitivity_number
+    elm_filtered = elm_filtered.tolist()
+    sensitivity_array = np.array([sensitivity_number[en] for en in elm_filtered])
     sensitivity_number_filtered = sensitivity_number.copy()  # sensitivity number of each element after filtering
-    for en in opt_domains:
-        numerator = 0
-        denominator = 0
-        for en2 in near_elm[en]:
-            ee = (min(en, en2), max(en, en2))
-            numerator += weight_factor2[ee] * sensitivity_number[en2]
-            denominator += weight_factor2[ee]
-        if denominator != 0:
-            sensitivity_number_filtered[en] = numerator / denominator
-        else:
-            msg = "\nERROR: simple filter failed due to division by 0." \
-                  "Some element has not a near element in distance <= r_min.\n"
-            print(msg)
-            beso_lib.write_to_log(file_name, msg)
-            filter_on_sensitivity = 0
-            return sensitivity_number
+    sensitivity_number_filtered.update(zip(elm_filtered, weight_factor2.dot(sensitivity_array).tolist()))
     return sensitivity_number_filtered
 
 
+# function returning sorted unique values of integer array by sorting, faster than np.unique for long arrays
+def unique_keys(keys):
+    keys = np.sort(keys)
+    return keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys
+
+
+# function computing pattern of adjacent elements (sharing a node) among elements of elm_filtered
+# elements of each node are found from the inverted index of nodes to elements, pairs of elements of one node are
+# generated in batches of about batch_size pairs, rows and columns belong to elm_filtered, without the element itself
+def element_adjacency(nodes, Elements, elm_filtered, batch_size=2 ** 22):
+    elm_rows = Elements.rows(elm_filtered)
+    filtered_position = np.full(len(Elements), -1)
+    filtered_position[elm_rows[elm_rows >= 0]] = np.arange(len(elm_filtered))[elm_rows >= 0]
+    node_list = [np.zeros(0, dtype=np.int64)]
+    elm_list = [np.zeros(0, dtype=np.int64)]
+    position = 0
+    for category in Elements.categories:
+        elm_category = getattr(Elements, category)
+        node_list.append(nodes.rows(elm_category.connectivity).ravel())
+        elm_list.append(np.repeat(filtered_position[position:position + len(elm_category)],
+                                  Elements.number_of_nodes[category]))
+        position += len(elm_category)
+    node_row = np.concatenate(node_list)
+    elm_position = np.concatenate(elm_list)
+    filtered = (elm_position >= 0) & (node_row >= 0)
+    order = np.argsort(node_row[filtered], kind="stable")
+    node_elm = elm_position[filtered][order]  # inverted index, elements of nodes in the node order
+    [_, start, count] = np.unique(node_row[filtered][order], return_index=True, return_counts=True)
+
+    n = len(elm_filtered)
+    keys_list = [np.zeros(0, dtype=np.int64)]
+    pair_end = np.cumsum(count ** 2)
+    first = 0
+    while first < len(count):
+        last = np.searchsorted(pair_end, pair_end[first] - count[first] ** 2 + batch_size, side="right")
+        last = max(last, first + 1)
+        incidence = np.arange(start[first], start[last - 1] + count[last - 1])
+        partners = np.repeat(count[first:last], count[first:last])  # number of elements of the node of incidence
+        partner_start = np.repeat(start[first:last], count[first:last])
+        i = np.repeat(node_elm[incidence], partners)
+        j = node_elm[np.arange(partners.sum()) + np.repeat(partner_start - np.cumsum(partners) + partners, partners)]
+        keys_list.append(unique_keys(i[i != j] * n + j[i != j]))
+        first = last
+    [i, j] = divmod(unique_keys(np.concatenate(keys_list)), n)
+    return SparseMatrix(i, j, None, (n, n))
+
+
+# function returning pairs of elements (positions i from rows, j) within given number of rings of adjacent elements
+# and their ring, i.e. number of steps over adjacent elements, the element itself is in ring 0, pairs are sorted by i, j
+def element_rings(adjacency, rings, rows):
+    n = adjacency.shape[0]
+    reached = rows * (n + 1)  # sorted keys i * n + j
+    keys_list = [reached]
+    ring_list = [np.zeros(len(rows), dtype=np.int64)]
+    [frontier_i, frontier_j] = [rows, rows]
+    for ring in range(1, rings + 1):
+        count = np.diff(adjacency.indptr)[frontier_j]
+        i = np.repeat(frontier_i, count)
+        j = adjacency.indices[np.arange(count.sum()) +
+                              np.repeat(adjacency.indptr[frontier_j] - np.cumsum(count) + count, count)]
+        keys = unique_keys(i * n + j)
+        keys = keys[~np.isin(keys, reached, assume_unique=True)]
+        reached = np.sort(np.concatenate([reached, keys]))
+        keys_list.append(keys)
+        ring_list.append(np.full(len(keys), ring))
+        [frontier_i, frontier_j] = divmod(keys, n)
+    keys = np.concatenate(keys_list)
+    order = np.argsort(keys)
+    [i, j] = divmod(keys[order], n)
+    return i, j, np.concatenate(ring_list)[order]
+
+
+# function preparing values for filtering element sensitivity numbers over topological neighbourhood
+# near elements are those within given number of rings of elements sharing a node, no radius is used,
+# thus the neighbourhood follows element size on graded meshes
+# rings are searched for blocks of elements with about batch_size candidate pairs
+# returns sparse matrix of weight factors (rings + 1 - ring) normalized to unit sum in each row (filtered by run2),
+# rows and columns belong to elements in elm_filtered
+def prepare_topological(file_name, nodes, Elements, rings, opt_domains, batch_size=2 ** 22):
+    rings = int(rings)
+    elm_filtered = np.unique(opt_domains)
+    n = len(elm_filtered)
+    adjacency = element_adjacency(nodes, Elements, elm_filtered)
+    degree = max(1.0, adjacency.indptr[-1] / max(1.0, n))
+    block = max(1, int(batch_size // degree ** rings))
+    count_list = [np.zeros(1, dtype=np.int64)]
+    indices_list = [np.zeros(0, dtype=np.int64)]
+    data_list = [np.zeros(0)]
+    for first in range(0, n, block):
+        rows = np.arange(first, min(first + block, n))
+        [i, j, ring] = element_rings(adjacency, rings, rows)
+        weights = rings + 1.0 - ring
+        sums = np.bincount(i - first, weights, minlength=len(rows))
+        count_list.append(np.bincount(i - first, minlength=len(rows)))
+        indices_list.append(j)
+        data_list.append(weights / sums[i - first])
+    weight_factor = sparse_from_csr(np.concatenate(count_list).cumsum(), np.concatenate(indices_list),
+                                    np.concatenate(data_list), (n, n))
+
+    near_count = np.diff(weight_factor.indptr)
+    if len(near_count):
+        msg = "\ntopological filter statistics (%d rings):\n" % rings
+        msg += "number of near elements including the element itself: minimum %d, mean %.1f, maximum %d\n" \
+               % (near_count.min(), near_count.mean(), near_count.max())
+        beso_lib.write_to_log(file_name, msg)
+    return weight_factor, elm_filtered
+
+
 # function preparing values for filtering element sensitivity number using own point mesh
 # currently set to work only with elements in opt_domains
 # does not work?!
@@ -483,230 +915,126 @@ def prepare3_ortho_grid(file_name, cg, cg_min, r_min, opt_domains):
     return weight_factor3, near_elm, near_points
 
 
+# points of one cell of the tetrahedral point mesh as multiples of tetrahedral edge, triangle high and tetrahedron high
+tetra_grid_cell_points = [[0, 0, 0], [0.5, 1, 0], [0.5, 1 / 3.0, 1], [0, 4 / 3.0, 1]]
+
+
 # function preparing values for filtering element sensitivity number using own point mesh of tetrahedrons
 # currently set to work only with elements in opt_domains
-def prepare3_tetra_grid(file_name, cg, r_min, opt_domains):
-    weight_factor3 = {}
-    near_points = {}
-    near_elm = {}
+# grid points are identified by integer cell indices and their position in the cell, candidate points of 27 cells
+# around each element are generated as arrays for chunks of chunk_size elements
+# returns weight factors (r_min - distance) as sparse matrices normalized for averaging from elements to points
+# and from points back to elements, element rows and columns belong to elm_filtered
+def prepare3_tetra_grid(file_name, cg, r_min, opt_domains, chunk_size=2 ** 15):
     grid = 1.0 * r_min  # ranges of xyz cycles should be set according to preset coefficient
+    # grid is the length of tetrahedral edge, which is also cell x size
+    # v = grid * np.sqrt(3) / 2 is the high of triangle, which is the half of cell y size
+    v = grid * 0.8660
+    # h = grid * np.sqrt(2 / 3.0)  is the high of tetrahedron, which is the half of cell z size
+    h = grid * 0.8165
+    cell_size = np.array([grid, 2 * v, 2 * h])
+    cell_points = np.array(tetra_grid_cell_points) * [grid, v, h]
+    cell_offsets = np.array([[dx, dy, dz] for dx in [-1, 0, 1] for dy in [-1, 0, 1] for dz in [-1, 0, 1]])
 
-    # searching for near points of each element
-    for en in opt_domains:  # domain to take elements for filtering
-        x_elm, y_elm, z_elm = cg[en]
+    elm_filtered = np.unique(opt_domains)
+    xyz = np.array([cg[en] for en in elm_filtered.tolist()]).reshape(-1, 3)
+    cells = np.floor(xyz / cell_size).astype(np.int64)
+    cell_min = cells.min(axis=0) - 1 if len(cells) else np.zeros(3, dtype=np.int64)
+    dims = cells.max(axis=0) - cell_min + 2 if len(cells) else np.ones(3, dtype=np.int64)
 
-        # set starting point of the cell
-        # grid is the length of tetrahedral edge, which is also cell x size
-        x_en_cell = x_elm - x_elm % grid
-        # v = grid * np.sqrt(3) / 2 is the high of triangle, which is the half of cell y size
-        v = grid * 0.8660
-        y_en_cell = y_elm - y_elm % (2 * v)
-        # h = grid * np.sqrt(2 / 3.0)  is the high of tetrahedron, which is the half of cell z size
-        h = grid * 0.8165
-        z_en_cell = z_elm - z_elm % (2 * h)
-
-        near_points[en] = []
-        # comparing distance in cells around element en
-        for x_cell in [x_en_cell - grid, x_en_cell, x_en_cell + grid]:
-            for y_cell in [y_en_cell - 2 * v, y_en_cell, y_en_cell + 2 * v]:
-                for z_cell in [z_en_cell - 2 * h, z_en_cell, z_en_cell + 2 * h]:
-                    for [x, y, z] in [[x_cell, y_cell, z_cell],
-                                               [x_cell + grid / 2.0, y_cell + v, z_cell],
-                                               [x_cell + grid / 2.0, y_cell + v / 3.0, z_cell + h],
-                                               [x_cell, y_cell + 4 / 3.0 * v, z_cell + h]]:  # grid point coordinates
-                        distance = ((x_elm - x) ** 2 + (y_elm - y) ** 2 + (z_elm - z) ** 2) ** 0.5
-                        if distance < r_min:
-                            weight_factor3[(en, (x, y, z))] = r_min - distance
-                            near_points[en].append((x, y, z))
-                            try:
-                                near_elm[(x, y, z)].append(en)
-                            except KeyError:
-                                near_elm[(x, y, z)] = [en]
+    # searching for near points of each element
+    elm_list = [np.zeros(0, dtype=np.int64)]
+    point_key_list = [np.zeros(0, dtype=np.int64)]
+    weight_list = [np.zeros(0)]
+    for first in range(0, len(xyz), chunk_size):
+        near_cells = cells[first:first + chunk_size, None, :] + cell_offsets  # (elements, 27, 3)
+        points = (near_cells * cell_size)[:, :, None, :] + cell_points  # (elements, 27, 4, 3)
+        distance = np.sqrt(((xyz[first:first + chunk_size, None, None, :] - points) ** 2).sum(axis=3))
+        [en_position, cell, point] = np.nonzero(distance < r_min)
+        near_cell = near_cells[en_position, cell] - cell_min
+        elm_list.append(en_position + first)
+        point_key_list.append(((near_cell[:, 0] * dims[1] + near_cell[:, 1]) * dims[2] + near_cell[:, 2]) * 4 +
+                              point)
+        weight_list.append(r_min - distance[en_position, cell, point])
+    elm_position = np.concatenate(elm_list)
+    [point_keys, point_position] = np.unique(np.concatenate(point_key_list), return_inverse=True)
+    weights = np.concatenate(weight_list)
+    weight_factor3_points = SparseMatrix(point_position, elm_position, weights, (len(point_keys), len(xyz)))
+    weight_factor3_points.normalize_rows()
+    weight_factor3_elm = SparseMatrix(elm_position, point_position, weights, (len(xyz), len(point_keys)))
+    weight_factor3_elm.normalize_rows()
 
     # summarize histogram of near elements
-    hist_near_points = list(np.zeros(10))
-    for en in near_points:
-        if isinstance(near_points[en], int):
-            le = 1
-        else:
-            le = len(near_points[en])
-        if le >= len(hist_near_points):
-            while len(hist_near_points) <= le:
-                hist_near_points.append(0)
-        hist_near_points[le] += 1
+    hist_near_points = np.bincount(np.diff(weight_factor3_elm.indptr), minlength=10).tolist()
     msg = "\nfilter over points statistics:\n"
     msg += "histogram - number of near points (list index) vs. number of elements (value)\n"
     msg += str(hist_near_points) + "\n"
     beso_lib.write_to_log(file_name, msg)
-    return weight_factor3, near_elm, near_points
+    return weight_factor3_points, weight_factor3_elm, elm_filtered
 
 
 # function for filtering element sensitivity number using own point mesh
 # currently works only with elements in opt_domains
-def run3(sensitivity_number, weight_factor3, near_elm, near_points):
+def run3(sensitivity_number, weight_factor3_points, weight_factor3_elm, elm_filtered):
+    elm_filtered = elm_filtered.tolist()
+    sensitivity_array = np.array([sensitivity_number[en] for en in elm_filtered])
+    # weighted averaging of sensitivity number from elements to points and from points back to elements
+    sensitivity_array = weight_factor3_elm.dot(weight_factor3_points.dot(sensitivity_array))
     sensitivity_number_filtered = sensitivity_number.copy()  # sensitivity number of each element after filtering
-    point_sensitivity = {}
-
-    # weighted averaging of sensitivity number from elements to points
-    for pn in near_elm:
-        numerator = 0
-        denominator = 0
-        for en in near_elm[pn]:
-            numerator += weight_factor3[(en, pn)] * sensitivity_number[en]
-            denominator += weight_factor3[(en, pn)]
-        point_sensitivity[pn] = numerator / denominator
-
-    # weighted averaging of sensitivity number from points back to elements
-    for en in near_points:
-        numerator = 0
-        denominator = 0
-        for pn in near_points[en]:
-            numerator += weight_factor3[(en, pn)] * point_sensitivity[pn]
-            denominator += weight_factor3[(en, pn)]
-        sensitivity_number_filtered[en] = numerator / denominator
-
+    sensitivity_number_filtered.update(zip(elm_filtered, sensitivity_array.tolist()))
     return sensitivity_number_filtered
 
 
 # function preparing values for morphology based filtering
 # it is a copy of filter_prepare2s without saving distance of near elements
-# uses sectoring to prevent computing distance of far points
-def prepare_morphology(cg, cg_min, cg_max, r_min, opt_domains, near_elm):
-    sector_elm = {}
-    # preparing empty sectors
-    x = cg_min[0] + 0.5 * r_min
-    while x <= cg_max[0] + 0.5 * r_min:
-        y = cg_min[1] + 0.5 * r_min
-        while y <= cg_max[1] + 0.5 * r_min:
-            z = cg_min[2] + 0.5 * r_min
-            while z <= cg_max[2] + 0.5 * r_min:
-                # 6 significant digit round because of small declination (6 must be used for all sround below)
-                sector_elm[(sround(x, 6), sround(y, 6), sround(z, 6))] = []
-                z += r_min
-            y += r_min
-        x += r_min
-
-    # assigning elements to the sectors
-    for en in opt_domains:
-        sector_centre = []
-        for k in range(3):
-            position = cg_min[k] + r_min * (0.5 + np.floor((cg[en][k] - cg_min[k]) / r_min))
-            sector_centre.append(sround(position, 6))
-        sector_elm[tuple(sector_centre)].append(en)
-
-    # finding near elements inside each sector
-    for sector_centre in sector_elm:
-        for en in sector_elm[sector_centre]:
-            near_elm[en] = []
-        for en in sector_elm[sector_centre]:
-            for en2 in sector_elm[sector_centre]:
-                if en == en2:
-                    continue
-                dx = cg[en][0] - cg[en2][0]
-                dy = cg[en][1] - cg[en2][1]
-                dz = cg[en][2] - cg[en2][2]
-                distance = (dx ** 2 + dy ** 2 + dz ** 2) ** 0.5
-                if distance < r_min:
-                    near_elm[en].append(en2)
-                    near_elm[en2].append(en)
-
-    # finding near elements in neighbouring sectors by comparing distance with neighbouring sector elements
-    x = cg_min[0] + 0.5 * r_min
-    while x <= cg_max[0] + 0.5 * r_min:
-        y = cg_min[1] + 0.5 * r_min
-        while y <= cg_max[1] + 0.5 * r_min:
-            z = cg_min[2] + 0.5 * r_min
-            while z <= cg_max[2] + 0.5 * r_min:
-                position = (sround(x, 6), sround(y, 6), sround(z, 6))
-                # down level neighbouring sectors:
-                # o  o  -
-                # o  -  -
-                # o  -  -
-                # middle level neighbouring sectors:
-                # o  o  -
-                # o self -
-                # o  -  -
-                # upper level neighbouring sectors:
-                # o  o  -
-                # o  o  -
-                # o  -  -
-                for position_neighbour in [(x + r_min, y - r_min, z - r_min),
-                                           (x + r_min, y, z - r_min),
-                                           (x + r_min, y + r_min, z - r_min),
-                                           (x, y + r_min, z - r_min),
-                                           (x + r_min, y - r_min, z),
-                                           (x + r_min, y, z),
-                                           (x + r_min, y + r_min, z),
-                                           (x, y + r_min, z),
-                                           (x + r_min, y - r_min, z + r_min),
-                                           (x + r_min, y, z + r_min),
-                                           (x + r_min, y + r_min, z + r_min),
-                                           (x, y + r_min, z + r_min),
-                                           (x, y, z + r_min)]:
-                    position_neighbour = (sround(position_neighbour[0], 6), sround(position_neighbour[1], 6),
-                                          sround(position_neighbour[2], 6))
-                    for en in sector_elm[position]:
-                        try:
-                            for en2 in sector_elm[position_neighbour]:
-                                dx = cg[en][0] - cg[en2][0]
-                                dy = cg[en][1] - cg[en2][1]
-                                dz = cg[en][2] - cg[en2][2]
-                                distance = (dx ** 2 + dy ** 2 + dz ** 2) ** 0.5
-                                if distance < r_min:
-                                    near_elm[en].append(en2)
-                                    near_elm[en2].append(en)
-                        except KeyError:
-                            pass
-                z += r_min
-            y += r_min
-        x += r_min
+# uses integer cell hashing to prevent computing distance of far points
+# returns sparse pattern of near elements including the element itself, rows and columns belong to elm_filtered
+# near elements can be taken from the neighbourhood prepared for more filters,
+# with memory_limit in MB they are searched in chunks (see near_elements_chunked)
+def prepare_morphology(cg, r_min, opt_domains, neighbourhood=None, memory_limit=0, file_name=None):
+    if memory_limit:
+        elm_filtered = np.unique(opt_domains)
+        xyz = np.array([cg[en] for en in elm_filtered.tolist()]).reshape(-1, 3)
+        [near_elm, order] = near_elements_chunked(file_name, xyz, r_min, False, True, memory_limit)
+        return near_elm, elm_filtered[order]
+    if neighbourhood is None:
+        neighbourhood = Neighbourhood(cg, r_min, opt_domains)
+    [elm_filtered, i, j, distance] = neighbourhood.within(cg, r_min, opt_domains)
+    itself = np.arange(len(elm_filtered))
+    near_elm = SparseMatrix(np.concatenate([itself, i, j]), np.concatenate([itself, j, i]), None,
+                            (len(elm_filtered), len(elm_filtered)))
     # print ("near elements have been associated")
-    return near_elm
+    return near_elm, elm_filtered
 
 
 # morphology based filtering (erode, dilate, open, close, open-close, close-open, combine)
-def run_morphology(sensitivity_number, near_elm, opt_domains, filter_type, FI_step_max=None):
-
-    def filter(filter_type, sensitivity_number, near_elm, opt_domains):
-        sensitivity_number_subtype = sensitivity_number.copy()
-        for en in opt_domains:
-            sensitivity_number_near = [sensitivity_number[en]]
-            for en2 in near_elm[en]:
-                sensitivity_number_near.append(sensitivity_number[en2])
-            if filter_type == "erode":
-                if FI_step_max:
-                    if FI_step_max[en] >= 1:  # if failing, do not switch down
-                        pass
-                    else:
-                        sensitivity_number_subtype[en] = min(sensitivity_number_near)
-                else:
-                    sensitivity_number_subtype[en] = min(sensitivity_number_near)
-            elif filter_type == "dilate":
-                sensitivity_number_subtype[en] = max(sensitivity_number_near)
-        return sensitivity_number_subtype
+# minimum or maximum over near elements is computed for all elements at once by reduction of sparse rows
+def run_morphology(sensitivity_number, near_elm, elm_filtered, filter_type, FI_step_max=None):
+    elm_filtered = elm_filtered.tolist()
+    if FI_step_max:
+        failing = np.array([FI_step_max[en] >= 1 for en in elm_filtered], dtype=bool)  # do not switch down
+    else:
+        failing = np.zeros(len(elm_filtered), dtype=bool)
 
-    sensitivity_number_filtered = sensitivity_number.copy()
+    def filter(filter_type, values):
+        if filter_type == "erode":
+            return np.where(failing, values, near_elm.reduce_columns(np.minimum, values))
+        elif filter_type == "dilate":
+            return near_elm.reduce_columns(np.maximum, values)
+
+    values = np.array([sensitivity_number[en] for en in elm_filtered])
     if filter_type in ["erode", "dilate"]:
-        sensitivity_number_filtered = filter(filter_type, sensitivity_number, near_elm, opt_domains)
+        values = filter(filter_type, values)
     elif filter_type == "open":
-        sensitivity_number_1 = filter("erode", sensitivity_number, near_elm, opt_domains)
-        sensitivity_number_filtered = filter("dilate", sensitivity_number_1, near_elm, opt_domains)
+        values = filter("dilate", filter("erode", values))
     elif filter_type == "close":
-        sensitivity_number_1 = filter("dilate", sensitivity_number, near_elm, opt_domains)
-        sensitivity_number_filtered = filter("erode", sensitivity_number_1, near_elm, opt_domains)
+        values = filter("erode", filter("dilate", values))
     elif filter_type == "open-close":
-        sensitivity_number_1 = filter("erode", sensitivity_number, near_elm, opt_domains)
-        sensitivity_number_1 = filter("dilate", sensitivity_number_1, near_elm, opt_domains)
-        sensitivity_number_1 = filter("dilate", sensitivity_number_1, near_elm, opt_domains)
-        sensitivity_number_filtered = filter("erode", sensitivity_number_1, near_elm, opt_domains)
+        values = filter("erode", filter("dilate", filter("dilate", filter("erode", values))))
     elif filter_type == "close-open":
-        sensitivity_number_1 = filter("dilate", sensitivity_number, near_elm, opt_domains)
-        sensitivity_number_1 = filter("erode", sensitivity_number_1, near_elm, opt_domains)
-        sensitivity_number_1 = filter("erode", sensitivity_number_1, near_elm, opt_domains)
-        sensitivity_number_filtered = filter("dilate", sensitivity_number_1, near_elm, opt_domains)
+        values = filter("dilate", filter("erode", filter("erode", filter("dilate", values))))
     elif filter_type == "combine":
-        sensitivity_number_1 = filter("erode", sensitivity_number, near_elm, opt_domains)
-        sensitivity_number_2 = filter("dilate", sensitivity_number, near_elm, opt_domains)
-        for en in opt_domains:
-            sensitivity_number_filtered[en] = (sensitivity_number_1[en] + sensitivity_number_2[en]) / 2.0
+        values = (filter("erode", values) + filter("dilate", values)) / 2.0
+    sensitivity_number_filtered = sensitivity_number.copy()
+    sensitivity_number_filtered.update(zip(elm_filtered, values.tolist()))
     return sensitivity_number_filtered
@@ -1,5 +1,16 @@
 import numpy as np
+import ast
+import functools
+import hashlib
+import mmap
+import multiprocessing
 import operator
+import os
+import re
+import warnings
+import zipfile
+
+CACHE_VERSION = 2  # increase when content of cache files changes
 
 
 # function to print ongoing messages to the log file
@@ -9,213 +20,592 @@ def write_to_log(file_name, msg):
     f_log.close()
 
 
-# function importing a mesh consisting of nodes, volume and shell elements
-def import_inp(file_name, domains_from_config, domain_optimized, shells_as_composite):
-    nodes = {}  # dict with nodes position
-
-    class Elements():
-        tria3 = {}
-        tria6 = {}
-        quad4 = {}
-        quad8 = {}
-        tetra4 = {}
-        tetra10 = {}
-        hexa8 = {}
-        hexa20 = {}
-        penta6 = {}
-        penta15 = {}
-
-    all_tria3 = {}
-    all_tria6 = {}
-    all_quad4 = {}
-    all_quad8 = {}
-    all_tetra4 = {}
-    all_tetra10 = {}
-    all_hexa8 = {}
-    all_hexa20 = {}
-    all_penta6 = {}
-    all_penta15 = {}
-
-    model_definition = True
-    domains = {}
-    read_domain = False
-    read_node = False
-    elm_category = []
-    elm_2nd_line = False
-    elset_generate = False
-    special_type = ""  # for plane strain, plane stress, or axisymmetry
-    plane_strain = set()
-    plane_stress = set()
-    axisymmetry = set()
+# function creating a dense map from node or element numbers to array rows (-1 for missing numbers)
+def dense_index(numbers, size=None):
+    numbers = np.asarray(numbers, dtype=np.int64)
+    if size is None:
+        size = int(numbers.max()) + 1 if len(numbers) else 0
+    index = np.full(size, -1, dtype=np.int32)
+    index[numbers] = np.arange(len(numbers), dtype=np.int32)
+    return index
+
+
+# dict-like access to array rows which belong to node or element numbers
+# index is a dense map number -> position, offset is subtracted when the map is shared by more arrays
+class NumberedArray(object):
+    def __init__(self, numbers, array, index=None, offset=0):
+        self.numbers = np.asarray(numbers, dtype=np.int32)
+        self.array = array
+        if index is None:
+            index = dense_index(self.numbers)
+        self.index = index
+        self.offset = offset
+
+    def rows(self, numbers):
+        """array rows of given numbers (any shape), -1 for numbers which are not stored"""
+        numbers = np.asarray(numbers, dtype=np.int64)
+        rows = np.full(numbers.shape, -1, dtype=np.int64)
+        inside = (numbers >= 0) & (numbers < len(self.index))
+        rows[inside] = self.index[numbers[inside]]
+        rows[rows >= 0] -= self.offset
+        rows[(rows < 0) | (rows >= len(self.numbers))] = -1
+        return rows
+
+    def _row(self, number):
+        if 0 <= number < len(self.index):
+            row = self.index[number] - self.offset
+            if 0 <= row < len(self.numbers) and self.index[number] >= 0:
+                return row
+        raise KeyError(number)
+
+    def __getitem__(self, number):
+        return self.array[self._row(number)]
+
+    def __contains__(self, number):
+        try:
+            self._row(number)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.numbers.tolist())
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __bool__(self):
+        return len(self.numbers) > 0
+    __nonzero__ = __bool__  # python 2.x
+
+    def get(self, number, default=None):
+        try:
+            return self[number]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.numbers.tolist()
+
+    def values(self):
+        return [self[number] for number in self.numbers.tolist()]
+
+    def items(self):
+        return [(number, self[number]) for number in self.numbers.tolist()]
+
+
+# node positions as float64 array (n, 3), nodes[nn] returns [x, y, z] row
+class Nodes(NumberedArray):
+    def __init__(self, numbers, coordinates):
+        NumberedArray.__init__(self, numbers, np.asarray(coordinates, dtype=np.float64).reshape(-1, 3))
+
+    @property
+    def coordinates(self):
+        return self.array
+
+
+# associated node numbers of one element category as int32 array (n, nodes per element)
+# Elements.category[en] returns a list of node numbers as the former dict of lists did
+class ElementCategory(NumberedArray):
+    def __init__(self, numbers, connectivity, number_of_nodes, index=None, offset=0):
+        connectivity = np.asarray(connectivity, dtype=np.int32).reshape(-1, number_of_nodes)
+        NumberedArray.__init__(self, numbers, connectivity, index, offset)
+
+    @property
+    def connectivity(self):
+        return self.array
+
+    def __getitem__(self, number):
+        return self.array[self._row(number)].tolist()
+
+
+# mesh elements divided to categories, all categories share one dense map en -> global element position
+# global positions follow order of categories, i.e. Elements.numbers
+class Elements(object):
+    categories = ["tria3", "tria6", "quad4", "quad8", "tetra4", "tetra10", "hexa8", "hexa20", "penta6", "penta15"]
+    number_of_nodes = {"tria3": 3, "tria6": 6, "quad4": 4, "quad8": 8, "tetra4": 4, "tetra10": 10, "hexa8": 8,
+                       "hexa20": 20, "penta6": 6, "penta15": 15}
 
+    shell_categories = ["tria3", "tria6", "quad4", "quad8"]  # shell and 2D elements, placed before volume elements
+
+    def __init__(self, connectivity_of_category=None):
+        # connectivity_of_category = {category: (element numbers, connectivity array), ...}
+        self.cache_key = None  # hash of input files if the mesh is cached
+        if connectivity_of_category is None:
+            connectivity_of_category = {}
+        numbers_list = []
+        for category in self.categories:
+            try:
+                numbers_list.append(np.asarray(connectivity_of_category[category][0], dtype=np.int32))
+            except KeyError:
+                numbers_list.append(np.zeros(0, dtype=np.int32))
+        self.numbers = np.concatenate(numbers_list)
+        self.index = dense_index(self.numbers)
+        offset = 0
+        for category, numbers in zip(self.categories, numbers_list):
+            try:
+                connectivity = connectivity_of_category[category][1]
+            except KeyError:
+                connectivity = np.zeros((0, self.number_of_nodes[category]), dtype=np.int32)
+            setattr(self, category, ElementCategory(numbers, connectivity, self.number_of_nodes[category],
+                                                    self.index, offset))
+            offset += len(numbers)
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def number_of_shells(self):
+        return sum([len(getattr(self, category)) for category in self.shell_categories])
+
+    def rows(self, numbers):
+        """global element positions of given element numbers, -1 for elements which are not stored"""
+        numbers = np.asarray(numbers, dtype=np.int64)
+        rows = np.full(numbers.shape, -1, dtype=np.int64)
+        inside = (numbers >= 0) & (numbers < len(self.index))
+        rows[inside] = self.index[numbers[inside]]
+        return rows
+
+
+# CalculiX element types: category, special type (plane strain, plane stress, axisymmetry or "")
+inp_element_types = {"S3": ("tria3", ""), "CPS3": ("tria3", "plane stress"), "CPE3": ("tria3", "plane strain"),
+                     "CAX3": ("tria3", "axisymmetry"),
+                     "S6": ("tria6", ""), "CPS6": ("tria6", "plane stress"), "CPE6": ("tria6", "plane strain"),
+                     "CAX6": ("tria6", "axisymmetry"),
+                     "S4": ("quad4", ""), "S4R": ("quad4", ""), "CPS4": ("quad4", "plane stress"),
+                     "CPS4R": ("quad4", "plane stress"), "CPE4": ("quad4", "plane strain"),
+                     "CPE4R": ("quad4", "plane strain"), "CAX4": ("quad4", "axisymmetry"),
+                     "CAX4R": ("quad4", "axisymmetry"),
+                     "S8": ("quad8", ""), "S8R": ("quad8", ""), "CPS8": ("quad8", "plane stress"),
+                     "CPS8R": ("quad8", "plane stress"), "CPE8": ("quad8", "plane strain"),
+                     "CPE8R": ("quad8", "plane strain"), "CAX8": ("quad8", "axisymmetry"),
+                     "CAX8R": ("quad8", "axisymmetry"),
+                     "C3D4": ("tetra4", ""), "C3D10": ("tetra10", ""),
+                     "C3D8": ("hexa8", ""), "C3D8R": ("hexa8", ""), "C3D8I": ("hexa8", ""),
+                     "C3D20": ("hexa20", ""), "C3D20R": ("hexa20", ""), "C3D20RI": ("hexa20", ""),
+                     "C3D6": ("penta6", ""), "C3D15": ("penta15", "")}
+
+separators_to_spaces = bytes.maketrans(b",", b" ")
+
+
+# function returning start of the next line beginning with * or -1 if there is not any
+def next_line_start(content, position):
+    start = content.find(b"\n*", position)
+    if start == -1:
+        return -1
+    return start + 1
+
+
+# generator going through keyword lines of the .inp file found by one pass over memory mapped file
+# yields (keyword line, None) for keywords and (None, (file name, start, end)) for data spans between them,
+# *INCLUDE files are read in place of their keyword line, data continue the last keyword as in CalculiX
+def inp_keywords(file_name):
+    f = open(file_name, "rb")
+    content = file_content(f)
     try:
-        f = open(file_name, "r")
-    except IOError:
-        msg = ("CalculiX input file " + file_name + " not found. Check your inputs.")
-        write_to_log(file_name, "\nERROR: " + msg + "\n")
-        raise Exception(msg)
-    line = "\n"
-    include = ""
-    while line != "":
-        if include:
-            line = f_include.readline()
-            if line == "":
-                f_include.close()
-                include = ""
-                line = f.readline()
+        position = 0  # start of data not yielded yet
+        if content[:1] == b"*":
+            start = 0  # start of keyword line, -1 if there is no next one
         else:
-            line = f.readline()
-        if line.strip() == '':
+            start = next_line_start(content, 0)
+        while start != -1:
+            end = content.find(b"\n", start)
+            if end == -1:
+                end = len(content)
+            if content[start + 1:start + 2] != b"*":  # not a comment
+                yield None, (file_name, position, start)
+                position = end
+                keyword_line = content[start:end].decode().strip()
+                if keyword_line[:8].upper() == "*INCLUDE":
+                    include = keyword_line[1 + keyword_line.index("="):].strip().strip('"')
+                    for item in inp_keywords(include):
+                        yield item
+                else:
+                    yield keyword_line, None
+            start = next_line_start(content, end)
+        yield None, (file_name, position, len(content))
+    finally:
+        close_content(content)
+        f.close()
+
+
+# function reading bytes of the data span (file name, start, end)
+def read_span(span):
+    [file_name, start, end] = span
+    f = open(file_name, "rb")
+    f.seek(start)
+    data = f.read(end - start)
+    f.close()
+    return data
+
+
+# function splitting the data span to spans of about chunk_size bytes for parallel parsing
+# spans are split only at line starts, with whole_records, also not after a line ending by comma (continued element)
+def split_span(span, chunk_size, whole_records):
+    [file_name, start, end] = span
+    if end - start <= chunk_size:
+        return [span]
+    spans = []
+    f = open(file_name, "rb")
+    content = file_content(f)
+    while end - start > chunk_size:
+        split = content.find(b"\n", start + chunk_size, end) + 1
+        if whole_records:
+            while 0 < split < end and content[content.rfind(b"\n", start, split - 1) + 1:split].rstrip()[-1:] == b",":
+                split = content.find(b"\n", split, end) + 1
+        if split <= 0 or split >= end:
+            break
+        spans.append((file_name, start, split))
+        start = split
+    spans.append((file_name, start, end))
+    close_content(content)
+    f.close()
+    return spans
+
+
+# function parsing one *NODE or *ELEMENT data span, it runs in a worker process for parallel reading
+def parse_span(task):
+    [keyword, number_of_nodes, span] = task
+    if keyword == "*NODE":
+        return parse_nodes(read_span(span))
+    return parse_elements(read_span(span), number_of_nodes)
+
+
+# function returning a process pool for cpu_cores processes or None if processes should not be used
+# only forked processes are used, spawned processes would execute beso_main again
+def process_pool(cpu_cores):
+    if cpu_cores < 2:
+        return None
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:  # not available on Windows
+        return None
+    return context.Pool(cpu_cores)
+
+
+# function splitting keyword line to upper case keyword and dict of its parameters
+def keyword_parameters(keyword_line):
+    line_list = keyword_line.split(",")
+    parameters = {}
+    for line_part in line_list[1:]:
+        parameter = line_part.split("=")
+        if len(parameter) > 1:
+            parameters[parameter[0].strip().upper()] = parameter[1].strip()
+        else:
+            parameters[parameter[0].strip().upper()] = ""
+    return line_list[0].strip().upper(), parameters
+
+
+# function parsing all numbers of a data block at once, commas and line breaks are separators
+# returns None if the block contains something else than numbers
+def parse_block(data, dtype):
+    if b"**" in data:  # remove comment lines
+        data = b"\n".join([line for line in data.splitlines() if line[:2] != b"**"])
+    with warnings.catch_warnings():  # numpy 1.x only warns and returns numbers read before the first bad token
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            return np.fromstring(data.translate(separators_to_spaces), dtype=dtype, sep=" ")
+        except (ValueError, DeprecationWarning):
+            return None
+
+
+# function returning rows of a node block as (node numbers, coordinates)
+def parse_nodes(data):
+    values = parse_block(data, np.float64)
+    if values is not None and len(values) % 4 == 0:
+        values = values.reshape(-1, 4)
+        if np.all(values[:, 0] == np.floor(values[:, 0])):
+            return values[:, 0].astype(np.int32), values[:, 1:]
+    # line by line reading if the block is not regular
+    numbers = []
+    coordinates = []
+    for line in data.decode().splitlines():
+        if line.strip() == "" or line[:2] == "**":
             continue
-        elif line[0] == '*':  # start/end of a reading set
-            if line[0:2] == '**':  # comments
-                continue
-            if line[:8].upper() == "*INCLUDE":
-                start = 1 + line.index("=")
-                include = line[start:].strip().strip('"')
-                f_include = open(include, "r")
+        line_list = line.split(',')
+        numbers.append(int(line_list[0]))
+        coordinates.append([float(line_list[1]), float(line_list[2]), float(line_list[3])])
+    return np.array(numbers, dtype=np.int32), np.array(coordinates, dtype=np.float64).reshape(-1, 3)
+
+
+# function returning element numbers and connectivity of an element block, element lines may continue on next lines
+def parse_elements(data, number_of_nodes):
+    values = parse_block(data, np.int64)
+    if values is None or len(values) % (number_of_nodes + 1):
+        msg = "element block of %d-node elements could not be read" % number_of_nodes
+        raise Exception(msg)
+    values = values.reshape(-1, number_of_nodes + 1).astype(np.int32)
+    return values[:, 0], values[:, 1:]
+
+
+# function returning element numbers of an element set block (numbers and names of previous element sets)
+def parse_elset(data, domains, generate):
+    data = b"\n".join([line for line in data.splitlines() if line[:2] != b"**"])
+    if generate:  # lines: first, last, increment
+        en_generated = [np.zeros(0, dtype=np.int32)]
+        for line in data.decode().splitlines():
+            line_split_comma = [part.strip() for part in line.split(",")]
+            if not line_split_comma[0]:
                 continue
-            read_node = False
-            elm_category = []
-            elm_2nd_line = False
-            read_domain = False
-            elset_generate = False
+            increment = 1
+            if len(line_split_comma) > 2 and line_split_comma[2]:
+                increment = int(line_split_comma[2])
+            en_generated.append(np.arange(int(line_split_comma[0]), int(line_split_comma[1]) + 1, increment,
+                                          dtype=np.int32))
+        return np.concatenate(en_generated)
+    values = parse_block(data, np.int64)
+    if values is not None:
+        return values.astype(np.int32)
+    en_list = []
+    for en in data.decode().replace("\n", ",").split(","):
+        en = en.strip()
+        if en.isdigit():
+            en_list.append(np.array([int(en)], dtype=np.int32))
+        elif en.isalpha():  # else: en is name of a previous elset
+            en_list.append(np.concatenate(domains[en.upper()]))
+    return np.concatenate(en_list) if en_list else np.zeros(0, dtype=np.int32)
+
+
+# function keeping the last definition of repeated numbers (as dict assignment does)
+def last_definitions(numbers, *arrays):
+    unique_numbers, last_reversed = np.unique(numbers[::-1], return_index=True)
+    if len(unique_numbers) == len(numbers):
+        return (numbers,) + arrays
+    last = np.sort(len(numbers) - 1 - last_reversed)
+    return (numbers[last],) + tuple([array[last] for array in arrays])
+
+
+# function reading the whole mesh of the .inp file (all elements, all element sets) into a dict of arrays
+# which can be stored in the mesh cache
+# keyword lines are found in one pass and each *NODE, *ELEMENT and *ELSET block is parsed at once,
+# everything after *STEP is skipped
+# with cpu_cores > 1, large node and element blocks (also from *INCLUDE files) are parsed in parallel processes
+def read_inp(file_name, cpu_cores=1):
+    # collecting keyword blocks in the definition order
+    blocks = []  # [(keyword, parameters, [data spans]), next block]
+    keyword_line = ""
+    spans = []
+    keywords = inp_keywords(file_name)
+    for [keyword_line_new, span] in keywords:
+        if keyword_line_new is None:
+            spans.append(span)
+            continue
+        if keyword_line:
+            blocks.append(keyword_parameters(keyword_line) + (spans,))
+        keyword_line = keyword_line_new
+        spans = []
+        if keyword_line[:5].upper() == "*STEP":
+            keyword_line = ""
+            break
+    keywords.close()
+    if keyword_line:
+        blocks.append(keyword_parameters(keyword_line) + (spans,))
+
+    # parsing node and element blocks, possibly split to chunks and parsed in parallel
+    tasks = []  # [(keyword, number of nodes, span), next task]
+    block_tasks = []  # number of tasks of each block
+    data_size = 0
+    for [keyword, parameters, spans] in blocks:
+        for [_, start, end] in spans:
+            data_size += end - start
+    chunk_size = max(2 ** 22, data_size // (4 * cpu_cores))
+    for [keyword, parameters, spans] in blocks:
+        tasks_before = len(tasks)
+        if keyword == "*NODE":
+            for span in spans:
+                tasks += [(keyword, 0, chunk) for chunk in split_span(span, chunk_size, False)]
+        elif keyword == "*ELEMENT" and parameters.get("TYPE", "").upper() in inp_element_types:
+            category = inp_element_types[parameters["TYPE"].upper()][0]
+            for span in spans:
+                tasks += [(keyword, Elements.number_of_nodes[category], chunk)
+                          for chunk in split_span(span, chunk_size, True)]
+        block_tasks.append(len(tasks) - tasks_before)
+    pool = None
+    if len(tasks) > 1:
+        pool = process_pool(min(cpu_cores, len(tasks)))
+    if pool:
+        parsed = pool.map(parse_span, tasks)
+        pool.close()
+        pool.join()
+    else:
+        parsed = list(map(parse_span, tasks))
+
+    # merging in the definition order
+    node_blocks = []  # [(node numbers, coordinates), next block]
+    category_blocks = {}  # {category: [(element numbers, connectivity), next block]}
+    for category in Elements.categories:
+        category_blocks[category] = []
+    elm_types = set()
+    domains = {}  # {elset name: [element numbers array, next array]}
+    special_blocks = {"plane strain": [], "plane stress": [], "axisymmetry": []}
+    task_position = 0
+    for [keyword, parameters, spans], n_tasks in zip(blocks, block_tasks):
+        parsed_block = parsed[task_position:task_position + n_tasks]
+        task_position += n_tasks
 
         # reading nodes
-        if (line[:5].upper() == "*NODE") and (model_definition is True):
-            read_node = True
-        elif read_node is True:
-            line_list = line.split(',')
-            number = int(line_list[0])
-            x = float(line_list[1])
-            y = float(line_list[2])
-            z = float(line_list[3])
-            nodes[number] = [x, y, z]
+        if keyword == "*NODE":
+            node_blocks += parsed_block
 
         # reading elements
-        elif line[:8].upper() == "*ELEMENT":
-            current_elset = ""
-            line_list = line[8:].upper().split(',')
-            for line_part in line_list:
-                if line_part.split('=')[0].strip() == "TYPE":
-                    elm_type = line_part.split('=')[1].strip()
-                elif line_part.split('=')[0].strip() == "ELSET":
-                    current_elset = line_part.split('=')[1].strip().upper()
-
-            if elm_type in ["S3", "CPS3", "CPE3", "CAX3"]:
-                elm_category = all_tria3
-                number_of_nodes = 3
-            elif elm_type in ["S6", "CPS6", "CPE6", "CAX6"]:
-                elm_category = all_tria6
-                number_of_nodes = 6
-            elif elm_type in ["S4", "S4R", "CPS4", "CPS4R", "CPE4", "CPE4R", "CAX4", "CAX4R"]:
-                elm_category = all_quad4
-                number_of_nodes = 4
-            elif elm_type in ["S8", "S8R", "CPS8", "CPS8R", "CPE8", "CPE8R", "CAX8", "CAX8R"]:
-                elm_category = all_quad8
-                number_of_nodes = 8
-            elif elm_type == "C3D4":
-                elm_category = all_tetra4
-                number_of_nodes = 4
-            elif elm_type == "C3D10":
-                elm_category = all_tetra10
-                number_of_nodes = 10
-            elif elm_type in ["C3D8", "C3D8R", "C3D8I"]:
-                elm_category = all_hexa8
-                number_of_nodes = 8
-            elif elm_type in ["C3D20", "C3D20R", "C3D20RI"]:
-                elm_category = all_hexa20
-                number_of_nodes = 20
-            elif elm_type == "C3D6":
-                elm_category = all_penta6
-                number_of_nodes = 6
-            elif elm_type == "C3D15":
-                elm_category = all_penta15
-                number_of_nodes = 15
-            if elm_type in ["CPE3", "CPE6", "CPE4", "CPE4R", "CPE8", "CPE8R"]:
-                special_type = "plane strain"
-            elif elm_type in ["CPS3", "CPS6", "CPS4", "CPS4R", "CPS8", "CPS8R"]:
-                special_type = "plane stress"
-            elif elm_type in ["CAX3", "CAX6", "CAX4", "CAX4R", "CAX8", "CAX8R"]:
-                special_type = "axisymmetry"
-            else:
-                special_type = ""
-                if (shells_as_composite is True) and (elm_type in ["S3", "S4", "S4R", "S8"]):
-                    msg = ("\nERROR: " + elm_type + "element type found. CalculiX might need S6 or S8R elements for "
-                                                  "composite\n")
-                    print(msg)
-                    write_to_log(file_name, msg)
-
-        elif elm_category != []:
-            line_list = line.split(',')
-            if elm_2nd_line is False:
-                en = int(line_list[0])  # element number
-                elm_category[en] = []
-                pos = 1
-                if current_elset:  # save en to the domain
-                    try:
-                        domains[current_elset].append(en)
-                    except KeyError:
-                        domains[current_elset] = [en]
-                if special_type == "plane strain":
-                    plane_strain.add(en)
-                elif special_type == "plane stress":
-                    plane_stress.add(en)
-                elif special_type == "axisymmetry":
-                    axisymmetry.add(en)
-            else:
-                pos = 0
-                elm_2nd_line = False
-            for nn in range(pos, pos + number_of_nodes - len(elm_category[en])):
-                try:
-                    enode = int(line_list[nn])
-                    elm_category[en].append(enode)
-                except IndexError:
-                    elm_2nd_line = True
-                    break
+        elif keyword == "*ELEMENT":
+            elm_type = parameters.get("TYPE", "").upper()
+            elm_types.add(elm_type)
+            if elm_type not in inp_element_types:
+                continue
+            category, special_type = inp_element_types[elm_type]
+            numbers = np.concatenate([np.zeros(0, dtype=np.int32)] + [en for (en, _) in parsed_block])
+            category_blocks[category] += parsed_block
+            current_elset = parameters.get("ELSET", "").upper()
+            if current_elset and len(numbers):  # save en to the domain
+                domains.setdefault(current_elset, []).append(numbers)
+            if special_type:
+                special_blocks[special_type].append(numbers)
 
         # reading domains from elset
-        elif line[:6].upper() == "*ELSET":
-            line_split_comma = line.split(",")
-            if "=" in line_split_comma[1]:
-                name_member = 1
-                try:
-                    if "GENERATE" in line_split_comma[2].upper():
-                        elset_generate = True
-                except IndexError:
-                    pass
-            else:
-                name_member = 2
-                if "GENERATE" in line_split_comma[1].upper():
-                    elset_generate = True
-            member_split = line_split_comma[name_member].split("=")
-            current_elset = member_split[1].strip()
-            try:
-                domains[current_elset]
-            except KeyError:
-                domains[current_elset] = []
-            if elset_generate is False:
-                read_domain = True
-        elif read_domain is True:
-            for en in line.split(","):
-                en = en.strip()
-                if en.isdigit():
-                    domains[current_elset].append(int(en))
-                elif en.isalpha():  # else: en is name of a previous elset
-                    domains[current_elset].extend(domains[en.upper()])
-        elif elset_generate is True:
-            line_split_comma = line.split(",")
-            try:
-                if line_split_comma[3]:
-                    en_generated = list(range(int(line_split_comma[0]), int(line_split_comma[1]) + 1,
-                                              int(line_split_comma[2])))
-            except IndexError:
-                en_generated = list(range(int(line_split_comma[0]), int(line_split_comma[1]) + 1))
-            domains[current_elset].extend(en_generated)
+        elif keyword == "*ELSET":
+            current_elset = parameters["ELSET"]
+            domains.setdefault(current_elset, [])
+            data = b"".join([read_span(span) for span in spans])
+            domains[current_elset].append(parse_elset(data, domains, "GENERATE" in parameters))
+
+    node_numbers = np.concatenate([np.zeros(0, dtype=np.int32)] + [numbers for (numbers, _) in node_blocks])
+    node_coordinates = np.concatenate([np.zeros((0, 3))] + [coordinates for (_, coordinates) in node_blocks])
+    [node_numbers, node_coordinates] = last_definitions(node_numbers, node_coordinates)
+    domain_elements = [np.concatenate(en_arrays) if en_arrays else np.zeros(0, dtype=np.int32)
+                       for en_arrays in domains.values()]
+    mesh = {"node_numbers": node_numbers,
+            "node_coordinates": node_coordinates,
+            "elm_types": np.array(sorted(elm_types), dtype=str),
+            "domain_names": np.array(list(domains.keys()), dtype=str),
+            "domain_sizes": np.array([len(en_array) for en_array in domain_elements], dtype=np.int64),
+            "domain_elements": np.concatenate([np.zeros(0, dtype=np.int32)] + domain_elements)}
+    for special_type, special_key in [("plane strain", "plane_strain"), ("plane stress", "plane_stress"),
+                                      ("axisymmetry", "axisymmetry")]:
+        mesh[special_key] = np.unique(np.concatenate([np.zeros(0, dtype=np.int32)] + special_blocks[special_type]))
+    for category in Elements.categories:
+        numbers = np.concatenate([np.zeros(0, dtype=np.int32)] +
+                                 [numbers for (numbers, _) in category_blocks[category]])
+        connectivity = np.concatenate([np.zeros((0, Elements.number_of_nodes[category]), dtype=np.int32)] +
+                                      [connectivity for (_, connectivity) in category_blocks[category]])
+        [numbers, connectivity] = last_definitions(numbers, connectivity)
+        order = np.argsort(numbers, kind="stable")
+        mesh[category + "_numbers"] = numbers[order]
+        mesh[category + "_connectivity"] = connectivity[order]
+    return mesh
+
+
+# function returning hash of the .inp file content and contents of all its nested *INCLUDE files, it is a key of the caches
+def inp_files_hash(file_name):
+    inp_hash = hashlib.sha1(("beso cache " + str(CACHE_VERSION)).encode())
+
+    def update_hash(file_name):  # follows *INCLUDE files recursively as inp_keywords does
+        inp_hash.update(file_name.encode())
+        try:
+            f = open(file_name, "rb")
+        except IOError:
+            return  # missing file is reported by the reader
+        content = file_content(f)
+        inp_hash.update(content)
+        includes = []
+        start = 0 if content[:1] == b"*" else next_line_start(content, 0)
+        while start != -1:
+            if content[start:start + 8].upper() == b"*INCLUDE":
+                end = content.find(b"\n", start)
+                include_line = content[start:end if end != -1 else len(content)].decode()
+                includes.append(include_line[1 + include_line.index("="):].strip().strip('"'))
+            start = next_line_start(content, start)
+        close_content(content)
+        f.close()
+        for include in includes:
+            update_hash(include)
+
+    update_hash(file_name)
+    return inp_hash.hexdigest()
+
+
+# function returning content of the opened binary file, memory mapped if possible
+def file_content(f):
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):  # empty file or file which cannot be mapped
+        return f.read()
+
+
+# function closing the content returned by file_content
+def close_content(content):
+    if isinstance(content, mmap.mmap):
+        content.close()
 
-        elif line[:5].upper() == "*STEP":
-            model_definition = False
+
+# function saving a dict of arrays to .npz cache file together with its key
+def save_cache(cache_file, cache_key, arrays):
+    cache_file_tmp = cache_file + ".tmp"
+    f = open(cache_file_tmp, "wb")
+    np.savez(f, cache_key=np.array(cache_key), **arrays)
     f.close()
+    os.replace(cache_file_tmp, cache_file)  # the cache is never seen half written
+
+
+# function loading a dict of arrays from .npz cache file, returns None if there is no valid cache for the key
+def load_cache(cache_file, cache_key):
+    try:
+        cache = np.load(cache_file, allow_pickle=False)
+    except (IOError, ValueError, zipfile.BadZipfile):
+        return None
+    try:
+        if str(cache["cache_key"]) != cache_key:
+            return None
+        arrays = {}
+        for key in cache.files:
+            if key != "cache_key":
+                arrays[key] = cache[key]
+    except (KeyError, ValueError, zipfile.BadZipfile):
+        return None
+    finally:
+        cache.close()
+    return arrays
+
+
+# function importing a mesh consisting of nodes, volume and shell elements
+# with mesh_cache, parsed mesh is stored to file_name_mesh_cache.npz and reused while the input files are the same
+def import_inp(file_name, domains_from_config, domain_optimized, shells_as_composite, mesh_cache=False, cpu_cores=1):
+    try:
+        f = open(file_name, "r")
+        f.close()
+    except IOError:
+        msg = ("CalculiX input file " + file_name + " not found. Check your inputs.")
+        write_to_log(file_name, "\nERROR: " + msg + "\n")
+        raise Exception(msg)
+
+    mesh = None
+    cache_key = None
+    if mesh_cache:
+        cache_key = inp_files_hash(file_name)
+        mesh = load_cache(file_name[:-4] + "_mesh_cache.npz", cache_key)
+        if mesh is not None:
+            msg = "\nINFO: mesh loaded from " + file_name[:-4] + "_mesh_cache.npz\n"
+            print(msg)
+            write_to_log(file_name, msg)
+    if mesh is None:
+        mesh = read_inp(file_name, cpu_cores)
+        if mesh_cache:
+            save_cache(file_name[:-4] + "_mesh_cache.npz", cache_key, mesh)
+
+    if shells_as_composite is True:
+        for elm_type in mesh["elm_types"]:
+            if elm_type in ["S3", "S4", "S4R", "S8"]:
+                msg = ("\nERROR: " + elm_type + "element type found. CalculiX might need S6 or S8R elements for "
+                                              "composite\n")
+                print(msg)
+                write_to_log(file_name, msg)
+
+    domains = {}
+    domain_ends = np.cumsum(mesh["domain_sizes"])
+    for dn, end, size in zip(mesh["domain_names"], domain_ends, mesh["domain_sizes"]):
+        domains[str(dn)] = mesh["domain_elements"][end - size:end].tolist()
+    plane_strain = set(mesh["plane_strain"].tolist())
+    plane_stress = set(mesh["plane_stress"].tolist())
+    axisymmetry = set(mesh["axisymmetry"].tolist())
 
     en_all = []
     opt_domains = []
@@ -226,36 +616,22 @@ def import_inp(file_name, domains_from_config, domain_optimized, shells_as_compo
     msg = ("domains: %.f\n" % len(domains_from_config))
 
     # only elements in domains_from_config are stored, the rest is discarded
-    keys = set(en_all).intersection(set(all_tria3.keys()))
-    Elements.tria3 = {k: all_tria3[k] for k in keys}
-    keys = set(en_all).intersection(set(all_tria6.keys()))
-    Elements.tria6 = {k: all_tria6[k] for k in keys}
-    keys = set(en_all).intersection(set(all_quad4.keys()))
-    Elements.quad4 = {k: all_quad4[k] for k in keys}
-    keys = set(en_all).intersection(set(all_quad8.keys()))
-    Elements.quad8 = {k: all_quad8[k] for k in keys}
-    keys = set(en_all).intersection(set(all_tetra4.keys()))
-    Elements.tetra4 = {k: all_tetra4[k] for k in keys}
-    keys = set(en_all).intersection(set(all_tetra10.keys()))
-    Elements.tetra10 = {k: all_tetra10[k] for k in keys}
-    keys = set(en_all).intersection(set(all_hexa8.keys()))
-    Elements.hexa8 = {k: all_hexa8[k] for k in keys}
-    keys = set(en_all).intersection(set(all_hexa20.keys()))
-    Elements.hexa20 = {k: all_hexa20[k] for k in keys}
-    keys = set(en_all).intersection(set(all_penta6.keys()))
-    Elements.penta6 = {k: all_penta6[k] for k in keys}
-    keys = set(en_all).intersection(set(all_penta15.keys()))
-    Elements.penta15 = {k: all_penta15[k] for k in keys}
-    en_all = list(Elements.tria3.keys()) + list(Elements.tria6.keys()) + list(Elements.quad4.keys()) + \
-             list(Elements.quad8.keys()) + list(Elements.tetra4.keys()) + list(Elements.tetra10.keys()) + \
-             list(Elements.hexa8.keys()) + list(Elements.hexa20.keys()) + list(Elements.penta6.keys()) + \
-             list(Elements.penta15.keys())
+    en_all = np.array(en_all, dtype=np.int32)
+    connectivity_of_category = {}
+    for category in Elements.categories:
+        in_domains = np.isin(mesh[category + "_numbers"], en_all)
+        connectivity_of_category[category] = (mesh[category + "_numbers"][in_domains],
+                                              mesh[category + "_connectivity"][in_domains])
+    elements = Elements(connectivity_of_category)
+    elements.cache_key = cache_key
+    en_all = elements.numbers.tolist()
+    nodes = Nodes(mesh["node_numbers"], mesh["node_coordinates"])
 
     msg += ("nodes  : %.f\nTRIA3  : %.f\nTRIA6  : %.f\nQUAD4  : %.f\nQUAD8  : %.f\nTETRA4 : %.f\nTETRA10: %.f\n"
            "HEXA8  : %.f\nHEXA20 : %.f\nPENTA6 : %.f\nPENTA15: %.f\n"
-           % (len(nodes), len(Elements.tria3), len(Elements.tria6), len(Elements.quad4), len(Elements.quad8),
-              len(Elements.tetra4), len(Elements.tetra10), len(Elements.hexa8), len(Elements.hexa20),
-              len(Elements.penta6), len(Elements.penta15)))
+           % (len(nodes), len(elements.tria3), len(elements.tria6), len(elements.quad4), len(elements.quad8),
+              len(elements.tetra4), len(elements.tetra10), len(elements.hexa8), len(elements.hexa20),
+              len(elements.penta6), len(elements.penta15)))
     print(msg)
     write_to_log(file_name, msg)
 
@@ -265,145 +641,200 @@ def import_inp(file_name, domains_from_config, domain_optimized, shells_as_compo
         write_to_log(file_name, msg)
         assert False, row
 
-    return nodes, Elements, domains, opt_domains, en_all, plane_strain, plane_stress, axisymmetry
+    return nodes, elements, domains, opt_domains, en_all, plane_strain, plane_stress, axisymmetry
+
+
+# splitting of element categories to triangles (shells) or tetrahedrons (volume elements) by node positions
+simplices_of_category = {"tria3": [[0, 1, 2]],
+                         "quad4": [[0, 1, 2], [0, 2, 3]],
+                         "tetra4": [[0, 1, 2, 3]],
+                         "hexa8": [[0, 1, 2, 5], [0, 2, 4, 5], [2, 4, 5, 6], [0, 2, 3, 4], [3, 4, 6, 7], [2, 3, 4, 6]],
+                         "penta6": [[0, 1, 2, 3], [1, 2, 3, 4], [2, 3, 4, 5]]}
+
+# 2nd order elements as in CalculiX: natural coordinates of corner nodes, corner pairs of mid-nodes (in node order),
+# exponents of monomials spanning shape functions, shape of the natural domain
+isoparametric_elements = {
+    "tria6": ([[0, 0], [1, 0], [0, 1]],
+              [[0, 1], [1, 2], [2, 0]],
+              [[0, 0], [1, 0], [0, 1], [2, 0], [1, 1], [0, 2]],
+              "triangle"),
+    "quad8": ([[-1, -1], [1, -1], [1, 1], [-1, 1]],
+              [[0, 1], [1, 2], [2, 3], [3, 0]],
+              [[0, 0], [1, 0], [0, 1], [2, 0], [1, 1], [0, 2], [2, 1], [1, 2]],
+              "square"),
+    "tetra10": ([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]],
+                [[0, 1], [1, 2], [2, 0], [0, 3], [1, 3], [2, 3]],
+                [[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1], [2, 0, 0], [0, 2, 0], [0, 0, 2], [1, 1, 0], [1, 0, 1],
+                 [0, 1, 1]],
+                "tetrahedron"),
+    "hexa20": ([[-1, -1, -1], [1, -1, -1], [1, 1, -1], [-1, 1, -1], [-1, -1, 1], [1, -1, 1], [1, 1, 1], [-1, 1, 1]],
+               [[0, 1], [1, 2], [2, 3], [3, 0], [4, 5], [5, 6], [6, 7], [7, 4], [0, 4], [1, 5], [2, 6], [3, 7]],
+               [[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1], [2, 0, 0], [0, 2, 0], [0, 0, 2], [1, 1, 0], [1, 0, 1],
+                [0, 1, 1], [2, 1, 0], [2, 0, 1], [1, 2, 0], [0, 2, 1], [1, 0, 2], [0, 1, 2], [1, 1, 1], [2, 1, 1],
+                [1, 2, 1], [1, 1, 2]],
+               "cube"),
+    "penta15": ([[0, 0, -1], [1, 0, -1], [0, 1, -1], [0, 0, 1], [1, 0, 1], [0, 1, 1]],
+                [[0, 1], [1, 2], [2, 0], [3, 4], [4, 5], [5, 3], [0, 3], [1, 4], [2, 5]],
+                [[0, 0, 0], [1, 0, 0], [0, 1, 0], [2, 0, 0], [1, 1, 0], [0, 2, 0], [0, 0, 1], [1, 0, 1], [0, 1, 1],
+                 [2, 0, 1], [1, 1, 1], [0, 2, 1], [0, 0, 2], [1, 0, 2], [0, 1, 2]],
+                "wedge")}
+
+
+# function computing cross product of vectors given by their component arrays [x, y, z]
+def cross_product(u, v):
+    return [u[1] * v[2] - u[2] * v[1], u[2] * v[0] - u[0] * v[2], u[0] * v[1] - u[1] * v[0]]
+
+
+# function computing areas (triangles) or volumes (tetrahedrons) and centres of gravity of elements of one category
+# xyz is an array of node coordinates (3, element nodes, elements), simplices are lists of node positions of sub-elements
+def simplices_measure_cg(xyz, simplices):
+    measure = np.zeros(xyz.shape[2])
+    moment = np.zeros((3, xyz.shape[2]))
+    for simplex in simplices:
+        points = [xyz[:, k] for k in simplex]
+        u = points[2] - points[1]
+        w = points[0] - points[1]
+        if len(simplex) == 3:
+            n = cross_product(u, w)
+            measure_simplex = np.sqrt(n[0] ** 2 + n[1] ** 2 + n[2] ** 2) / 2.0
+        else:
+            n = cross_product(u, points[3] - points[1])
+            measure_simplex = abs(n[0] * w[0] + n[1] * w[1] + n[2] * w[2]) / 6.0
+        cg_simplex = sum(points) / float(len(simplex))
+        if len(simplices) == 1:
+            return measure_simplex, cg_simplex.T
+        measure += measure_simplex
+        moment += measure_simplex * cg_simplex
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return measure, (moment / measure).T
+
+
+# function returning Gauss points (points, dimensions) and weights of the natural domain of isoparametric element
+# triangle and tetrahedron use Gauss-Legendre points on a collapsed square or cube
+def gauss_points(domain, points_per_direction=3):
+    [g, w] = np.polynomial.legendre.leggauss(points_per_direction)
+    g = (g + 1) / 2.0  # interval 0..1
+    w = w / 2.0
+    if domain == "square":
+        [r, s] = [2 * x.ravel() - 1 for x in np.meshgrid(g, g, indexing="ij")]
+        weights = 4 * np.outer(w, w).ravel()
+        return np.array([r, s]).T, weights
+    elif domain == "cube":
+        [r, s, t] = [2 * x.ravel() - 1 for x in np.meshgrid(g, g, g, indexing="ij")]
+        weights = 8 * np.einsum("i,j,k->ijk", w, w, w).ravel()
+        return np.array([r, s, t]).T, weights
+    elif domain == "triangle":
+        [u, v] = [x.ravel() for x in np.meshgrid(g, g, indexing="ij")]
+        weights = np.outer(w, w).ravel() * (1 - u)
+        return np.array([u, (1 - u) * v]).T, weights
+    elif domain == "tetrahedron":
+        [u, v, z] = [x.ravel() for x in np.meshgrid(g, g, g, indexing="ij")]
+        weights = np.einsum("i,j,k->ijk", w, w, w).ravel() * (1 - u) ** 2 * (1 - v)
+        return np.array([u, (1 - u) * v, (1 - u) * (1 - v) * z]).T, weights
+    elif domain == "wedge":
+        [points, weights] = gauss_points("triangle", points_per_direction)
+        t = 2 * g - 1
+        points = np.hstack([np.repeat(points, len(t), axis=0), np.tile(t, len(points))[:, None]])
+        return points, 2 * np.outer(weights, w).ravel()
+
+
+# function returning shape functions (points, nodes) and their derivatives (points, nodes, dimensions)
+# of the 2nd order element category at given natural coordinates
+def shape_functions(category, points):
+    [corners, mid_nodes, exponents, domain] = isoparametric_elements[category]
+    corners = np.array(corners, dtype=float)
+    node_coordinates = np.vstack([corners, corners[np.array(mid_nodes)].mean(axis=1)])
+    exponents = np.array(exponents)
+
+    def monomials(x, derivative=None):
+        e = exponents.copy()
+        factor = np.ones(len(e))
+        if derivative is not None:
+            factor = e[:, derivative].astype(float)
+            e[:, derivative] = np.maximum(e[:, derivative] - 1, 0)
+        return factor * np.prod(x[:, None, :] ** e[None, :, :], axis=2)
+
+    coefficients = np.linalg.inv(monomials(node_coordinates))  # shape functions are 1 at own node, 0 at others
+    n = monomials(points).dot(coefficients)
+    dn = np.array([monomials(points, d).dot(coefficients) for d in range(points.shape[1])]).transpose(1, 2, 0)
+    return n, dn
+
+
+# function computing areas (2D natural domain) or volumes (3D) and centres of gravity of isoparametric elements
+# by Gauss quadrature, xyz is an array of node coordinates (3, element nodes, elements)
+def isoparametric_measure_cg(xyz, category):
+    [points, weights] = gauss_points(isoparametric_elements[category][3])
+    [n, dn] = shape_functions(category, points)
+    elements = xyz.shape[2]
+    xyz_matrix = np.ascontiguousarray(xyz.transpose(1, 0, 2)).reshape(xyz.shape[1], 3 * elements)
+    measure = np.zeros(elements)
+    moment = np.zeros((3, elements))
+    for q in range(len(weights)):
+        # Jacobian columns, i.e. derivatives of [x, y, z] by natural coordinates
+        jacobian = dn[q].T.dot(xyz_matrix).reshape(points.shape[1], 3, elements)
+        if len(jacobian) == 2:
+            normal = cross_product(jacobian[0], jacobian[1])
+            det = np.sqrt(normal[0] ** 2 + normal[1] ** 2 + normal[2] ** 2)
+        else:
+            normal = cross_product(jacobian[0], jacobian[1])
+            det = abs(normal[0] * jacobian[2][0] + normal[1] * jacobian[2][1] + normal[2] * jacobian[2][2])
+        measure += weights[q] * det
+        moment += weights[q] * det * n[q].dot(xyz_matrix).reshape(3, elements)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return measure, (moment / measure).T
 
 
 # function for computing volumes or area (shell elements) and centres of gravity
-# approximate for 2nd order elements!
+# 1st order elements are split to triangles or tetrahedrons, 2nd order elements are integrated by Gauss quadrature
+# elements of one category are computed in chunks from coordinates gathered to array (3, nodes, elements)
+# for cached mesh, results are stored to file_name_geometry_cache.npz and reused for the same elements
 def elm_volume_cg(file_name, nodes, Elements):
-    u = [0.0, 0.0, 0.0]
-    v = [0.0, 0.0, 0.0]
-    w = [0.0, 0.0, 0.0]
-
-    def tria_area_cg(nod):
-        # compute volume
-        for i in [0, 1, 2]:  # denote x, y, z directions
-            u[i] = nodes[nod[2]][i] - nodes[nod[1]][i]
-            v[i] = nodes[nod[0]][i] - nodes[nod[1]][i]
-        area_tria = np.linalg.linalg.norm(np.cross(u, v)) / 2.0
-        # compute centre of gravity
-        x_cg = (nodes[nod[0]][0] + nodes[nod[1]][0] + nodes[nod[2]][0]) / 3.0
-        y_cg = (nodes[nod[0]][1] + nodes[nod[1]][1] + nodes[nod[2]][1]) / 3.0
-        z_cg = (nodes[nod[0]][2] + nodes[nod[1]][2] + nodes[nod[2]][2]) / 3.0
-        cg_tria = [x_cg, y_cg, z_cg]
-        return area_tria, cg_tria
-
-    def tetra_volume_cg(nod):
-        # compute volume
-        for i in [0, 1, 2]:  # denote x, y, z directions
-            u[i] = nodes[nod[2]][i] - nodes[nod[1]][i]
-            v[i] = nodes[nod[3]][i] - nodes[nod[1]][i]
-            w[i] = nodes[nod[0]][i] - nodes[nod[1]][i]
-            volume_tetra = abs(np.dot(np.cross(u, v), w)) / 6.0
-        # compute centre of gravity
-        x_cg = (nodes[nod[0]][0] + nodes[nod[1]][0] + nodes[nod[2]][0] + nodes[nod[3]][0]) / 4.0
-        y_cg = (nodes[nod[0]][1] + nodes[nod[1]][1] + nodes[nod[2]][1] + nodes[nod[3]][1]) / 4.0
-        z_cg = (nodes[nod[0]][2] + nodes[nod[1]][2] + nodes[nod[2]][2] + nodes[nod[3]][2]) / 4.0
-        cg_tetra = [x_cg, y_cg, z_cg]
-        return volume_tetra, cg_tetra
-
-    def second_order_info(elm_type):
-        msg = "\nINFO: areas and centres of gravity of " + elm_type.upper() + " elements ignore mid-nodes' positions\n"
-        print(msg)
-        write_to_log(file_name, msg)
-
-    # defining volume and centre of gravity for all element types
-    volume_elm = {}
-    area_elm = {}
-    cg = {}
-
-    for en, nod in Elements.tria3.items():
-        [area_elm[en], cg[en]] = tria_area_cg(nod)
-
-    if Elements.tria6:
-        second_order_info("tria6")
-    for en, nod in Elements.tria6.items():  # copy from tria3
-        [area_elm[en], cg[en]] = tria_area_cg(nod)
-
-    for en, nod in Elements.quad4.items():
-        [a1, cg1] = tria_area_cg(nod[0:3])
-        [a2, cg2] = tria_area_cg(nod[0:1] + nod[2:4])
-        area_elm[en] = float(a1 + a2)
-        cg[en] = [[], [], []]
-        for k in [0, 1, 2]:  # denote x, y, z dimensions
-            cg[en][k] = (a1 * cg1[k] + a2 * cg2[k]) / area_elm[en]
-
-    if Elements.quad8:
-        second_order_info("quad8")
-    for en, nod in Elements.quad8.items():  # copy from quad4
-        [a1, cg1] = tria_area_cg(nod[0:3])
-        [a2, cg2] = tria_area_cg(nod[0:1] + nod[2:4])
-        area_elm[en] = float(a1 + a2)
-        cg[en] = [[], [], []]
-        for k in [0, 1, 2]:  # denote x, y, z dimensions
-            cg[en][k] = (a1 * cg1[k] + a2 * cg2[k]) / area_elm[en]
-
-    for en, nod in Elements.tetra4.items():
-        [volume_elm[en], cg[en]] = tetra_volume_cg(nod)
-
-    if Elements.tetra10:
-        second_order_info("tetra10")
-    for en, nod in Elements.tetra10.items():  # copy from tetra4
-        [volume_elm[en], cg[en]] = tetra_volume_cg(nod)
-
-    for en, nod in Elements.hexa8.items():
-        [v1, cg1] = tetra_volume_cg(nod[0:3] + nod[5:6])
-        [v2, cg2] = tetra_volume_cg(nod[0:1] + nod[2:3] + nod[4:6])
-        [v3, cg3] = tetra_volume_cg(nod[2:3] + nod[4:7])
-        [v4, cg4] = tetra_volume_cg(nod[0:1] + nod[2:5])
-        [v5, cg5] = tetra_volume_cg(nod[3:5] + nod[6:8])
-        [v6, cg6] = tetra_volume_cg(nod[2:5] + nod[6:7])
-        volume_elm[en] = float(v1 + v2 + v3 + v4 + v5 + v6)
-        cg[en] = [[], [], []]
-        for k in [0, 1, 2]:  # denote x, y, z dimensions
-            cg[en][k] = (v1 * cg1[k] + v2 * cg2[k] + v3 * cg3[k] + v4 * cg4[k] + v5 * cg5[k] + v6 * cg6[k]
-                         ) / volume_elm[en]
-
-    if Elements.hexa20:
-        second_order_info("hexa20")
-    for en, nod in Elements.hexa20.items():  # copy from hexa8
-        [v1, cg1] = tetra_volume_cg(nod[0:3] + nod[5:6])
-        [v2, cg2] = tetra_volume_cg(nod[0:1] + nod[2:3] + nod[4:6])
-        [v3, cg3] = tetra_volume_cg(nod[2:3] + nod[4:7])
-        [v4, cg4] = tetra_volume_cg(nod[0:1] + nod[2:5])
-        [v5, cg5] = tetra_volume_cg(nod[3:5] + nod[6:8])
-        [v6, cg6] = tetra_volume_cg(nod[2:5] + nod[6:7])
-        volume_elm[en] = float(v1 + v2 + v3 + v4 + v5 + v6)
-        cg[en] = [[], [], []]
-        for k in [0, 1, 2]:  # denote x, y, z dimensions
-            cg[en][k] = (v1 * cg1[k] + v2 * cg2[k] + v3 * cg3[k] + v4 * cg4[k] + v5 * cg5[k] + v6 * cg6[k]
-                         ) / volume_elm[en]
-
-    for en, nod in Elements.penta6.items():
-        [v1, cg1] = tetra_volume_cg(nod[0:4])
-        [v2, cg2] = tetra_volume_cg(nod[1:5])
-        [v3, cg3] = tetra_volume_cg(nod[2:6])
-        volume_elm[en] = float(v1 + v2 + v3)
-        cg[en] = [[], [], []]
-        for k in [0, 1, 2]:  # denote x, y, z dimensions
-            cg[en][k] = (v1 * cg1[k] + v2 * cg2[k] + v3 * cg3[k]) / volume_elm[en]
-
-    if Elements.penta15:
-        second_order_info("penta15")  # copy from penta6
-    for en, nod in Elements.penta15.items():
-        [v1, cg1] = tetra_volume_cg(nod[0:4])
-        [v2, cg2] = tetra_volume_cg(nod[1:5])
-        [v3, cg3] = tetra_volume_cg(nod[2:6])
-        volume_elm[en] = float(v1 + v2 + v3)
-        cg[en] = [[], [], []]
-        for k in [0, 1, 2]:  # denote x, y, z dimensions
-            cg[en][k] = (v1 * cg1[k] + v2 * cg2[k] + v3 * cg3[k]) / volume_elm[en]
-
+    cache_file = file_name[:-4] + "_geometry_cache.npz"
+    if Elements.cache_key:
+        geometry = load_cache(cache_file, Elements.cache_key)
+        if geometry is not None and np.array_equal(geometry["numbers"], Elements.numbers):
+            return geometry_dicts(Elements, geometry["volume_area"], geometry["cg"])
+
+    # arrays ordered as Elements.numbers, area for shells is followed by volume for volume elements
+    volume_area = np.zeros(len(Elements))
+    cg_array = np.zeros((len(Elements), 3))
+    position = 0
+    for category in Elements.categories:
+        elm_category = getattr(Elements, category)
+        if not elm_category:
+            continue
+        node_rows = nodes.rows(elm_category.connectivity)
+        if (node_rows == -1).any():
+            en = elm_category.numbers[(node_rows == -1).any(axis=1)][0]
+            msg = "Element " + str(en) + " has a node which is not defined. Check your inputs."
+            write_to_log(file_name, "\nERROR: " + msg + "\n")
+            raise Exception(msg)
+        for chunk in range(0, len(elm_category), 2 ** 17):  # limits memory of gathered coordinates
+            xyz = nodes.coordinates.T[:, node_rows[chunk:chunk + 2 ** 17].T]
+            end = position + xyz.shape[2]
+            if category in simplices_of_category:
+                measure_cg = simplices_measure_cg(xyz, simplices_of_category[category])
+            else:
+                measure_cg = isoparametric_measure_cg(xyz, category)
+            [volume_area[position:end], cg_array[position:end]] = measure_cg
+            position = end
+
+    if Elements.cache_key:
+        save_cache(cache_file, Elements.cache_key, {"numbers": Elements.numbers, "volume_area": volume_area,
+                                                    "cg": cg_array})
+    return geometry_dicts(Elements, volume_area, cg_array)
+
+
+# function returning element volumes, areas and centres of gravity as dicts for the arrays ordered as Elements.numbers
+def geometry_dicts(Elements, volume_area, cg_array):
+    n_shells = Elements.number_of_shells()
+    numbers = Elements.numbers.tolist()
+    area_elm = dict(zip(numbers[:n_shells], volume_area[:n_shells].tolist()))
+    volume_elm = dict(zip(numbers[n_shells:], volume_area[n_shells:].tolist()))
+    cg = dict(zip(numbers, cg_array.tolist()))
     # finding the minimum and maximum cg position
-    x_cg = []
-    y_cg = []
-    z_cg = []
-    for xyz in cg.values():
-        x_cg.append(xyz[0])
-        y_cg.append(xyz[1])
-        z_cg.append(xyz[2])
-    cg_min = [min(x_cg), min(y_cg), min(z_cg)]
-    cg_max = [max(x_cg), max(y_cg), max(z_cg)]
+    cg_min = cg_array.min(axis=0).tolist()
+    cg_max = cg_array.max(axis=0).tolist()
 
     return cg, cg_min, cg_max, volume_elm, area_elm
 
@@ -570,12 +1001,301 @@ def write_inp(file_name, file_nameW, elm_states, number_of_states, domains, doma
         fW.close()
 
 
+# generator of result blocks of .dat file content with header line starting by one of header_starts
+# yields the header line and data of the block, i.e. lines after empty lines below the header until the next empty line
+def dat_blocks(content, header_starts):
+    empty_lines = re.compile(rb"(?:[ \t\r]*\n)+")
+    block_end = re.compile(rb"\n[ \t\r]*(?:\n|$)")
+    next_header = {}  # next position of each header start
+    position = 0
+    while True:
+        for header_start in header_starts:
+            if next_header.get(header_start, position) <= position:
+                next_header[header_start] = content.find(b"\n" + header_start, position)
+        found = [start for start in next_header.values() if start != -1]
+        if not found:
+            return
+        header = min(found) + 1
+        header_end = content.find(b"\n", header)
+        if header_end == -1:
+            header_end = len(content)
+        start = header_end + 1
+        empty = empty_lines.match(content, start)
+        if empty:
+            start = empty.end()
+        if any(content[start:start + len(header_start)] == header_start for header_start in header_starts):
+            end = start  # block without data followed by the next header
+        else:
+            end = block_end.search(content, start)
+            end = end.start() + 1 if end else len(content)
+        yield content[header:header_end].decode(), content[start:end]
+        position = max(end - 1, header_end)
+
+
+# function returning start positions of runs of the same element numbers in array en and the numbers of runs
+def element_runs(en):
+    run_start = np.flatnonzero(np.concatenate([[True], en[1:] != en[:-1]])) if len(en) else np.zeros(0, dtype=int)
+    return run_start, en[run_start]
+
+
+# names of stress components usable in "user_def" failure criteria (aliases of the symmetric components included)
+stress_names = ["sxx", "syy", "szz", "sxy", "sxz", "syz", "syx", "szx", "szy"]
+# functions usable in "user_def" failure criteria, they are evaluated elementwise over arrays of stress components
+criteria_functions = {"abs": np.abs, "sqrt": np.sqrt, "exp": np.exp, "log": np.log,
+                      "max": lambda *values: functools.reduce(np.maximum, values),
+                      "min": lambda *values: functools.reduce(np.minimum, values)}
+
+
+# function compiling failure criteria once, "user_def" expressions are parsed and checked that they use only stress
+# names, numbers, arithmetic and functions of criteria_functions or numpy ufuncs (np.name)
+# returns list of criteria where expressions of "user_def" criteria are replaced by their code objects
+def compile_criteria(criteria, file_name):
+    allowed_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Attribute, ast.Constant,
+                     ast.Load, ast.operator, ast.unaryop)
+    criteria_compiled = []
+    for criterion in criteria:
+        if criterion[0] != "user_def":
+            criteria_compiled.append(criterion)
+            continue
+        msg = ""
+        try:
+            tree = ast.parse(str(criterion[1]).strip(), mode="eval")
+        except SyntaxError as error:
+            tree = None
+            msg = "syntax error " + str(error)
+        for node in ast.walk(tree) if tree else []:
+            if not isinstance(node, allowed_nodes):
+                msg = type(node).__name__ + " is not allowed"
+            elif isinstance(node, ast.Name) and node.id not in stress_names + list(criteria_functions) + ["np"]:
+                msg = "name " + node.id + " is not allowed, use " + ", ".join(stress_names)
+            elif isinstance(node, ast.Attribute) and not (isinstance(node.value, ast.Name) and node.value.id == "np"
+                                                          and isinstance(getattr(np, node.attr, None), np.ufunc)):
+                msg = "only numpy ufuncs as np.name are allowed"
+            elif isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                msg = "constant " + repr(node.value) + " is not allowed"
+            elif isinstance(node, ast.Call) and (node.keywords or isinstance(node.func, ast.Name) and
+                                                 node.func.id not in criteria_functions):
+                msg = "only functions " + ", ".join(criteria_functions) + " and np ufuncs can be called"
+            if msg:
+                break
+        if msg:
+            msg = "failure criterion " + str(criterion) + " is not valid: " + msg
+            write_to_log(file_name, "\nERROR: " + msg + "\n")
+            raise Exception(msg)
+        criteria_compiled.append(("user_def", compile(tree, "user_def", "eval")))
+    return criteria_compiled
+
+
+# function computing failure indices of compiled criteria at points with stress components in columns of stress array
+# (sxx, syy, szz, sxy, sxz, syz), each criterion is evaluated only at points where point_applied is True
+# returns list of arrays for criteria (nan at other points), None for a criterion which is not recognised or not applied
+def failure_indices(criteria_compiled, stress, point_applied, file_name):
+    FI = []
+    for FIn, criterion in enumerate(criteria_compiled):
+        if criterion[0] not in ["stress_von_Mises", "user_def"]:
+            msg = "\nError: failure criterion " + str(criterion) + " not recognised.\n"
+            write_to_log(file_name, msg)
+            FI.append(None)
+            continue
+        points = np.flatnonzero(point_applied[:, FIn])
+        if not len(points):  # no element of these points uses the criterion
+            FI.append(None)
+            continue
+        [sxx, syy, szz, sxy, sxz, syz] = (stress if len(points) == len(stress) else stress[points]).T
+        if criterion[0] == "stress_von_Mises":
+            s_allowable = criterion[1]
+            FI_applied = np.sqrt(0.5 * ((sxx - syy) ** 2 + (syy - szz) ** 2 + (szz - sxx) ** 2 +
+                                        6 * (sxy ** 2 + syz ** 2 + sxz ** 2))) / s_allowable
+        else:
+            variables = dict(criteria_functions, np=np, sxx=sxx, syy=syy, szz=szz, sxy=sxy, sxz=sxz, syz=syz, syx=sxy,
+                             szx=sxz, szy=syz)
+            FI_applied = np.zeros(len(points)) + eval(criterion[1], {"__builtins__": {}}, variables)
+        FI.append(np.full(len(stress), np.nan))
+        FI[-1][points] = FI_applied
+    return FI
+
+
+# function returning sorted array of elements with criteria and boolean table of their applied criteria
+def criteria_table(criteria_elm, number_of_criteria):
+    criteria_numbers = np.array(sorted(criteria_elm), dtype=np.int64)
+    criteria_applied = np.zeros((len(criteria_numbers), number_of_criteria), dtype=bool)
+    for row, en in enumerate(criteria_numbers.tolist()):
+        criteria_applied[row, criteria_elm[en]] = True
+    return criteria_numbers, criteria_applied
+
+
+# function returning boolean table of criteria applied at points of elements point_en, points of each element in one run
+def point_criteria(point_en, criteria_numbers, criteria_applied):
+    [run_start, run_en] = element_runs(point_en)
+    rows = np.searchsorted(criteria_numbers, run_en)
+    found = rows < len(criteria_numbers)
+    found[found] = criteria_numbers[rows[found]] == run_en[found]
+    run_applied = np.zeros((len(run_en), criteria_applied.shape[1]), dtype=bool)
+    run_applied[found] = criteria_applied[rows[found]]
+    return np.repeat(run_applied, np.diff(np.append(run_start, len(point_en))), axis=0)
+
+
+# function reducing failure indices at points (integration points or nodes) of elements point_en, points of each element
+# in one run, to the maximum or average over each element
+# returns elements with criteria and array of their FI (nan for criteria which are not applied)
+def element_FI(reference_value, FI_points, point_en, criteria_numbers, criteria_applied):
+    [run_start, run_en] = element_runs(point_en)
+    run_end = np.append(run_start[1:], len(point_en))
+    rows = np.searchsorted(criteria_numbers, run_en)
+    found = rows < len(criteria_numbers)
+    found[found] = criteria_numbers[rows[found]] == run_en[found]
+    FI_elm = np.full((len(run_en), len(FI_points)), np.nan)
+    for FIn, FI in enumerate(FI_points):
+        if FI is None or not len(run_en):
+            continue
+        if reference_value == "max":
+            FI_reduced = np.maximum.reduceat(FI, run_start)
+        elif reference_value == "average":
+            FI_reduced = np.add.reduceat(FI, run_start) / (run_end - run_start)
+        else:
+            continue
+        applied = found.copy()
+        applied[found] = criteria_applied[rows[found], FIn]
+        FI_elm[applied, FIn] = FI_reduced[applied]
+    return run_en[found], FI_elm[found]
+
+
+# results of all steps as lists for steps of dicts
+# FI_step = [{en1: list for criteria FI (None for criteria which are not applied), en2: [], ...}, next step]
+# energy_density_step = [{en1: energy_density, en2: ..., ...}, next step]
+class StepResults(object):
+    def __init__(self):
+        self.FI_step = []
+        self.energy_density_step = []
+
+    def new_step(self):
+        self.FI_step.append({})
+        self.energy_density_step.append({})
+
+    def add_FI(self, en, FI):
+        FI_elm = FI.astype(object)
+        FI_elm[np.isnan(FI)] = None
+        self.FI_step[-1].update(zip(en.tolist(), FI_elm.tolist()))
+
+    def add_energy_density(self, en, energy_density):
+        self.energy_density_step[-1].update(zip(en.tolist(), energy_density.tolist()))
+
+    def results(self):
+        return self.FI_step, self.energy_density_step
+
+
+# results of steps folded to maxima over steps as each step is read, memory does not grow with the number of steps
+# results are returned in the layout of StepResults as if there was only one step, elements missing in some step are
+# left out as they would miss in the step of StepResults
+class StepMaxima(object):
+    def __init__(self, numbers, number_of_criteria):
+        self.steps = 0
+        self.FI = NumberedArray(numbers, np.full((len(numbers), number_of_criteria), np.nan))
+        self.energy_density = np.full(len(numbers), -np.inf)
+        self.FI_count = np.zeros(len(numbers), dtype=np.int32)  # number of steps with results of the element
+        self.energy_density_count = np.zeros(len(numbers), dtype=np.int32)
+        self.FI_last = np.full(len(numbers), -1, dtype=np.int32)  # the last step with results of the element
+        self.energy_density_last = np.full(len(numbers), -1, dtype=np.int32)
+
+    def new_step(self):
+        self.steps += 1
+
+    # function returning rows of stored elements among en and counting the actual step for them
+    def _count(self, en, count, last):
+        rows = self.FI.rows(en)
+        taken = rows >= 0
+        rows = rows[taken]
+        count[rows[last[rows] != self.steps]] += 1
+        last[rows] = self.steps
+        return rows, taken
+
+    def add_FI(self, en, FI):
+        [rows, taken] = self._count(en, self.FI_count, self.FI_last)
+        np.fmax.at(self.FI.array, rows, FI[taken])  # nan of criteria which are not applied is kept only if all are nan
+
+    def add_energy_density(self, en, energy_density):
+        [rows, taken] = self._count(en, self.energy_density_count, self.energy_density_last)
+        np.maximum.at(self.energy_density, rows, energy_density[taken])
+
+    def results(self):
+        if not self.steps:
+            return [], []
+        complete = self.FI_count == self.steps
+        FI_elm = self.FI.array[complete].astype(object)
+        FI_elm[np.isnan(self.FI.array[complete])] = None
+        FI_max = dict(zip(self.FI.numbers[complete].tolist(), FI_elm.tolist()))
+        complete = self.energy_density_count == self.steps
+        energy_density_max = dict(zip(self.FI.numbers[complete].tolist(), self.energy_density[complete].tolist()))
+        return [FI_max], [energy_density_max]
+
+
+# function returning coefficients of steps_superposition as matrix (superposed steps, memorized steps), boolean matrix
+# of memorized steps used in superposed steps and list of memorized steps (0 based)
+def superposition_matrix(steps_superposition):
+    memorized = sorted(set(sn - 1 for combination in steps_superposition for (scale, sn) in combination))
+    coefficients = np.zeros((len(steps_superposition), len(memorized)))
+    used = np.zeros(coefficients.shape, dtype=bool)
+    for LCn, combination in enumerate(steps_superposition):
+        for (scale, sn) in combination:
+            coefficients[LCn, memorized.index(sn - 1)] += scale
+            used[LCn, memorized.index(sn - 1)] = True
+    return coefficients, used, memorized
+
+
+# function aligning points of memorized steps given as lists of blocks (element numbers of points, values of points)
+# points of an element are identified by order in which they appear, a point missing in a step has zero values
+# returns element numbers of points (points of each element in one run), array of values (steps, points, columns)
+# and boolean array of points present in steps (steps, points)
+def align_points(step_blocks, columns):
+    steps = []
+    for blocks in step_blocks:
+        point_en = np.concatenate([np.zeros(0, dtype=np.int64)] + [block[0] for block in blocks])
+        values = np.concatenate([np.zeros((0, columns))] + [block[1].reshape(-1, columns) for block in blocks])
+        steps.append((point_en, values))
+    run_en = element_runs(steps[0][0])[1] if steps else np.zeros(0, dtype=np.int64)
+    if all(np.array_equal(steps[0][0], point_en) for (point_en, values) in steps) and \
+            len(np.unique(run_en)) == len(run_en):  # the same points in all steps
+        return steps[0][0], np.stack([values for (point_en, values) in steps]), \
+            np.ones((len(steps), len(steps[0][0])), dtype=bool)
+    keys = []  # element number * points_max + order of the point in the element
+    for (point_en, values) in steps:
+        order = np.argsort(point_en, kind="stable")
+        run_start = element_runs(point_en[order])[0]
+        point_order = np.arange(len(point_en)) - np.repeat(run_start, np.diff(np.append(run_start, len(point_en))))
+        keys.append((point_en[order], point_order, order))
+    points_max = max([int(point_order.max()) + 1 for (point_en, point_order, order) in keys if len(point_order)] + [1])
+    keys = [(point_en * points_max + point_order, order) for (point_en, point_order, order) in keys]
+    all_keys = np.unique(np.concatenate([key for (key, order) in keys]))
+    aligned = np.zeros((len(steps), len(all_keys), columns))
+    present = np.zeros((len(steps), len(all_keys)), dtype=bool)
+    for sn, (key, order) in enumerate(keys):
+        rows = np.searchsorted(all_keys, key)
+        aligned[sn, rows] = steps[sn][1][order]
+        present[sn, rows] = True
+    return all_keys // points_max, aligned, present
+
+
+# generator of superposed steps computed by tensordot of coefficients with values of memorized steps (steps, points,
+# components) in chunks of about chunk_size values, yields values at points (points, components) of each superposed
+# step and boolean array of points present in some of memorized steps used by the superposed step
+def superposed_steps(coefficients, used, step_values, step_present, chunk_size=2**24):
+    chunk = max(1, chunk_size // max(step_values[0].size if len(step_values) else 0, 1))
+    for first in range(0, len(coefficients), chunk):
+        values = np.tensordot(coefficients[first:first + chunk], step_values, axes=1)
+        present = np.dot(used[first:first + chunk], step_present)
+        for LCn in range(len(values)):
+            yield values[LCn], present[LCn]
+
+
 # function for importing results from .dat file
 # Failure Indices are computed at each integration point and maximum or average above each element is returned
+# stress and energy density blocks are parsed at once to arrays and reduced over runs of integration points of elements
 def import_FI_int_pt(reference_value, file_nameW, domains, criteria, domain_FI, file_name, elm_states,
-                     domains_from_config, steps_superposition):
+                     domains_from_config, steps_superposition, criteria_compiled=None, stream_steps=False):
+    if criteria_compiled is None:
+        criteria_compiled = compile_criteria(criteria, file_name)
     try:
-        f = open(file_nameW + ".dat", "r")
+        f = open(file_nameW + ".dat", "rb")
     except IOError:
         msg = "CalculiX result file not found, check your inputs"
         write_to_log(file_name, "\nERROR: " + msg + "\n")
@@ -583,19 +1303,12 @@ def import_FI_int_pt(reference_value, file_nameW, domains, criteria, domain_FI,
     last_time = "initial"  # TODO solve how to read a new step which differs in time
     step_number = -1
     criteria_elm = {}  # {en1: numbers of applied criteria, en2: [], ...}
-    FI_step = []  # list for steps - [{en1: list for criteria FI, en2: [], ...}, {en1: [], en2: [], ...}, next step]
-    energy_density_step = []  # list for steps - [{en1: energy_density, en2: ..., ...}, {en1: ..., ...}, next step]
 
-    memorized_steps = set()  # steps to use in superposition
-    if steps_superposition:
-        step_stress = {}  # {sn: {en: [sxx, syy, szz, sxy, sxz, syz], next element with int. pt. stresses}, next step, ...}
-        step_ener = {}  # energy density {sn: {en: ener, next element with int. pt. stresses}, next step, ...}
-        for LCn in range(len(steps_superposition)):
-            for (scale, sn) in steps_superposition[LCn]:
-                sn -= 1  # step numbering in CalculiX is from 1, but we have it 0 based
-                memorized_steps.add(sn)
-                step_stress[sn] = {}
-                step_ener[sn] = {}
+    # steps to use in superposition, step numbering in CalculiX is from 1, but we have it 0 based
+    [coefficients, used, memorized] = superposition_matrix(steps_superposition)
+    memorized_steps = set(memorized)
+    step_stress = {sn: [] for sn in memorized}  # {sn: [(element numbers of int. pt., stress (int. pt., 6)), ...], ...}
+    step_ener = {sn: [] for sn in memorized}  # energy density {sn: [(element numbers of int. pt., energy), ...], ...}
 
     # prepare FI dict from failure criteria
     for dn in domain_FI:
@@ -605,192 +1318,165 @@ def import_FI_int_pt(reference_value, file_nameW, domains, criteria, domain_FI,
                 cr.append(criteria.index(dn_crit))
             criteria_elm[en] = cr
 
-    def compute_FI():  # for the actual integration point
-        for FIn in criteria_elm[en]:
-            if criteria[FIn][0] == "stress_von_Mises":
-                s_allowable = criteria[FIn][1]
-                FI_int_pt[FIn].append(np.sqrt(0.5 * ((sxx - syy) ** 2 + (syy - szz) ** 2 + (szz - sxx) ** 2 +
-                                                     6 * (sxy ** 2 + syz ** 2 + sxz ** 2))) / s_allowable)
-            elif criteria[FIn][0] == "user_def":
-                FI_int_pt[FIn].append(eval(criteria[FIn][1]))
-            else:
-                msg = "\nError: failure criterion " + str(criteria[FIn]) + " not recognised.\n"
-                write_to_log(file_name, msg)
+    [criteria_numbers, criteria_applied] = criteria_table(criteria_elm, len(criteria))
+    if stream_steps:
+        step_results = StepMaxima(criteria_numbers, len(criteria))
+    else:
+        step_results = StepResults()
 
-    def save_FI(sn, en):
-        FI_step[sn][en] = []
-        for FIn in range(len(criteria)):
-            FI_step[sn][en].append(None)
-            if FIn in criteria_elm[en]:
-                if reference_value == "max":
-                    FI_step[sn][en][FIn] = max(FI_int_pt[FIn])
-                elif reference_value == "average":
-                    FI_step[sn][en][FIn] = np.average(FI_int_pt[FIn])
-
-    read_stresses = 0
-    read_energy_density = 0
-    for line in f:
-        line_split = line.split()
-        if line.replace(" ", "") == "\n":
-            if read_stresses == 1:
-                save_FI(step_number, en_last)
-            if read_energy_density == 1:
-                energy_density_step[step_number][en_last] = np.average(ener_int_pt)
-            read_stresses -= 1
-            read_energy_density -= 1
-            FI_int_pt = [[] for _ in range(len(criteria))]
-            ener_int_pt = []
-            en_last = None
-
-        elif line[:9] == " stresses":
-            if line.split()[-4] in map(lambda x: x.upper(), domains_from_config):  # TODO upper already on user input
-                read_stresses = 2
-                if last_time != line_split[-1]:
-                    step_number += 1
-                    FI_step.append({})
-                    energy_density_step.append({})
-                    last_time = line_split[-1]
-        elif line[:24] == " internal energy density":
-            if line.split()[-4] in map(lambda x: x.upper(), domains_from_config):  # TODO upper already on user input
-                read_energy_density = 2
-                if last_time != line_split[-1]:
-                    step_number += 1
-                    FI_step.append({})
-                    energy_density_step.append({})
-                    last_time = line_split[-1]
-
-        elif read_stresses == 1:
-            en = int(line_split[0])
-            if en_last != en:
-                if en_last:
-                    save_FI(step_number, en_last)
-                    FI_int_pt = [[] for _ in range(len(criteria))]
-                en_last = en
-            sxx = float(line_split[2])
-            syy = float(line_split[3])
-            szz = float(line_split[4])
-            sxy = float(line_split[5])
-            sxz = float(line_split[6])
-            syz = float(line_split[7])
-            syx = sxy
-            szx = sxz
-            szy = syz
-            compute_FI()
+    domains_upper = set(dn.upper() for dn in domains_from_config)
+    content = file_content(f)
+    for [header, data] in dat_blocks(content, [b" stresses", b" internal energy density"]):
+        header_split = header.split()
+        if header_split[-4] not in domains_upper:
+            continue
+        if last_time != header_split[-1]:
+            step_number += 1
+            step_results.new_step()
+            last_time = header_split[-1]
+        values = parse_block(data, np.float64)
+        columns = 8 if header[:9] == " stresses" else 3
+        if values is None or len(values) % columns:
+            msg = "Unexpected data in the block of " + file_nameW + ".dat with header " + header.strip()
+            write_to_log(file_name, "\nERROR: " + msg + "\n")
+            raise Exception(msg)
+        values = values.reshape(-1, columns)
+        point_en = values[:, 0].astype(np.int64)
+        [run_start, run_en] = element_runs(point_en)
+        run_end = np.append(run_start[1:], len(values))
+
+        if columns == 8:  # stresses
+            stress = values[:, 2:8]
+            point_applied = point_criteria(point_en, criteria_numbers, criteria_applied)
+            step_results.add_FI(*element_FI(reference_value,
+                                            failure_indices(criteria_compiled, stress, point_applied, file_name),
+                                            point_en, criteria_numbers, criteria_applied))
             if step_number in memorized_steps:
-                try:
-                    step_stress[step_number][en]
-                except KeyError:
-                    step_stress[step_number][en] = []
-                step_stress[step_number][en].append([sxx, syy, szz, sxy, sxz, syz])
-
-        elif read_energy_density == 1:
-            en = int(line_split[0])
-            if en_last != en:
-                if en_last:
-                    energy_density_step[step_number][en_last] = np.average(ener_int_pt)
-                    ener_int_pt = []
-                en_last = en
-            energy_density = float(line_split[2])
-            ener_int_pt.append(energy_density)
+                step_stress[step_number].append((point_en, stress))
+
+        else:  # internal energy density
+            energy_density = np.add.reduceat(values[:, 2], run_start) / (run_end - run_start)
+            step_results.add_energy_density(run_en, energy_density)
             if step_number in memorized_steps:
-                try:
-                    step_ener[step_number][en]
-                except KeyError:
-                    step_ener[step_number][en] = []
-                    step_ener[step_number][en].append(energy_density)
-    if read_stresses == 1:
-        save_FI(step_number, en_last)
-    if read_energy_density == 1:
-        energy_density_step[step_number][en_last] = np.average(ener_int_pt)
+                step_ener[step_number].append((point_en, values[:, 2]))
+    close_content(content)
     f.close()
 
-    # superposed steps
-    # step_stress = {sn: {en: [[sxx, syy, szz, sxy, sxz, syz], next integration point], next element with int. pt. stresses}, next step, ...}
-    # steps_superposition = [[(sn, scale), next scaled step to add, ...], next superposed step]
-    for LCn in range(len(steps_superposition)):
-        FI_step.append({})
-        energy_density_step.append({})
-
-        # sum scaled stress components at each integration point
-        superposition_stress = {}
-        superposition_energy_density = {}
-        for (scale, sn) in steps_superposition[LCn]:
-            sn -= 1  # step numbering in CalculiX is from 1, but we have it 0 based
-            # with stresses
-            for en in step_stress[sn]:
-                try:
-                    superposition_stress[en]
-                except KeyError:
-                    superposition_stress[en] = []  # list of integration points
-                for ip in range(len(step_stress[sn][en])):
-                    try:
-                        superposition_stress[en][ip]
-                    except IndexError:
-                        superposition_stress[en].append([0, 0, 0, 0, 0, 0])  # components of stress
-                    for component in range(6):
-                        superposition_stress[en][ip][component] += scale * step_stress[sn][en][ip][component]
-            # again with energy density
-            for en in step_ener[sn]:
-                try:
-                    superposition_energy_density[en]
-                except KeyError:
-                    superposition_energy_density[en] = []  # list of integration points
-                for ip in range(len(step_ener[sn][en])):
-                    try:
-                        superposition_energy_density[en][ip]
-                    except IndexError:
-                        superposition_energy_density[en].append(0)  # components of stress
-                    for component in range(6):
-                        superposition_energy_density[en][ip] += scale * step_ener[sn][en][ip]
-
-        # compute FI in each element at superposed step
-        for en in superposition_stress:
-            FI_int_pt = [[] for _ in range(len(criteria))]
-            for ip in range(len(superposition_stress[en])):
-                sxx = superposition_stress[en][ip][0]
-                syy = superposition_stress[en][ip][1]
-                szz = superposition_stress[en][ip][2]
-                sxy = superposition_stress[en][ip][3]
-                sxz = superposition_stress[en][ip][4]
-                syz = superposition_stress[en][ip][5]
-                syx = sxy
-                szx = sxz
-                szy = syz
-                compute_FI()  # fill FI_int_pt
-            sn = -1  # last step number
-            save_FI(sn, en)  # save value to FI_step for given en
-        # compute average energy density over integration point at superposed step
-        for en in superposition_energy_density:
-            ener_int_pt = []
-            for ip in range(len(superposition_energy_density[en])):
-                ener_int_pt.append(superposition_energy_density[en][ip])
-            sn = -1  # last step number
-            energy_density_step[sn][en] = np.average(ener_int_pt)
-
-    return FI_step, energy_density_step
+    # superposed steps as sums of scaled stress components and energy densities at each integration point
+    # steps_superposition = [[(scale, sn), next scaled step to add, ...], next superposed step]
+    if steps_superposition:
+        [point_en, stress, stress_present] = align_points([step_stress[sn] for sn in memorized], 6)
+        [energy_en, energy, energy_present] = align_points([step_ener[sn] for sn in memorized], 1)
+        superposed_energy = superposed_steps(coefficients, used, energy, energy_present)
+        for [superposed_stress, present] in superposed_steps(coefficients, used, stress, stress_present):
+            step_results.new_step()
+            # compute FI in each element at superposed step
+            point_applied = point_criteria(point_en[present], criteria_numbers, criteria_applied)
+            FI_points = failure_indices(criteria_compiled, superposed_stress[present], point_applied, file_name)
+            step_results.add_FI(*element_FI(reference_value, FI_points,
+                                            point_en[present], criteria_numbers, criteria_applied))
+            # compute average energy density over integration points at superposed step
+            [superposed_energy_density, present] = next(superposed_energy)
+            [run_start, run_en] = element_runs(energy_en[present])
+            if len(run_en):
+                run_end = np.append(run_start[1:], np.count_nonzero(present))
+                energy_density = np.add.reduceat(superposed_energy_density[present, 0], run_start) / (run_end - run_start)
+                step_results.add_energy_density(run_en, energy_density)
+
+    return step_results.results()
+
+
+# generator of blocks of .frd file content, yields name of the block ("3C" for the elements or name of the result
+# block given in names as b"STRESS") and data of the block, i.e. its -1 and -2 records up to the block end -3
+def frd_blocks(content, names):
+    header_starts = [b"    3C"] + [b" -4  " + name + b" " for name in names]
+    next_header = {}  # next position of each header start
+    position = 0
+    while True:
+        for header_start in header_starts:
+            if next_header.get(header_start, position) <= position:
+                next_header[header_start] = content.find(b"\n" + header_start, position)
+        found = [(start, header_start) for (header_start, start) in next_header.items() if start != -1]
+        if not found:
+            return
+        [header, header_start] = min(found)
+        start = content.find(b"\n -1", header + 1) + 1
+        end = content.find(b"\n -3", header + 1) + 1
+        if end == 0:  # unfinished block
+            return
+        if start == 0 or start > end:  # block without records
+            start = end
+        yield header_start.split()[-1].decode(), content[start:end]
+        position = end
+
+
+# function returning element and node pairs of elements from the 3C block data of .frd file, only elements in array
+# elements are taken, nodes of each element are in one run
+def frd_element_nodes(data, elements):
+    numbers = parse_block(data, np.int64)  # -1 en type group material -2 nn nn ... -2 nn ... -1 en ...
+    if numbers is None:
+        return None
+    positions = np.arange(len(numbers))
+    record = np.maximum.accumulate(np.where(numbers < 0, positions, 0))  # position of the last record start
+    is_node = (numbers > 0) & (numbers[record] == -2)
+    element_record = np.maximum.accumulate(np.where(numbers == -1, positions, 0))  # position of the last -1
+    pair_en = numbers[np.minimum(element_record + 1, len(numbers) - 1)][is_node]
+    pair_nn = numbers[is_node]
+    take = np.isin(pair_en, elements)
+    return pair_en[take], pair_nn[take]
+
+
+# function returning node numbers and values of -1 records of a result block data of .frd file, records have fixed width
+# columns: node number [3:13] and values by 12 characters, which need not be separated by spaces
+def frd_node_values(data, number_of_values):
+    record_length = 13 + 12 * number_of_values
+    chars = np.frombuffer(data, dtype=np.uint8)
+    line_ends = np.flatnonzero(chars == ord("\n"))
+    line_length = line_ends[0] + 1 if len(line_ends) else 0
+    if line_length > record_length and len(chars) == line_length * len(line_ends) and \
+            np.all(line_ends == np.arange(line_length - 1, len(chars), line_length)):
+        lines = chars.reshape(-1, line_length)
+        fields = np.full((len(lines), 1 + number_of_values, 13), ord(" "), dtype=np.uint8)  # fields with a space
+        fields[:, 0, :10] = lines[:, 3:13]
+        fields[:, 1:, :12] = lines[:, 13:record_length].reshape(len(lines), number_of_values, 12)
+        values = parse_block(fields.tobytes(), np.float64)
+        if values is not None and len(values) == len(lines) * (1 + number_of_values) and \
+                np.all(lines[:, :3] == np.frombuffer(b" -1", dtype=np.uint8)):
+            values = values.reshape(len(lines), 1 + number_of_values)
+            return values[:, 0].astype(np.int64), values[:, 1:]
+    # lines of different lengths
+    node_numbers = []
+    node_values = []
+    try:
+        for line in data.splitlines():
+            if line[:3] == b" -1":
+                node_numbers.append(int(line[3:13]))
+                node_values.append([float(line[13 + 12 * k:25 + 12 * k]) for k in range(number_of_values)])
+    except ValueError:
+        return None
+    return np.array(node_numbers, dtype=np.int64), np.array(node_values, dtype=float).reshape(-1, number_of_values)
 
 
 # function for importing results from .frd file
 # Failure Indices are computed at each node and maximum or average above each element is returned
+# stress blocks are read in bulk to arrays, nodes are mapped to elements by element and node pairs from the mesh block
 def import_FI_node(reference_value, file_nameW, domains, criteria, domain_FI, file_name, elm_states,
-                   steps_superposition):
+                   steps_superposition, criteria_compiled=None, stream_steps=False):
+    if criteria_compiled is None:
+        criteria_compiled = compile_criteria(criteria, file_name)
     try:
-        f = open(file_nameW + ".frd", "r")
+        f = open(file_nameW + ".frd", "rb")
     except IOError:
         msg = "CalculiX result file not found, check your inputs"
         write_to_log(file_name, "\nERROR: " + msg + "\n")
         assert False, msg
 
-    memorized_steps = set()  # steps to use in superposition
-    if steps_superposition:
-        step_stress = {}  #{sn: {en: [sxx, syy, szz, sxy, sxz, syz], next element with int. pt. stresses}, next step, ...}
-        for LCn in range(len(steps_superposition)):
-            for (scale, sn) in steps_superposition[LCn]:
-                sn -= 1  # step numbering in CalculiX is from 1, but we have it 0 based
-                memorized_steps.add(sn)
-                step_stress[sn] = {}
-
-    # prepare ordered elements of interest and failure criteria for each element
+    # steps to use in superposition, step numbering in CalculiX is from 1, but we have it 0 based
+    [coefficients, used, memorized] = superposition_matrix(steps_superposition)
+    memorized_steps = set(memorized)
+    step_stress = {}  # {sn: (stress array at element and node pairs, pairs with read stress), next step, ...}
+
+    # prepare elements of interest and failure criteria for each element
     criteria_elm = {}
     for dn in domain_FI:
         for en in domains[dn]:
@@ -798,178 +1484,124 @@ def import_FI_node(reference_value, file_nameW, domains, criteria, domain_FI, fi
             for dn_crit in domain_FI[dn][elm_states[en]]:
                 cr.append(criteria.index(dn_crit))
             criteria_elm[en] = cr
-    sorted_elements = sorted(criteria_elm.keys())  # [en_lowest, ..., en_highest]
-
-    def compute_FI():  # for the actual node
-        for FIn in criteria_elm[en]:
-            if criteria[FIn][0] == "stress_von_Mises":
-                s_allowable = criteria[FIn][1]
-                FI_node[nn][FIn] = np.sqrt(0.5 * ((sxx - syy) ** 2 + (syy - szz) ** 2 + (szz - sxx) ** 2 +
-                                                  6 * (sxy ** 2 + syz ** 2 + sxz ** 2))) / s_allowable
-            elif criteria[FIn][0] == "user_def":
-                FI_node[nn][FIn] = eval(criteria[FIn][1])
-            else:
-                msg = "\nError: failure criterion " + str(criteria[FIn]) + " not recognised.\n"
-                write_to_log(file_name, msg)
+    [criteria_numbers, criteria_applied] = criteria_table(criteria_elm, len(criteria))
+    if stream_steps:
+        step_results = StepMaxima(criteria_numbers, len(criteria))
+    else:
+        step_results = StepResults()
+
+    # function computing FI at element and node pairs with read stress and reducing them over elements
+    def save_FI(stress, read):
+        point_applied = point_criteria(pair_en[read], criteria_numbers, criteria_applied)
+        step_results.add_FI(*element_FI(reference_value,
+                                        failure_indices(criteria_compiled, stress[read], point_applied, file_name),
+                                        pair_en[read], criteria_numbers, criteria_applied))
 
-    def save_FI(sn, en):
-        FI_step[sn][en] = []
-        for FIn in range(len(criteria)):
-            FI_step[sn][en].append(None)
-            if FIn in criteria_elm[en]:
-                if reference_value == "max":
-                    FI_step[sn][en][FIn] = max(FI_elm[en][FIn])
-                elif reference_value == "average":
-                    FI_step[sn][en][FIn] = np.average(FI_elm[en][FIn])
-
-    read_mesh = False
-    frd_nodes = {}  # en associated to given node
-    elm_nodes = {}
-    for en in sorted_elements:
-        elm_nodes[en] = []
-    read_stress = False
+    pair_en = np.zeros(0, dtype=np.int64)  # element and node pairs, nodes of each element in one run
+    pair_nn = np.zeros(0, dtype=np.int64)
     sn = -1
-    FI_step = []  # list for steps - [{en1: list for criteria FI, en2: [], ...}, {en1: [], en2: [], ...}, next step]
-    for line in f:
-        # reading mesh
-        if line[:6] == "    3C":
-            read_mesh = True
-        elif read_mesh is True:
-            if line[:3] == " -1":
-                en = int(line[3:13])
-                if en == sorted_elements[0]:
-                    sorted_elements.pop(0)
-                    read_elm_nodes = True
-                else:
-                    read_elm_nodes = False
-            elif line[:3] == " -2" and read_elm_nodes is True:
-                associated_nn = list(map(int, line.split()[1:]))
-                elm_nodes[en] += associated_nn
-                for nn in associated_nn:
-                    frd_nodes[nn] = en
-
-        # block end
-        if line[:3] == " -3":
-            if read_mesh is True:
-                read_mesh = False
-                frd_nodes_sorted = sorted(frd_nodes.items())  # [(nn, en), ...]
-            elif read_stress is True:
-                read_stress = False
-                FI_elm = {}
-                for en in elm_nodes:
-                    FI_elm[en] = [[] for _ in range(len(criteria))]
-                    for FIn in criteria_elm[en]:
-                        for nn in elm_nodes[en]:
-                            FI_elm[en][FIn].append(FI_node[nn][FIn])
-                FI_step.append({})
-                for en in FI_elm:
-                    save_FI(sn, en)
-
-        # reading stresses
-        elif line[:11] == " -4  STRESS":
-            read_stress = True
-            sn += 1
-            FI_node = {}
-            for nn in frd_nodes:
-                FI_node[nn] = [[] for _ in range(len(criteria))]
-            next_node = 0
-        elif read_stress is True:
-            if line[:3] == " -1":
-                nn = int(line[3:13])
-                if nn == frd_nodes_sorted[next_node][0]:
-                    next_node += 1
-                    sxx = float(line[13:25])
-                    syy = float(line[25:37])
-                    szz = float(line[37:49])
-                    sxy = float(line[49:61])
-                    syz = float(line[61:73])
-                    szx = float(line[73:85])
-                    syx = sxy
-                    szy = syz
-                    sxz = szx
-                    en = frd_nodes[nn]
-                    compute_FI()
-                    if sn in memorized_steps:
-                        try:
-                            step_stress[sn][en]
-                        except KeyError:
-                            step_stress[sn][en] = {}
-                        step_stress[sn][en][nn] = [sxx, syy, szz, sxy, sxz, syz]
+    content = file_content(f)
+    for [name, data] in frd_blocks(content, [b"STRESS"]):
+        if name == "3C":
+            values = frd_element_nodes(data, criteria_numbers)
+        else:
+            values = frd_node_values(data, 6)
+        if values is None:
+            msg = "Unexpected data in the " + name + " block of " + file_nameW + ".frd"
+            write_to_log(file_name, "\nERROR: " + msg + "\n")
+            raise Exception(msg)
+        if name == "3C":
+            [pair_en, pair_nn] = values
+            continue
+
+        # stress of nodes is gathered to element and node pairs, .frd order sxx, syy, szz, sxy, syz, szx is changed
+        [node_numbers, node_stress] = values
+        order = np.argsort(node_numbers)
+        positions = np.searchsorted(node_numbers, pair_nn, sorter=order)
+        read = positions < len(order)  # pairs with stress of the node read
+        read[read] = node_numbers[order[positions[read]]] == pair_nn[read]
+        stress = np.zeros((len(pair_nn), 6))
+        stress[read] = node_stress[order[positions[read]]][:, [0, 1, 2, 3, 5, 4]]
+        sn += 1
+        step_results.new_step()
+        save_FI(stress, read)
+        if sn in memorized_steps:
+            step_stress[sn] = (stress, read)
+    close_content(content)
     f.close()
 
-    # superposed steps
-    # step_stress = {sn: {en: [[sxx, syy, szz, sxy, sxz, syz], next node], next element with nodal stresses}, next step, ...}
-    # steps_superposition = [[(sn, scale), next scaled step to add, ...], next superposed step]
-    for LCn in range(len(steps_superposition)):
-        FI_step.append({})
-
-        # sum scaled stress components at each integration node
-        superposition_stress = {}
-        for (scale, sn) in steps_superposition[LCn]:
-            sn -= 1  # step numbering in CalculiX is from 1, but we have it 0 based
-            for en in step_stress[sn]:
-                try:
-                    superposition_stress[en]
-                except KeyError:
-                    superposition_stress[en] = {}  # for nodes
-                for nn in elm_nodes[en]:
-                    try:
-                        superposition_stress[en][nn]
-                    except KeyError:
-                        superposition_stress[en][nn] = [0, 0, 0, 0, 0, 0]  # components of stress
-                    for component in range(6):
-                        superposition_stress[en][nn][component] += scale * step_stress[sn][en][nn][component]
-
-        # compute FI in each element at superposed step
-        for en in superposition_stress:
-            FI_node = {}
-            for nn in elm_nodes[en]:
-                FI_node[nn] = [[] for _ in range(len(criteria))]
-                sxx = superposition_stress[en][nn][0]
-                syy = superposition_stress[en][nn][1]
-                szz = superposition_stress[en][nn][2]
-                sxy = superposition_stress[en][nn][3]
-                sxz = superposition_stress[en][nn][4]
-                syz = superposition_stress[en][nn][5]
-                syx = sxy
-                szx = sxz
-                szy = syz
-                compute_FI()  # fill FI_node
-            FI_elm[en] = [[] for _ in range(len(criteria))]
-            for FIn in criteria_elm[en]:
-                for nn in elm_nodes[en]:
-                    FI_elm[en][FIn].append(FI_node[nn][FIn])
-            sn = -1  # last step number
-            save_FI(sn, en)  # save value to FI_step for given en
-
-    return FI_step
+    # superposed steps as sums of scaled stress components at each element and node pair
+    # steps_superposition = [[(scale, sn), next scaled step to add, ...], next superposed step]
+    if steps_superposition:
+        stress = np.zeros((len(memorized), len(pair_nn), 6))
+        read = np.zeros((len(memorized), len(pair_nn)), dtype=bool)
+        for k, sn in enumerate(memorized):
+            if sn in step_stress:
+                [stress[k], read[k]] = step_stress.pop(sn)
+        for [superposed_stress, superposed_read] in superposed_steps(coefficients, used, stress, read):
+            step_results.new_step()
+            save_FI(superposed_stress, superposed_read)
+
+    return step_results.results()[0]
+
+
+# function returning sorted element numbers of domains and array of their domain labels (order in domains_from_config)
+# an element listed in more domains gets the label of the last one
+def domain_labels(domains, domains_from_config):
+    domain_elements = [np.asarray(domains[dn], dtype=np.int64) for dn in domains_from_config]
+    elm_numbers = np.unique(np.concatenate([np.zeros(0, dtype=np.int64)] + domain_elements))
+    elm_domain = np.zeros(len(elm_numbers), dtype=np.int32)
+    for dno, en in enumerate(domain_elements):
+        elm_domain[np.searchsorted(elm_numbers, en)] = dno
+    return elm_numbers, elm_domain
+
+
+# function returning values of domains for states (e.g. domain_density) as array (domains, states), nan for missing
+def domain_state_table(domain_values, domains_from_config, number_of_states):
+    table = np.full((len(domains_from_config), number_of_states), np.nan)
+    for dno, dn in enumerate(domains_from_config):
+        values = list(domain_values[dn])[:number_of_states]
+        table[dno, :len(values)] = values
+    return table
+
+
+# function returning masses of elements in all states as array (elements, states), rows of elm_numbers
+# mass is density * area * thickness for shells, density * volume for volume elements and zero for other elements,
+# nan for states which are not defined in the domain of the element
+def mass_table(elm_numbers, elm_domain, density_table, thickness_table, area_elm, volume_elm):
+    elm_shell = np.array([en in area_elm for en in elm_numbers], dtype=bool)
+    elm_measure = np.array([area_elm[en] if en in area_elm else volume_elm.get(en, 0.0) for en in elm_numbers])
+    thickness = np.where(elm_shell[:, np.newaxis], thickness_table[elm_domain], 1.0)
+    return density_table[elm_domain] * thickness * elm_measure[:, np.newaxis]
+
+
+# function returning arrays of failure indices (steps, elements, criteria) and energy densities (steps, elements) of
+# elements elm_numbers from results of steps, None values are nan, KeyError is raised for missing elements
+def step_arrays(FI_step, energy_density_step, elm_numbers, number_of_criteria):
+    FI = np.full((len(FI_step), len(elm_numbers), number_of_criteria), np.nan)
+    for sn, FI_elm in enumerate(FI_step):
+        FI[sn] = np.array([FI_elm[en] for en in elm_numbers], dtype=float).reshape(-1, number_of_criteria)
+    energy_density = None
+    if energy_density_step is not None:
+        energy_density = np.array([[energy_density_elm[en] for en in elm_numbers]
+                                   for energy_density_elm in energy_density_step], dtype=float)
+    return FI, energy_density
 
 
 # function for switch element states
-def switching(elm_states, domains_from_config, domain_optimized, domains, FI_step_max, domain_density, domain_thickness,
-              domain_shells, area_elm, volume_elm, sensitivity_number, mass, mass_referential, mass_addition_ratio,
-              mass_removal_ratio, compensate_state_filter, mass_excess, decay_coefficient, FI_violated, i_violated, i,
-              mass_goal_i, domain_same_state):
+# elm_mass is NumberedArray of element masses in all states (elements, states), see mass_table
+def switching(elm_states, domains_from_config, domain_optimized, domains, FI_step_max, domain_density, elm_mass,
+              sensitivity_number, mass, mass_referential, mass_addition_ratio, mass_removal_ratio,
+              compensate_state_filter, mass_excess, decay_coefficient, FI_violated, i_violated, i, mass_goal_i,
+              domain_same_state):
 
     def compute_difference(failing=False):
-        if en in domain_shells[dn]:  # shells mass difference
-            mass[i] += area_elm[en] * domain_density[dn][elm_states[en]] * domain_thickness[dn][elm_states[en]]
-            if (failing is False) and (elm_states[en] != 0):  # for potential switching down
-                mass_decrease[en] = area_elm[en] * (
-                    domain_density[dn][elm_states[en]] * domain_thickness[dn][elm_states[en]] -
-                    domain_density[dn][elm_states[en] - 1] * domain_thickness[dn][elm_states[en] - 1])
-            if elm_states[en] < len(domain_density[dn]) - 1:  # for potential switching up
-                mass_increase[en] = area_elm[en] * (
-                    domain_density[dn][elm_states[en] + 1] * domain_thickness[dn][elm_states[en] + 1] -
-                    domain_density[dn][elm_states[en]] * domain_thickness[dn][elm_states[en]])
-        else:  # volumes mass difference
-            mass[i] += volume_elm[en] * domain_density[dn][elm_states[en]]
-            if (failing is False) and (elm_states[en] != 0):  # for potential switching down
-                mass_decrease[en] = volume_elm[en] * (
-                    domain_density[dn][elm_states[en]] - domain_density[dn][elm_states[en] - 1])
-            if elm_states[en] < len(domain_density[dn]) - 1:  # for potential switching up
-                mass_increase[en] = volume_elm[en] * (
-                    domain_density[dn][elm_states[en] + 1] - domain_density[dn][elm_states[en]])
+        elm_mass_en = elm_mass[en].tolist()  # masses of the element in states
+        mass[i] += elm_mass_en[elm_states[en]]
+        if (failing is False) and (elm_states[en] != 0):  # for potential switching down
+            mass_decrease[en] = elm_mass_en[elm_states[en]] - elm_mass_en[elm_states[en] - 1]
+        if elm_states[en] < len(domain_density[dn]) - 1:  # for potential switching up
+            mass_increase[en] = elm_mass_en[elm_states[en] + 1] - elm_mass_en[elm_states[en]]
 
     mass_increase = {}
     mass_decrease = {}
@@ -1019,31 +1651,28 @@ def switching(elm_states, domains_from_config, domain_optimized, domains, FI_ste
                             pass
 
             else: # domain_same_state is False
-                for en in domains[dn]:
-                    if FI_step_max[en] >= 1:  # increase state if it is not the highest
-                        en_added = False
-                        if elm_states[en] < len(domain_density[dn]) - 1:
-                            elm_states[en] += 1
-                            en_added = True
-                        if en in domain_shells[dn]:  # shells
-                            mass[i] += area_elm[en] * domain_density[dn][elm_states[en]] * domain_thickness[
-                                dn][elm_states[en]]
-                            if en_added is True:
-                                mass_difference = area_elm[en] * (
-                                    domain_density[dn][elm_states[en]] * domain_thickness[dn][elm_states[en]] -
-                                    domain_density[dn][elm_states[en] - 1] * domain_thickness[dn][elm_states[en] - 1])
-                                mass_overloaded += mass_difference
-                                mass_goal_i += mass_difference
-                        else:  # volumes
-                            mass[i] += volume_elm[en] * domain_density[dn][elm_states[en]]
-                            if en_added is True:
-                                mass_difference = volume_elm[en] * (
-                                    domain_density[dn][elm_states[en]] - domain_density[dn][elm_states[en] - 1])
-                                mass_overloaded += mass_difference
-                                mass_goal_i += mass_difference
-                    else:  # rest of elements prepare to sorting and switching
-                        compute_difference()  # mass to add or remove
-                        sensitivity_number_opt[en] = sensitivity_number[en]
+                en_domain = np.asarray(domains[dn], dtype=np.int64)
+                domain_mass = elm_mass.array[elm_mass.rows(en_domain)]  # masses of elements in states
+                rows = np.arange(len(en_domain))
+                states = np.array([elm_states[en] for en in domains[dn]], dtype=np.int64)
+                failing = np.array([FI_step_max[en] >= 1 for en in domains[dn]], dtype=bool)
+                # increase state of failing elements if it is not the highest
+                added = failing & (states < len(domain_density[dn]) - 1)
+                mass_state = domain_mass[rows, states]
+                mass_added_state = domain_mass[rows, states + added]
+                mass[i] += float(mass_added_state.sum())
+                mass_difference = float((mass_added_state - mass_state)[added].sum())
+                mass_overloaded += mass_difference
+                mass_goal_i += mass_difference
+                elm_states.update(zip(en_domain[added].tolist(), (states[added] + 1).tolist()))
+                # rest of elements prepare to sorting and switching
+                down = ~failing & (states != 0)  # for potential switching down
+                mass_decrease.update(zip(en_domain[down].tolist(),
+                                         (mass_state - domain_mass[rows, states - 1])[down].tolist()))
+                up = ~failing & (states < len(domain_density[dn]) - 1)  # for potential switching up
+                mass_increase.update(zip(en_domain[up].tolist(), (domain_mass[rows, np.minimum(
+                    states + 1, domain_mass.shape[1] - 1)] - mass_state)[up].tolist()))
+                sensitivity_number_opt.update((en, sensitivity_number[en]) for en in en_domain[~failing].tolist())
     # sorting
     sensitivity_number_sorted = sorted(sensitivity_number_opt.items(), key=operator.itemgetter(1))
     sensitivity_number_sorted2 = list(sensitivity_number_sorted)
@@ -1131,68 +1760,59 @@ def switching(elm_states, domains_from_config, domain_optimized, domains, FI_ste
     return elm_states, mass
 
 
+# function returning array of states of elements in the given element category
+def category_states(elm_states, elm_category):
+    return np.array([elm_states[en] for en in elm_category.numbers.tolist()], dtype=np.int32)
+
+
+# function returning sorted node numbers associated to elements of categories, optionally masked by element state
+def associated_nodes_of(elm_categories, masks=None):
+    associated = [np.zeros(0, dtype=np.int32)]
+    for k, elm_category in enumerate(elm_categories):
+        if masks is None:
+            associated.append(elm_category.connectivity.ravel())
+        else:
+            associated.append(elm_category.connectivity[masks[k]].ravel())
+    return np.unique(np.concatenate(associated))
+
+
 # function for exporting the resulting mesh in separate files for each state of elm_states
 # only elements found by import_inp function are taken into account
 def export_frd(file_nameW, nodes, Elements, elm_states, number_of_states):
-
-    def get_associated_nodes(elm_category):
-        for en in elm_category:
-            if elm_states[en] == state:
-                associated_nodes.extend(elm_category[en])
-
-    def write_elm(elm_category, category_symbol):
-        for en in elm_category:
-            if elm_states[en] == state:
-                f.write(" -1" + str(en).rjust(10, " ") + category_symbol.rjust(5, " ") + "\n")
-                line = ""
-                nodes_done = 0
-                if category_symbol == "4":  # hexa20 different node numbering in inp and frd file
-                    for np in [0, 1, 2, 3, 4, 5, 6, 7, 8, 9,
-                               10, 11, 16, 17, 18, 19, 12, 13, 14, 15]:
-                        nn = elm_category[en][np]
-                        line += str(nn).rjust(10, " ")
-                        if np in [9, 15]:
-                            f.write(" -2" + line + "\n")
-                            line = ""
-                elif category_symbol == "5":  # penta15 has different node numbering in inp and frd file
-                    for np in [0, 1, 2, 3, 4, 5, 6, 7, 8, 12,
-                               13, 14, 9, 10, 11]:
-                        nn = elm_category[en][np]
-                        line += str(nn).rjust(10, " ")
-                        if np in [12, 11]:
-                            f.write(" -2" + line + "\n")
-                            line = ""
-                else:
-                    for nn in elm_category[en]:
-                        line += str(nn).rjust(10, " ")
-                        nodes_done += 1
-                        if nodes_done == 10 and elm_category != Elements.tetra10:
-                            f.write(" -2" + line + "\n")
-                            line = ""
-                    f.write(" -2" + line + "\n")
+    # (element category, frd symbol, node order in frd file)
+    frd_categories = [(Elements.tria3, "7", None),
+                      (Elements.tria6, "8", None),
+                      (Elements.quad4, "9", None),
+                      (Elements.quad8, "10", None),
+                      (Elements.tetra4, "3", None),
+                      (Elements.tetra10, "6", None),
+                      (Elements.penta6, "2", None),
+                      (Elements.penta15, "5", [0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 13, 14, 9, 10, 11]),
+                      (Elements.hexa8, "1", None),
+                      (Elements.hexa20, "4", [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 16, 17, 18, 19, 12, 13, 14, 15])]
+    categories_states = [category_states(elm_states, elm_category) for (elm_category, _, _) in frd_categories]
+
+    def write_elm(elm_category, category_symbol, frd_order, mask):
+        connectivity = elm_category.connectivity[mask]
+        if frd_order:  # hexa20 and penta15 have different node numbering in inp and frd file
+            connectivity = connectivity[:, frd_order]
+        for en, nod in zip(elm_category.numbers[mask].tolist(), connectivity.tolist()):
+            f.write(" -1" + str(en).rjust(10, " ") + category_symbol.rjust(5, " ") + "\n")
+            for start in range(0, len(nod), 10):  # at most 10 nodes in a line
+                f.write(" -2" + "".join([str(nn).rjust(10, " ") for nn in nod[start:start + 10]]) + "\n")
 
     # find all possible states in elm_states and run separately for each of them
     for state in range(number_of_states):
         f = open(file_nameW + "_state" + str(state) + ".frd", "w")
+        masks = [states == state for states in categories_states]
 
         # print nodes
-        associated_nodes = []
-        get_associated_nodes(Elements.tria3)
-        get_associated_nodes(Elements.tria6)
-        get_associated_nodes(Elements.quad4)
-        get_associated_nodes(Elements.quad8)
-        get_associated_nodes(Elements.tetra4)
-        get_associated_nodes(Elements.tetra10)
-        get_associated_nodes(Elements.penta6)
-        get_associated_nodes(Elements.penta15)
-        get_associated_nodes(Elements.hexa8)
-        get_associated_nodes(Elements.hexa20)
-
-        associated_nodes = sorted(list(set(associated_nodes)))
+        associated_nodes = associated_nodes_of([elm_category for (elm_category, _, _) in frd_categories], masks)
+        coordinates = nodes.coordinates[nodes.rows(associated_nodes)]
         f.write("    1C\n")
         f.write("    2C" + str(len(associated_nodes)).rjust(30, " ") + 37 * " " + "1\n")
-        for nn in associated_nodes:
-            f.write(" -1" + str(nn).rjust(10, " ") + "% .5E% .5E% .5E\n" % (nodes[nn][0], nodes[nn][1], nodes[nn][2]))
+        for nn, xyz in zip(associated_nodes.tolist(), coordinates.tolist()):
+            f.write(" -1" + str(nn).rjust(10, " ") + "% .5E% .5E% .5E\n" % (xyz[0], xyz[1], xyz[2]))
         f.write(" -3\n")
 
         # print elements
@@ -1201,16 +1821,8 @@ def export_frd(file_nameW, nodes, Elements, elm_states, number_of_states):
             if elm_states[en] == state:
                 elm_sum += 1
         f.write("    3C" + str(elm_sum).rjust(30, " ") + 37 * " " + "1\n")
-        write_elm(Elements.tria3, "7")
-        write_elm(Elements.tria6, "8")
-        write_elm(Elements.quad4, "9")
-        write_elm(Elements.quad8, "10")
-        write_elm(Elements.tetra4, "3")
-        write_elm(Elements.tetra10, "6")
-        write_elm(Elements.penta6, "2")
-        write_elm(Elements.penta15, "5")
-        write_elm(Elements.hexa8, "1")
-        write_elm(Elements.hexa20, "4")
+        for (elm_category, category_symbol, frd_order), mask in zip(frd_categories, masks):
+            write_elm(elm_category, category_symbol, frd_order, mask)
         f.write(" -3\n")
         f.close()
 
@@ -1218,66 +1830,45 @@ def export_frd(file_nameW, nodes, Elements, elm_states, number_of_states):
 # function for exporting the resulting mesh in separate files for each state of elm_states
 # only elements found by import_inp function are taken into account
 def export_inp(file_nameW, nodes, Elements, elm_states, number_of_states):
-
-    def get_associated_nodes(elm_category):
-        for en in elm_category:
-            if elm_states[en] == state:
-                associated_nodes.extend(elm_category[en])
-
-    def write_elements_of_type(elm_type, elm_type_inp):
-        if elm_type:
+    # (element category, element type written to inp file), prints only basic element types
+    inp_categories = [(Elements.tria3, "S3"),
+                      (Elements.tria6, "S6"),
+                      (Elements.quad4, "S4"),
+                      (Elements.quad8, "S8"),
+                      (Elements.tetra4, "C3D4"),
+                      (Elements.tetra10, "C3D10"),
+                      (Elements.penta6, "C3D6"),
+                      (Elements.penta15, "C3D15"),
+                      (Elements.hexa8, "C3D8"),
+                      (Elements.hexa20, "C3D20")]
+    categories_states = [category_states(elm_states, elm_category) for (elm_category, _) in inp_categories]
+
+    def write_elements_of_type(elm_category, elm_type_inp, mask):
+        if mask.any():
             f.write("*ELEMENT, TYPE=" + elm_type_inp + ", ELSET=state" + str(state) + "\n")
-            for en, nod in elm_type.items():
-                if elm_states[en] == state:
-                    f.write(str(en))
-                    for nn in nod:
-                        f.write(", " + str(nn))
-                    f.write("\n")
+            for en, nod in zip(elm_category.numbers[mask].tolist(), elm_category.connectivity[mask].tolist()):
+                if len(nod) > 15:  # hexa20 needs the second line
+                    f.write(str(en) + ", " + ", ".join(map(str, nod[:15])) + "\n")
+                    f.write(", " + ", ".join(map(str, nod[15:])) + "\n")
+                else:
+                    f.write(str(en) + ", " + ", ".join(map(str, nod)) + "\n")
 
     # find all possible states in elm_states and run separately for each of them
     for state in range(number_of_states):
         f = open(file_nameW + "_state" + str(state) + ".inp", "w")
+        masks = [states == state for states in categories_states]
 
         # print nodes
-        associated_nodes = []
-        get_associated_nodes(Elements.tria3)
-        get_associated_nodes(Elements.tria6)
-        get_associated_nodes(Elements.quad4)
-        get_associated_nodes(Elements.quad8)
-        get_associated_nodes(Elements.tetra4)
-        get_associated_nodes(Elements.tetra10)
-        get_associated_nodes(Elements.penta6)
-        get_associated_nodes(Elements.penta15)
-        get_associated_nodes(Elements.hexa8)
-        get_associated_nodes(Elements.hexa20)
-
-        associated_nodes = sorted(list(set(associated_nodes)))
+        associated_nodes = associated_nodes_of([elm_category for (elm_category, _) in inp_categories], masks)
+        coordinates = nodes.coordinates[nodes.rows(associated_nodes)]
         f.write("*NODE\n")
-        for nn in associated_nodes:
-            f.write(str(nn) + ", % .5E, % .5E, % .5E\n" % (nodes[nn][0], nodes[nn][1], nodes[nn][2]))
+        for nn, xyz in zip(associated_nodes.tolist(), coordinates.tolist()):
+            f.write(str(nn) + ", % .5E, % .5E, % .5E\n" % (xyz[0], xyz[1], xyz[2]))
         f.write("\n")
 
         # print elements
-        # prints only basic element types
-        write_elements_of_type(Elements.tria3, "S3")
-        write_elements_of_type(Elements.tria6, "S6")
-        write_elements_of_type(Elements.quad4, "S4")
-        write_elements_of_type(Elements.quad8, "S8")
-        write_elements_of_type(Elements.tetra4, "C3D4")
-        write_elements_of_type(Elements.tetra10, "C3D10")
-        write_elements_of_type(Elements.penta6, "C3D6")
-        write_elements_of_type(Elements.penta15, "C3D15")
-        write_elements_of_type(Elements.hexa8, "C3D8")
-        if Elements.hexa20:
-            f.write("*ELEMENT, TYPE=C3D20\n")
-            for en, nod in Elements.hexa20.items():
-                f.write(str(en))
-                for nn in nod[:15]:
-                    f.write(", " + str(nn))
-                f.write("\n")
-                for nn in nod[15:]:
-                    f.write(", " + str(nn))
-                f.write("\n")
+        for (elm_category, elm_type_inp), mask in zip(inp_categories, masks):
+            write_elements_of_type(elm_category, elm_type_inp, mask)
         f.close()
 
 
@@ -1289,69 +1880,43 @@ def vtk_mesh(file_nameW, nodes, Elements):
     f.write("ASCII\n")
     f.write("DATASET UNSTRUCTURED_GRID\n")
 
-    # nodes
-    associated_nodes = set()
-    for nn_lists in list(Elements.tria3.values()) + list(Elements.tria6.values()) + list(Elements.quad4.values()) + \
-            list(Elements.quad8.values()) + list(Elements.tetra4.values()) + list(Elements.tetra10.values()) + \
-            list(Elements.penta6.values()) + list(Elements.penta15.values()) + list(Elements.hexa8.values()) + \
-            list(Elements.hexa20.values()):
-        associated_nodes.update(nn_lists)
-    associated_nodes = sorted(associated_nodes)
-    # node renumbering table for vtk format which does not jump over node numbers and contains only associated nodes
-    nodes_vtk = [None for _ in range(max(nodes.keys()) + 1)]
-    nn_vtk = 0
-    for nn in associated_nodes:
-        nodes_vtk[nn] = nn_vtk
-        nn_vtk += 1
+    # (element category, number of written nodes, vtk cell type)
+    vtk_categories = [(Elements.tria3, 3, "5"),
+                      (Elements.tria6, 6, "22"),
+                      (Elements.quad4, 4, "9"),
+                      (Elements.quad8, 8, "23"),
+                      (Elements.tetra4, 4, "10"),
+                      (Elements.tetra10, 10, "24"),
+                      (Elements.penta6, 6, "13"),
+                      (Elements.penta15, 6, "13"),  # quadratic wedge not supported
+                      (Elements.hexa8, 8, "12"),
+                      (Elements.hexa20, 20, "25")]
 
+    # nodes
+    associated_nodes = associated_nodes_of([elm_category for (elm_category, _, _) in vtk_categories])
+    # node renumbering for vtk format which does not jump over node numbers and contains only associated nodes
     f.write("\nPOINTS " + str(len(associated_nodes)) + " float\n")
-    for nn in associated_nodes:
-        f.write("{} {} {}\n".format(nodes[nn][0], nodes[nn][1], nodes[nn][2]))
+    for xyz in nodes.coordinates[nodes.rows(associated_nodes)].tolist():
+        f.write("{} {} {}\n".format(xyz[0], xyz[1], xyz[2]))
 
     # elements
-    number_of_elements = len(Elements.tria3) + len(Elements.tria6) + len(Elements.quad4) + len(Elements.quad8) + \
-                         len(Elements.tetra4) + len(Elements.tetra10) + len(Elements.penta6) + len(Elements.penta15) + \
-                         len(Elements.hexa8) + len(Elements.hexa20)
-    en_all = list(Elements.tria3.keys()) + list(Elements.tria6.keys()) + list(Elements.quad4.keys()) + \
-             list(Elements.quad8.keys()) + list(Elements.tetra4.keys()) + list(Elements.tetra10.keys()) + \
-             list(Elements.penta6.keys()) + list(Elements.penta15.keys()) + list(Elements.hexa8.keys()) + \
-             list(Elements.hexa20.keys())  # defines vtk element numbering from 0
-
-    size_of_cells = 4 * len(Elements.tria3) + 7 * len(Elements.tria6) + 5 * len(Elements.quad4) + \
-                    9 * len(Elements.quad8) + 5 * len(Elements.tetra4) + 9 * len(Elements.tetra10) + \
-                    7 * len(Elements.penta6) + 7 * len(Elements.penta15) + 9 * len(Elements.hexa8) + \
-                    21 * len(Elements.hexa20)  # quadratic wedge not supported
+    number_of_elements = 0
+    size_of_cells = 0
+    en_all = []  # defines vtk element numbering from 0
+    for (elm_category, node_length, _) in vtk_categories:
+        number_of_elements += len(elm_category)
+        size_of_cells += (node_length + 1) * len(elm_category)
+        en_all += elm_category.numbers.tolist()
     f.write("\nCELLS " + str(number_of_elements) + " " + str(size_of_cells) + "\n")
 
-    def write_elm(elm_category, node_length):
-        for en in elm_category:
-            f.write(node_length)
-            for nn in elm_category[en]:
-                f.write(" " + str(nodes_vtk[nn]))
-            f.write("\n")
-
-    write_elm(Elements.tria3, "3")
-    write_elm(Elements.tria6, "6")
-    write_elm(Elements.quad4, "4")
-    write_elm(Elements.quad8, "8")
-    write_elm(Elements.tetra4, "4")
-    write_elm(Elements.tetra10, "10")
-    write_elm(Elements.penta6, "6")
-    write_elm(Elements.penta15, "6")  # quadratic wedge not supported
-    write_elm(Elements.hexa8, "8")
-    write_elm(Elements.hexa20, "20")
+    for (elm_category, node_length, _) in vtk_categories:
+        nodes_vtk = np.searchsorted(associated_nodes, elm_category.connectivity[:, :node_length])
+        for nod in nodes_vtk.tolist():
+            f.write(str(node_length) + " " + " ".join(map(str, nod)) + "\n")
 
     f.write("\nCELL_TYPES " + str(number_of_elements) + "\n")
-    f.write("5\n" * len(Elements.tria3))
-    f.write("22\n" * len(Elements.tria6))
-    f.write("9\n" * len(Elements.quad4))
-    f.write("23\n" * len(Elements.quad8))
-    f.write("10\n" * len(Elements.tetra4))
-    f.write("24\n" * len(Elements.tetra10))
-    f.write("13\n" * len(Elements.penta6))
-    f.write("13\n" * len(Elements.penta15))  # quadratic wedge not supported
-    f.write("12\n" * len(Elements.hexa8))
-    f.write("25\n" * len(Elements.hexa20))
+    for (elm_category, _, cell_type) in vtk_categories:
+        f.write((cell_type + "\n") * len(elm_category))
 
     f.write("\nCELL_DATA " + str(number_of_elements) + "\n")
 
@@ -28,8 +28,11 @@ file_name = "Plane_Mesh.inp"
 mass_goal_ratio = 0.4
 continue_from = ""
 filter_list = [["simple", 0]]
+filter_memory_limit = 0
+structured_grid_filter = False
 optimization_base = "stiffness"
 cpu_cores = 0
+mesh_cache = False
 FI_violated_tolerance = 1
 decay_coefficient = -0.2
 shells_as_composite = False
@@ -41,6 +44,7 @@ mass_removal_ratio = 0.03
 ratio_type = "relative"
 compensate_state_filter = False
 steps_superposition = []
+stream_steps = False
 iterations_limit = "auto"
 tolerance = 1e-3
 save_iteration_results = 0
@@ -104,8 +108,11 @@ for dn in domain_optimized:
 msg += ("mass_goal_ratio         = %s\n" % mass_goal_ratio)
 msg += ("continue_from           = %s\n" % continue_from)
 msg += ("filter_list             = %s\n" % filter_list)
+msg += ("filter_memory_limit     = %s\n" % filter_memory_limit)
+msg += ("structured_grid_filter  = %s\n" % structured_grid_filter)
 msg += ("optimization_base       = %s\n" % optimization_base)
 msg += ("cpu_cores               = %s\n" % cpu_cores)
+msg += ("mesh_cache              = %s\n" % mesh_cache)
 msg += ("FI_violated_tolerance   = %s\n" % FI_violated_tolerance)
 msg += ("decay_coefficient       = %s\n" % decay_coefficient)
 msg += ("shells_as_composite     = %s\n" % shells_as_composite)
@@ -117,6 +124,7 @@ msg += ("ratio_type              = %s\n" % ratio_type)
 msg += ("compensate_state_filter = %s\n" % compensate_state_filter)
 msg += ("sensitivity_averaging   = %s\n" % sensitivity_averaging)
 msg += ("steps_superposition     = %s\n" % steps_superposition)
+msg += ("stream_steps            = %s\n" % stream_steps)
 msg += ("iterations_limit        = %s\n" % iterations_limit)
 msg += ("tolerance               = %s\n" % tolerance)
 msg += ("save_iteration_results  = %s\n" % save_iteration_results)
@@ -130,9 +138,12 @@ if optimization_base == "stiffness" and reference_points == "nodes":
     beso_lib.write_to_log(file_name, "\nERROR: " + msg + "\n")
     assert False, msg
 
+# failure criteria are compiled once for all iterations
+criteria_compiled = beso_lib.compile_criteria(criteria, file_name)
+
 # mesh and domains importing
 [nodes, Elements, domains, opt_domains, en_all, plane_strain, plane_stress, axisymmetry] = beso_lib.import_inp(
-    file_name, domains_from_config, domain_optimized, shells_as_composite)
+    file_name, domains_from_config, domain_optimized, shells_as_composite, mesh_cache, cpu_cores)
 domain_shells = {}
 domain_volumes = {}
 for dn in domains_from_config:  # distinguishing shell elements and volume elements
@@ -168,18 +179,24 @@ else:
 
 # computing volume or area, and centre of gravity of each element
 [cg, cg_min, cg_max, volume_elm, area_elm] = beso_lib.elm_volume_cg(file_name, nodes, Elements)
-mass = [0.0]
-mass_full = 0  # sum from initial states TODO make it independent on starting elm_states?
 
-for dn in domains_from_config:
-    if domain_optimized[dn] is True:
-        for en in domain_shells[dn]:
-            mass[0] += domain_density[dn][elm_states[en]] * area_elm[en] * domain_thickness[dn][elm_states[en]]
-            mass_full += domain_density[dn][len(domain_density[dn]) - 1] * area_elm[en] * domain_thickness[dn][
-                                                                                            len(domain_density[dn]) - 1]
-        for en in domain_volumes[dn]:
-            mass[0] += domain_density[dn][elm_states[en]] * volume_elm[en]
-            mass_full += domain_density[dn][len(domain_density[dn]) - 1] * volume_elm[en]
+# element values of domains are kept in arrays, rows are given by elm_numbers, domains by labels elm_domain
+[elm_numbers, elm_domain] = beso_lib.domain_labels(domains, domains_from_config)
+elm_numbers_list = elm_numbers.tolist()
+elm_rows = np.arange(len(elm_numbers))
+density_table = beso_lib.domain_state_table(domain_density, domains_from_config, number_of_states)
+thickness_table = beso_lib.domain_state_table(domain_thickness, domains_from_config, number_of_states)
+# masses of elements in all states, elm_mass[en] returns masses of the element en for states
+elm_mass = beso_lib.NumberedArray(elm_numbers, beso_lib.mass_table(elm_numbers_list, elm_domain, density_table,
+                                                                    thickness_table, area_elm, volume_elm))
+elm_optimized = np.array([domain_optimized[dn] is True for dn in domains_from_config], dtype=bool)[elm_domain]
+elm_optimized &= np.array([en in area_elm or en in volume_elm for en in elm_numbers_list], dtype=bool)
+elm_highest = np.array([len(domain_density[dn]) - 1 for dn in domains_from_config], dtype=np.int32)[elm_domain]
+
+states = np.array([elm_states[en] for en in elm_numbers_list], dtype=np.int32)
+mass = [float(elm_mass.array[elm_rows, states][elm_optimized].sum())]
+# sum from initial states TODO make it independent on starting elm_states?
+mass_full = float(elm_mass.array[elm_rows, elm_highest][elm_optimized].sum())
 print("initial optimization domains mass {}" .format(mass[0]))
 
 if iterations_limit == "auto":  # automatic setting
@@ -197,18 +214,21 @@ if iterations_limit == "auto":  # automatic setting
     beso_lib.write_to_log(file_name, msg)
 
 # preparing parameters for filtering sensitivity numbers
-weight_factor2 = {}
-near_elm = {}
-weight_factor3 = []
-near_elm3 = []
-near_points = []
+weight_factor2 = []
+elm_filtered2 = []
+near_elm = []
+elm_filtered_morphology = []
+weight_factor3_points = []
+weight_factor3_elm = []
+elm_filtered3 = []
 weight_factor_node = []
-M = []
 weight_factor_distance = []
-near_nodes = []
+elm_filtered1 = []
+weight_factor_topological = []
+elm_filtered_topological = []
+filter_domains = []  # elements to filter of each filter
 for ft in filter_list:
     if ft[0] and ft[1]:
-        f_range = ft[1]
         if len(ft) == 2:
             domains_to_filter = list(opt_domains)
             beso_filters.check_same_state(domain_same_state, domains_from_config, file_name)
@@ -219,24 +239,90 @@ for ft in filter_list:
                 domains_to_filter += domains[dn]
                 filtered_dn.append(dn)
             beso_filters.check_same_state(domain_same_state, filtered_dn, file_name)
+        filter_domains.append(domains_to_filter)
+    else:
+        filter_domains.append([])
+# prepared filters are loaded from cache files if the mesh is cached, None for filters to be prepared
+filter_prepared = []
+for ft, domains_to_filter in zip(filter_list, filter_domains):
+    prepared = None
+    if ft[0] and ft[1] and Elements.cache_key:
+        [cache_file, cache_key] = beso_filters.filter_cache(file_name, Elements.cache_key, ft[0], ft[1],
+                                                            domains_to_filter, filter_memory_limit,
+                                                            structured_grid_filter)
+        prepared = beso_filters.load_prepared(cache_file, cache_key)
+        if prepared is not None:
+            msg = "\nINFO: filter " + ft[0] + " with range " + str(ft[1]) + " loaded from " + cache_file + "\n"
+            beso_lib.write_to_log(file_name, msg)
+    filter_prepared.append(prepared)
+# near elements and near nodes are searched only once within the largest range of filters using them
+elm_neighbourhood = None
+node_neighbourhood = None
+elm_ranges = []
+elm_domains = []
+node_ranges = []
+node_domains = []
+for ft, domains_to_filter, prepared in zip(filter_list, filter_domains, filter_prepared):
+    if ft[0] and ft[1] and prepared is None:
+        if ft[0] == "simple" or ft[0].split()[0] in ["erode", "dilate", "open", "close", "open-close", "close-open",
+                                                     "combine"]:
+            elm_ranges.append(ft[1])
+            elm_domains += domains_to_filter
+        elif ft[0] == "over nodes":
+            node_ranges.append(ft[1])
+            node_domains += domains_to_filter
+if elm_ranges and not filter_memory_limit:  # with memory limit, near elements are searched for each filter in chunks
+    elm_neighbourhood = beso_filters.Neighbourhood(cg, max(elm_ranges), elm_domains, None, cpu_cores)
+if node_ranges:
+    node_neighbourhood = beso_filters.Neighbourhood(cg, max(node_ranges), node_domains, nodes, cpu_cores)
+for ft, domains_to_filter, prepared in zip(filter_list, filter_domains, filter_prepared):
+    if ft[0] and ft[1]:
+        f_range = ft[1]
+        loaded = prepared is not None
         if ft[0] == "over points":
             beso_filters.check_same_state(domain_same_state, domains_from_config, file_name)
-            [w_f3, n_e3, n_p] = beso_filters.prepare3_tetra_grid(file_name, cg, f_range, domains_to_filter)
-            weight_factor3.append(w_f3)
-            near_elm3.append(n_e3)
-            near_points.append(n_p)
+            if not loaded:
+                prepared = beso_filters.prepare3_tetra_grid(file_name, cg, f_range, domains_to_filter)
+            [w_f3_p, w_f3_e, e_f3] = prepared
+            weight_factor3_points.append(w_f3_p)
+            weight_factor3_elm.append(w_f3_e)
+            elm_filtered3.append(e_f3)
         elif  ft[0] == "over nodes":
             beso_filters.check_same_state(domain_same_state, domains_from_config, file_name)
-            [w_f_n, M_, w_f_d, n_n] = beso_filters.prepare1s(nodes, Elements, cg, f_range, domains_to_filter)
+            if not loaded:
+                prepared = beso_filters.prepare1s(nodes, Elements, cg, f_range, domains_to_filter, node_neighbourhood)
+            [w_f_n, w_f_d, e_f1] = prepared
             weight_factor_node.append(w_f_n)
-            M.append(M_)
             weight_factor_distance.append(w_f_d)
-            near_nodes.append(n_n)
+            elm_filtered1.append(e_f1)
         elif ft[0] == "simple":
-            [weight_factor2, near_elm] = beso_filters.prepare2s(cg, cg_min, cg_max, f_range, domains_to_filter,
-                                                                weight_factor2, near_elm)
+            if not loaded:
+                prepared = beso_filters.prepare2s(cg, f_range, domains_to_filter, elm_neighbourhood,
+                                                  filter_memory_limit, file_name, structured_grid_filter)
+            [w_f2, e_f2] = prepared
+            weight_factor2.append(w_f2)
+            elm_filtered2.append(e_f2)
         elif ft[0].split()[0] in ["erode", "dilate", "open", "close", "open-close", "close-open", "combine"]:
-            near_elm = beso_filters.prepare_morphology(cg, cg_min, cg_max, f_range, domains_to_filter, near_elm)
+            if not loaded:
+                prepared = beso_filters.prepare_morphology(cg, f_range, domains_to_filter, elm_neighbourhood,
+                                                           filter_memory_limit, file_name)
+            [n_e, e_f] = prepared
+            near_elm.append(n_e)
+            elm_filtered_morphology.append(e_f)
+        elif ft[0] == "topological":
+            if not loaded:
+                prepared = beso_filters.prepare_topological(file_name, nodes, Elements, f_range, domains_to_filter)
+            [w_f_t, e_f_t] = prepared
+            weight_factor_topological.append(w_f_t)
+            elm_filtered_topological.append(e_f_t)
+        if Elements.cache_key and not loaded and prepared is not None:
+            [cache_file, cache_key] = beso_filters.filter_cache(file_name, Elements.cache_key, ft[0], f_range,
+                                                                domains_to_filter, filter_memory_limit,
+                                                                structured_grid_filter)
+            if not beso_filters.save_prepared(cache_file, cache_key, prepared):
+                msg = "\nINFO: filter " + ft[0] + " with range " + str(f_range) + " is not cached"
+                msg += " since its near elements are spilled to temporary files\n"
+                beso_lib.write_to_log(file_name, msg)
 
 # separating elements for reading nodal input
 if reference_points == "nodes":
@@ -268,7 +354,7 @@ en_all_vtk = beso_lib.vtk_mesh(file_name_resulting_states, nodes, Elements)
 
 # ITERATION CYCLE
 sensitivity_number = {}
-sensitivity_number_old = {}
+sensitivity_number_old = None  # sensitivity numbers of opt_domains from the last iteration for averaging
 FI_max = []
 FI_mean = []  # list of mean stress in every iteration
 FI_mean_without_state0 = []  # mean stress without elements in state 0
@@ -296,113 +382,92 @@ while True:
     if reference_points == "integration points":  # from .dat file
         [FI_step, energy_density_step] = beso_lib.import_FI_int_pt(reference_value, file_nameW, domains, criteria,
                                                                    domain_FI, file_name, elm_states,
-                                                                   domains_from_config, steps_superposition)
+                                                                   domains_from_config, steps_superposition,
+                                                                   criteria_compiled, stream_steps)
     elif reference_points == "nodes":  # from .frd file
         FI_step = beso_lib.import_FI_node(reference_value, file_nameW, domains, criteria, domain_FI, file_name,
-                                          elm_states, steps_superposition)
+                                          elm_states, steps_superposition, criteria_compiled, stream_steps)
     if not FI_step:
         msg = "CalculiX results not found, check CalculiX for errors."
         beso_lib.write_to_log(file_name, "\nERROR: " + msg + "\n")
         assert False, msg
 
-    FI_max.append({})
-    for dn in domains_from_config:
-        FI_max[i][dn] = 0
-        for en in domains[dn]:
-            for sn in range(len(FI_step)):
-                try:
-                    FI_step_en = list(filter(lambda a: a is not None, FI_step[sn][en]))  # drop None FI
-                    FI_max[i][dn] = max(FI_max[i][dn], max(FI_step_en))
-                except ValueError:
-                    msg = "FI_max computing failed. Check if each domain contains at least one failure criterion."
-                    beso_lib.write_to_log(file_name, "\nERROR: " + msg + "\n")
-                    raise Exception(msg)
-                except KeyError:
-                    msg = "Some result values are missing. Check available disk space or steps_superposition settings"
-                    beso_lib.write_to_log(file_name, "\nERROR: " + msg + "\n")
-                    raise Exception(msg)
-    print("FI_max, number of violated elements, domain name")
+    try:
+        [FI_array, energy_density_array] = beso_lib.step_arrays(
+            FI_step, energy_density_step if optimization_base == "stiffness" else None, elm_numbers_list,
+            len(criteria))
+    except KeyError:
+        msg = "Some result values are missing. Check available disk space or steps_superposition settings"
+        beso_lib.write_to_log(file_name, "\nERROR: " + msg + "\n")
+        raise Exception(msg)
+    FI_elm_step = np.fmax.reduce(FI_array, axis=2, initial=np.nan)  # maximal FI of criteria, nan without criteria
+    if np.isnan(FI_elm_step).any():
+        msg = "FI_max computing failed. Check if each domain contains at least one failure criterion."
+        beso_lib.write_to_log(file_name, "\nERROR: " + msg + "\n")
+        raise Exception(msg)
 
     # handling with more steps
-    FI_step_max = {}  # maximal FI over all steps for each element in this iteration
-    energy_density_enlist = {}   # {en1: [energy from sn1, energy from sn2, ...], en2: [], ...}
-    FI_violated.append([])
-    dno = 0
-    for dn in domains_from_config:
-        FI_violated[i].append(0)
-        for en in domains[dn]:
-            FI_step_max[en] = 0
-            if optimization_base == "stiffness":
-                energy_density_enlist[en] = []
-            for sn in range(len(FI_step)):
-                FI_step_en = list(filter(lambda a: a is not None, FI_step[sn][en]))  # drop None FI
-                FI_step_max[en] = max(FI_step_max[en], max(FI_step_en))
-                if optimization_base == "stiffness":
-                    energy_density_enlist[en].append(energy_density_step[sn][en])
-            if optimization_base == "stiffness":
-                sensitivity_number[en] = max(energy_density_enlist[en])
-            elif optimization_base == "failure_index":
-                sensitivity_number[en] = FI_step_max[en] / domain_density[dn][elm_states[en]]
-            if FI_step_max[en] >= 1:
-                FI_violated[i][dno] += 1
+    FI_step_max_array = FI_elm_step.max(axis=0, initial=0)  # maximal FI over all steps for each element
+    FI_max_domain = np.zeros(len(domains_from_config))
+    np.maximum.at(FI_max_domain, elm_domain, FI_step_max_array)
+    FI_max.append(dict(zip(domains_from_config, FI_max_domain.tolist())))
+    FI_violated.append(np.bincount(elm_domain, weights=FI_step_max_array >= 1,
+                                   minlength=len(domains_from_config)).astype(int).tolist())
+    states = np.array([elm_states[en] for en in elm_numbers_list], dtype=np.int32)
+    if optimization_base == "stiffness":
+        sensitivity_array = energy_density_array.max(axis=0)
+    elif optimization_base == "failure_index":
+        sensitivity_array = FI_step_max_array / density_table[elm_domain, states]
+    sensitivity_number = dict(zip(elm_numbers_list, sensitivity_array.tolist()))
+    FI_step_max = dict(zip(elm_numbers_list, FI_step_max_array.tolist()))
+    print("FI_max, number of violated elements, domain name")
+    for dno, dn in enumerate(domains_from_config):
         print(str(FI_max[i][dn]).rjust(15) + " " + str(FI_violated[i][dno]).rjust(4) + "   " + dn)
-        dno += 1
 
     # filtering sensitivity number
     kp = 0
     kn = 0
+    ks = 0
+    km = 0
+    kt = 0
     for ft in filter_list:
         if ft[0] and ft[1]:
-            if len(ft) == 2:
-                domains_to_filter = list(opt_domains)
-            else:
-                domains_to_filter = []
-                for dn in ft[2:]:
-                    domains_to_filter += domains[dn]
             if ft[0] == "over points":
-                sensitivity_number = beso_filters.run3(sensitivity_number, weight_factor3[kp], near_elm3[kp],
-                                                       near_points[kp])
+                sensitivity_number = beso_filters.run3(sensitivity_number, weight_factor3_points[kp],
+                                                       weight_factor3_elm[kp], elm_filtered3[kp])
                 kp += 1
             elif ft[0] == "over nodes":
-                sensitivity_number = beso_filters.run1(file_name, sensitivity_number, weight_factor_node[kn], M[kn],
-                                                       weight_factor_distance[kn], near_nodes[kn], nodes,
-                                                       domains_to_filter)
+                sensitivity_number = beso_filters.run1(file_name, sensitivity_number, weight_factor_node[kn],
+                                                       weight_factor_distance[kn], elm_filtered1[kn], Elements)
                 kn += 1
             elif ft[0] == "simple":
-                sensitivity_number = beso_filters.run2(file_name, sensitivity_number, weight_factor2, near_elm,
-                                                       domains_to_filter)
+                sensitivity_number = beso_filters.run2(file_name, sensitivity_number, weight_factor2[ks],
+                                                       elm_filtered2[ks])
+                ks += 1
+            elif ft[0] == "topological":
+                sensitivity_number = beso_filters.run2(file_name, sensitivity_number, weight_factor_topological[kt],
+                                                       elm_filtered_topological[kt])
+                kt += 1
             elif ft[0].split()[0] in ["erode", "dilate", "open", "close", "open-close", "close-open", "combine"]:
                 if ft[0].split()[1] == "sensitivity":
-                    sensitivity_number = beso_filters.run_morphology(sensitivity_number, near_elm, domains_to_filter,
-                                                                     ft[0].split()[0])
+                    sensitivity_number = beso_filters.run_morphology(sensitivity_number, near_elm[km],
+                                                                     elm_filtered_morphology[km], ft[0].split()[0])
+                km += 1
 
     if sensitivity_averaging:
-        for en in opt_domains:
-            # averaging with the last iteration should stabilize iterations
-            if i > 0:
-                sensitivity_number[en] = (sensitivity_number[en] + sensitivity_number_old[en]) / 2.0
-            sensitivity_number_old[en] = sensitivity_number[en]  # for averaging in the next step
+        sensitivity_opt = np.array([sensitivity_number[en] for en in opt_domains])
+        # averaging with the last iteration should stabilize iterations
+        if i > 0:
+            sensitivity_opt = (sensitivity_opt + sensitivity_number_old) / 2.0
+        sensitivity_number_old = sensitivity_opt  # for averaging in the next step
+        sensitivity_number.update(zip(opt_domains, sensitivity_opt.tolist()))
 
     # computing mean stress from maximums of each element in all steps in the optimization domain
-    FI_mean_sum = 0
-    FI_mean_sum_without_state0 = 0
-    mass_without_state0 = 0
-    for dn in domain_optimized:
-        if domain_optimized[dn] is True:
-            for en in domain_shells[dn]:
-                mass_elm = domain_density[dn][elm_states[en]] * area_elm[en] * domain_thickness[dn][elm_states[en]]
-                FI_mean_sum += FI_step_max[en] * mass_elm
-                if elm_states[en] != 0:
-                    FI_mean_sum_without_state0 += FI_step_max[en] * mass_elm
-                    mass_without_state0 += mass_elm
-            for en in domain_volumes[dn]:
-                mass_elm = domain_density[dn][elm_states[en]] * volume_elm[en]
-                FI_mean_sum += FI_step_max[en] * mass_elm
-                if elm_states[en] != 0:
-                    FI_mean_sum_without_state0 += FI_step_max[en] * mass_elm
-                    mass_without_state0 += mass_elm
-    FI_mean.append(FI_mean_sum / mass[i])
-    FI_mean_without_state0.append(FI_mean_sum_without_state0 / mass_without_state0)
+    mass_elm = np.where(elm_optimized, elm_mass.array[elm_rows, states], 0.0)
+    mass_elm_without_state0 = np.where(states != 0, mass_elm, 0.0)
+    FI_mean.append(float(np.dot(FI_step_max_array, mass_elm)) / mass[i])
+    FI_mean_without_state0.append(float(np.dot(FI_step_max_array, mass_elm_without_state0)) /
+                                  float(mass_elm_without_state0.sum()))
     print("FI_mean                = {}" .format(FI_mean[i]))
     print("FI_mean_without_state0 = {}".format(FI_mean_without_state0[i]))
 
@@ -485,42 +550,30 @@ while True:
     elif ratio_type == "relative":
         mass_referential = mass[i - 1]
     [elm_states, mass] = beso_lib.switching(elm_states, domains_from_config, domain_optimized, domains, FI_step_max,
-                                            domain_density, domain_thickness, domain_shells, area_elm, volume_elm,
-                                            sensitivity_number, mass, mass_referential, mass_addition_ratio,
-                                            mass_removal_ratio, compensate_state_filter, mass_excess, decay_coefficient,
-                                            FI_violated, i_violated, i, mass_goal_i, domain_same_state)
+                                            domain_density, elm_mass, sensitivity_number, mass, mass_referential,
+                                            mass_addition_ratio, mass_removal_ratio, compensate_state_filter,
+                                            mass_excess, decay_coefficient, FI_violated, i_violated, i, mass_goal_i,
+                                            domain_same_state)
 
     # filtering state
     mass_not_filtered = mass[i]  # use variable to store the "right" mass
+    km = 0
     for ft in filter_list:
         if ft[0] and ft[1]:
-            if len(ft) == 2:
-                domains_to_filter = list(opt_domains)
-            else:
-                domains_to_filter = []
-                for dn in ft[2:]:
-                    domains_to_filter += domains[dn]
-
             if ft[0].split()[0] in ["erode", "dilate", "open", "close", "open-close", "close-open", "combine"]:
                 if ft[0].split()[1] == "state":
                     # the same filter as for sensitivity numbers
-                    elm_states_filtered = beso_filters.run_morphology(elm_states, near_elm, domains_to_filter,
-                                                                      ft[0].split()[0], FI_step_max)
+                    elm_states_filtered = beso_filters.run_morphology(elm_states, near_elm[km],
+                                                                      elm_filtered_morphology[km], ft[0].split()[0],
+                                                                      FI_step_max)
                     # compute mass difference
-                    for dn in domains_from_config:
-                        if domain_optimized[dn] is True:
-                            for en in domain_shells[dn]:
-                                if elm_states[en] != elm_states_filtered[en]:
-                                    mass[i] += area_elm[en] * (
-                                        domain_density[dn][elm_states_filtered[en]] * domain_thickness[dn][
-                                                                                                elm_states_filtered[en]]
-                                        - domain_density[dn][elm_states[en]] * domain_thickness[dn][elm_states[en]])
-                                    elm_states[en] = elm_states_filtered[en]
-                            for en in domain_volumes[dn]:
-                                if elm_states[en] != elm_states_filtered[en]:
-                                    mass[i] += volume_elm[en] * (
-                                        domain_density[dn][elm_states_filtered[en]] - domain_density[dn][elm_states[en]])
-                                    elm_states[en] = elm_states_filtered[en]
+                    states = np.array([elm_states[en] for en in elm_numbers_list], dtype=np.int32)
+                    states_filtered = np.array([elm_states_filtered[en] for en in elm_numbers_list], dtype=np.int32)
+                    changed = elm_optimized & (states != states_filtered)
+                    mass[i] += float((elm_mass.array[elm_rows, states_filtered] -
+                                      elm_mass.array[elm_rows, states])[changed].sum())
+                    elm_states.update(zip(elm_numbers[changed].tolist(), states_filtered[changed].tolist()))
+                km += 1
     print("mass = {}" .format(mass[i]))
     mass_excess = mass[i] - mass_not_filtered
 
@@ -1,6 +1,8 @@
 # The aim of this script is to read .inp file and separate adjacend elements, so that every element has its own nodes,
 # thus nodal results from CalculiX are not averaged between neighbouring elements.
 
+import beso_lib
+
 
 def separating(file_name, nodes={}):
 
@@ -10,48 +12,8 @@ def separating(file_name, nodes={}):
             file_nameR = file_name
         else:
             file_nameR = file_name + ".inp"
-        fR = open(file_nameR, "r")
-
-        nodes = {}  # dict with nodes position
-        model_definition = True
-        read_node = False
-        line = "\n"
-        include = ""
-        while line != "":
-            if include:
-                line = f_include.readline()
-                if line == "":
-                    f_include.close()
-                    include = ""
-                    line = fR.readline()
-            else:
-                line = fR.readline()
-            if line.strip() == '':
-                continue
-            elif line[0] == '*':  # start/end of a reading set
-                if line[0:2] == '**':  # comments
-                    continue
-                if line[:8].upper() == "*INCLUDE":
-                    start = 1 + line.index("=")
-                    include = line[start:].strip().strip('"')
-                    f_include = open(include, "r")
-                    continue
-                read_node = False
-
-            # reading nodes
-            if (line[:5].upper() == "*NODE") and (model_definition is True):
-                read_node = True
-            elif read_node is True:
-                line_list = line.split(',')
-                number = int(line_list[0])
-                x = float(line_list[1])
-                y = float(line_list[2])
-                z = float(line_list[3])
-                nodes[number] = [x, y, z]
-
-            elif line[:5].upper() == "*STEP":
-                model_definition = False
-        fR.close()
+        mesh = beso_lib.read_inp(file_nameR)
+        nodes = beso_lib.Nodes(mesh["node_numbers"], mesh["node_coordinates"])
 
     # creating new file from old one with separated elements
     if file_name[-4:] == ".inp":
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import beso_lib
+
+
+def mesh_domains(mesh):
+    domains = {}
+    ends = np.cumsum(mesh["domain_sizes"])
+    for dn, end, size in zip(mesh["domain_names"], ends, mesh["domain_sizes"]):
+        domains[str(dn)] = mesh["domain_elements"][end - size:end].tolist()
+    return domains
+
+
+def test_parse_block_rejects_names():
+    assert beso_lib.parse_block(b"1, B\n", np.int64) is None
+    assert beso_lib.parse_block(b"1, 2,\n3\n", np.int64).tolist() == [1, 2, 3]
+
+
+def test_elset_with_numbers_and_set_names(tmp_path):
+    file_name = str(tmp_path / "mixed.inp")
+    with open(file_name, "w") as f:
+        f.write("*NODE\n1, 0, 0, 0\n2, 1, 0, 0\n3, 0, 1, 0\n4, 0, 0, 1\n5, 1, 1, 1\n")
+        f.write("*ELEMENT, TYPE=C3D4\n1, 1, 2, 3, 4\n2, 2, 3, 4, 5\n")
+        f.write("*ELSET, ELSET=B\n2\n")
+        f.write("*ELSET, ELSET=DOM\n1, B\n")
+    domains = mesh_domains(beso_lib.read_inp(file_name))
+    assert sorted(domains["DOM"]) == [1, 2]